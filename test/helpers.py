@@ -1,6 +1,6 @@
 
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
 from importlib.resources import path
 from json import load as load_json
 from logging import getLogger
@@ -9,6 +9,7 @@ from re import compile, fullmatch, split
 from shutil import copy
 from shutil import copytree
 from shutil import rmtree
+from struct import pack
 from typing import Dict, List
 from typing import Optional
 from typing import Tuple
@@ -315,6 +316,139 @@ def skiplive_condition() -> bool:
 
 skip_live = mark.skipif( skiplive_condition(), reason="live test not enabled as configuration is missing" )
 
+def skipbenchmark_condition() -> bool:
+	from os import getenv
+	return not getenv( 'TRACS_BENCHMARK' )
+
+skip_benchmark = mark.skipif( skipbenchmark_condition(), reason="benchmark not enabled, set TRACS_BENCHMARK to run benchmarks" )
+
+def synthetic_gpx( starttime: datetime, points: int = 10 ) -> str:
+	"""
+	Creates a minimal GPX track starting at the provided (UTC) time, having one point per second.
+	"""
+	trkpts = ''.join( [
+		f'<trkpt lat="{51.0 + p * 0.0001:.6f}" lon="{13.0 + p * 0.0001:.6f}"><ele>100.0</ele><time>{( starttime + timedelta( seconds=p ) ).isoformat()}Z</time></trkpt>'
+		for p in range( points )
+	] )
+	return '<?xml version="1.0" encoding="UTF-8"?>' \
+	       '<gpx version="1.1" creator="tracs" xmlns="http://www.topografix.com/GPX/1/1">' \
+	       f'<trk><trkseg>{trkpts}</trkseg></trk></gpx>'
+
+def synthetic_tcx( starttime: datetime, points: int = 10, laps: int = 1 ) -> str:
+	"""
+	Creates a minimal TCX activity starting at the provided (UTC) time, having one point per second. Points are split
+	evenly into the provided number of laps.
+	"""
+	size = max( points // laps, 1 )
+	lap_elements = []
+	for start in range( 0, points, size ):
+		trkpts = ''.join( [
+			f'<Trackpoint><Time>{( starttime + timedelta( seconds=p ) ).isoformat()}.000Z</Time><HeartRateBpm><Value>100</Value></HeartRateBpm></Trackpoint>'
+			for p in range( start, min( start + size, points ) )
+		] )
+		lap_elements.append(
+			f'<Lap StartTime="{( starttime + timedelta( seconds=start ) ).isoformat()}.000Z"><TotalTimeSeconds>{min( size, points - start ) - 1}.0</TotalTimeSeconds>'
+			f'<DistanceMeters>0.0</DistanceMeters><Calories>0</Calories><Intensity>Active</Intensity><TriggerMethod>Manual</TriggerMethod>'
+			f'<Track>{trkpts}</Track></Lap>'
+		)
+	return '<?xml version="1.0" encoding="UTF-8"?>' \
+	       '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"><Activities><Activity Sport="Other">' \
+	       f'<Id>{starttime.isoformat()}.000Z</Id>{"".join( lap_elements )}</Activity></Activities></TrainingCenterDatabase>'
+
+FIT_CRC_TABLE = [ 0x0000, 0xCC01, 0xD801, 0x1400, 0xF001, 0x3C00, 0x2800, 0xE401, 0xA001, 0x6C00, 0x7800, 0xB401, 0x5000, 0x9C01, 0x8801, 0x4400 ]
+
+def fit_crc( data: bytes, crc: int = 0 ) -> int:
+	for byte in data:
+		crc = ( crc >> 4 ) ^ FIT_CRC_TABLE[crc & 0xF] ^ FIT_CRC_TABLE[byte & 0xF]
+		crc = ( crc >> 4 ) ^ FIT_CRC_TABLE[crc & 0xF] ^ FIT_CRC_TABLE[( byte >> 4 ) & 0xF]
+	return crc
+
+def synthetic_fit( starttime: datetime, points: int = 10, laps: int = 1, compressed: bool = False, developer: bool = False, big_endian: bool = False ) -> bytes:
+	"""
+	Creates a minimal FIT running activity starting at the provided (UTC) time, having one record per second, moving
+	north at 3 m/s. Points are split evenly into the provided number of laps, followed by one session. Records after
+	the first one may use compressed timestamp headers, developer records contain an additional field 'stride'. The heart
+	rate of the second record is invalid.
+	"""
+	e, ts = '>' if big_endian else '<', lambda dt: int( dt.timestamp() ) - 631065600
+	semicircles = lambda degrees: int( round( degrees * 2 ** 31 / 180 ) )
+
+	def definition( local: int, mesg_num: int, fields: List[Tuple[int, int, int]], developer_fields: List[Tuple[int, int, int]] = None ) -> bytes:
+		message = pack( f'{e}BBBHB', 0x40 | ( 0x20 if developer_fields else 0 ) | local, 0, 1 if big_endian else 0, mesg_num, len( fields ) )
+		message += b''.join( pack( 'BBB', *f ) for f in fields )
+		if developer_fields:
+			message += pack( 'B', len( developer_fields ) ) + b''.join( pack( 'BBB', *f ) for f in developer_fields )
+		return message
+
+	record_fields = [ ( 0, 4, 0x85 ), ( 1, 4, 0x85 ), ( 2, 2, 0x84 ), ( 3, 1, 0x02 ), ( 5, 4, 0x86 ), ( 6, 2, 0x84 ) ]
+	developer_fields = [ ( 0, 1, 0 ) ] if developer else None
+	lap_fields = [ ( 253, 4, 0x86 ), ( 2, 4, 0x86 ), ( 7, 4, 0x86 ), ( 8, 4, 0x86 ), ( 9, 4, 0x86 ), ( 11, 2, 0x84 ), ( 15, 1, 0x02 ), ( 16, 1, 0x02 ), ( 25, 1, 0x00 ) ]
+	session_fields = [
+		( 253, 4, 0x86 ), ( 2, 4, 0x86 ), ( 3, 4, 0x85 ), ( 4, 4, 0x85 ), ( 5, 1, 0x00 ), ( 7, 4, 0x86 ), ( 8, 4, 0x86 ), ( 9, 4, 0x86 ),
+		( 11, 2, 0x84 ), ( 14, 2, 0x84 ), ( 15, 2, 0x84 ), ( 16, 1, 0x02 ), ( 17, 1, 0x02 ), ( 22, 2, 0x84 ), ( 23, 2, 0x84 ),
+	]
+
+	# file_id: type activity, manufacturer development, time created
+	data = definition( 0, 0, [ ( 0, 1, 0x00 ), ( 1, 2, 0x84 ), ( 4, 4, 0x86 ) ] ) + pack( f'{e}BBHI', 0, 4, 255, ts( starttime ) )
+	if developer:
+		data += definition( 0, 207, [ ( 3, 1, 0x02 ) ] ) + pack( f'{e}BB', 0, 0 )
+		data += definition( 0, 206, [ ( 0, 1, 0x02 ), ( 1, 1, 0x02 ), ( 2, 1, 0x02 ), ( 3, 16, 0x07 ), ( 8, 8, 0x07 ) ] )
+		data += pack( f'{e}BBBB16s8s', 0, 0, 0, 0x02, b'stride', b'cm' )
+	data += definition( 1, 20, [ ( 253, 4, 0x86 ), *record_fields ], developer_fields )
+	if compressed:
+		data += definition( 2, 20, record_fields, developer_fields )
+	data += definition( 3, 19, lap_fields ) + definition( 4, 18, session_fields )
+
+	size = max( points // laps, 1 )
+	for start in range( 0, points, size ):
+		for p in range( start, min( start + size, points ) ):
+			t = ts( starttime + timedelta( seconds=p ) )
+			values = ( semicircles( 51.0 + p * 0.000027 ), semicircles( 13.0 ), ( 100 + p % 50 + 500 ) * 5, 0xFF if p == 1 else 120 + p % 40, p * 300, 3000 )
+			if compressed and p > 0:
+				data += pack( f'{e}BiiHBIH', 0x80 | ( 2 << 5 ) | ( t & 0x1F ), *values )
+			else:
+				data += pack( f'{e}BIiiHBIH', 1, t, *values )
+			if developer:
+				data += pack( 'B', 80 + p % 10 )
+
+		end = min( start + size, points ) - 1
+		data += pack(
+			f'{e}BIIIIIHBBB', 3, ts( starttime + timedelta( seconds=end ) ), ts( starttime + timedelta( seconds=start ) ),
+			( end - start ) * 1000, ( end - start ) * 1000, ( end - start ) * 300, 10, 140, 159, 1
+		)
+
+	data += pack(
+		f'{e}BIIiiBIIIHHHBBHH', 4, ts( starttime + timedelta( seconds=points - 1 ) ), ts( starttime ), semicircles( 51.0 ), semicircles( 13.0 ),
+		1, ( points - 1 ) * 1000, ( points - 1 ) * 1000, ( points - 1 ) * 300, 10 * laps, 3000, 3000, 139, 159, 49, 49
+	)
+
+	header = pack( '<BBHI4s', 14, 0x20, 2132, len( data ), b'.FIT' )
+	header += pack( '<H', fit_crc( header ) )
+	return header + data + pack( '<H', fit_crc( header + data ) )
+
+def write_synthetic_gpx( path: Path, count: int, points: int = 10 ) -> None:
+	"""
+	Writes count minimal GPX files with distinct start times to the provided directory.
+	"""
+	path.mkdir( parents=True, exist_ok=True )
+	start = datetime( 2020, 1, 1, 8, 0, 0 )
+	for i in range( count ):
+		path.joinpath( f'{i:05d}.gpx' ).write_text( synthetic_gpx( start + timedelta( hours=i ), points ), encoding='UTF-8' )
+
+def synthetic_waze_takeout( drives: int, points: int = 10 ) -> str:
+	"""
+	Creates the location details section of a Waze account activity takeout (2022 format), one drive per day.
+	"""
+	lines, start = [ 'Location details (date, time, coordinates)' ], datetime( 2021, 1, 1, 8, 0, 0 )
+	for d in range( drives ):
+		t = start + timedelta( days=d )
+		coords = ' => '.join( [
+			f'{( t + timedelta( seconds=3 * p ) ).strftime( "%Y-%m-%d %H:%M:%S" )} GMT({49.3 + p * 0.0001:.6f}; {10.8 + p * 0.0001:.6f})'
+			for p in range( points )
+		] )
+		lines.append( f'"[{{""0"":""{coords}""}}]"' )
+	return '\n'.join( lines ) + '\n\n'
+
 # mock gpx resource
 
 gpx_resource = '''
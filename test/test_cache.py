@@ -0,0 +1,167 @@
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import List
+
+from dateutil.tz import UTC
+from pytest import fail, fixture, mark
+from requests_cache import DO_NOT_CACHE
+
+from test.helpers import synthetic_gpx, synthetic_tcx
+from test.mock import Mock
+from tracs.activity import Activity
+from tracs.cache import ACCESS_TABLE, ActivityCache, CachePolicy, HTTP_CACHE_FILENAME, HttpCache
+from tracs.plugins.gpx import GPX_TYPE, GPXImporter
+from tracs.plugins.tcx import TCX_TYPE
+from tracs.resources import Resource
+from tracs.service import Service
+
+class RequestHandler( BaseHTTPRequestHandler ):
+
+	requests: List[str] = []
+
+	def do_GET( self ):
+		RequestHandler.requests.append( f'{self.path} {self.headers.get( "If-None-Match" )}' )
+		if self.headers.get( 'If-None-Match' ) == '"v1"':
+			self.send_response( 304 )
+			self.end_headers()
+		else:
+			body = f'content of {self.path}'.encode( 'UTF-8' ) * 100
+			self.send_response( 200 )
+			self.send_header( 'ETag', '"v1"' )
+			self.send_header( 'Content-Length', str( len( body ) ) )
+			self.end_headers()
+			self.wfile.write( body )
+
+	def log_message( self, format, *args ):
+		pass
+
+@fixture
+def server() -> str:
+	RequestHandler.requests = []
+	httpd = ThreadingHTTPServer( ( '127.0.0.1', 0 ), RequestHandler )
+	Thread( target=httpd.serve_forever, daemon=True ).start()
+	yield f'http://127.0.0.1:{httpd.server_address[1]}'
+	httpd.shutdown()
+
+def test_policy():
+	policy = CachePolicy()
+	assert policy.expire_after() == 3600 and policy.expire_after( download=True ) == -1
+	assert CachePolicy( enabled=False ).expire_after() == DO_NOT_CACHE
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_policy_from_config( ctx ):
+	assert CachePolicy.from_config( ctx, 'polar' ) == CachePolicy()
+
+	ctx.config.plugins.polar.cache = { 'ttl': 60 }
+	assert CachePolicy.from_config( ctx, 'polar' ).ttl == 60
+	assert CachePolicy.from_config( ctx, 'strava' ).ttl == 3600
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_cache( ctx, server ):
+	session = HttpCache.for_context( ctx, 'polar' )
+	assert ctx.cache_fs.exists( HTTP_CACHE_FILENAME )
+
+	# requests are not cached unless asked for
+	session.get( f'{server}/login' )
+	session.get( f'{server}/login' )
+	assert RequestHandler.requests == [ '/login None', '/login None' ]
+
+	# cached responses survive a new session
+	assert not session.get( f'{server}/export/1', expire_after=-1 ).from_cache
+	assert HttpCache.for_context( ctx, 'polar' ).get( f'{server}/export/1', expire_after=-1 ).from_cache
+	assert len( RequestHandler.requests ) == 3
+
+	# expired responses are revalidated
+	session.get( f'{server}/events', expire_after=0 )
+	response = session.get( f'{server}/events', expire_after=0 )
+	assert RequestHandler.requests[-1] == '/events "v1"' and response.from_cache and response.status_code == 200
+
+	status = session.status()
+	assert status['responses'] == 2 and status['size'] > 0
+
+	session.clear()
+	assert session.status()['responses'] == 0
+
+def test_eviction( server ):
+	session = HttpCache()
+	for i in range( 1, 4 ):
+		session.get( f'{server}/export/{i}', expire_after=-1 )
+	session.get( f'{server}/export/1', expire_after=-1 ) # access first response again
+
+	evicted = session.evict( session.size - 1 )
+	assert len( evicted ) == 1
+	assert session.get( f'{server}/export/1', expire_after=-1 ).from_cache
+	assert not session.get( f'{server}/export/2', expire_after=-1 ).from_cache
+
+def test_eviction_running_total( server, monkeypatch ):
+	session, evictions = HttpCache( policy=CachePolicy( max_size=5000 ) ), []
+	evict = session.evict
+	monkeypatch.setattr( session, 'evict', lambda *args, **kwargs: evictions.append( 1 ) or evict( *args, **kwargs ) )
+
+	# responses which are not cached are not tracked and don't trigger an eviction
+	for _ in range( 3 ):
+		session.get( f'{server}/login' )
+	with session.cache.responses.connection() as con:
+		assert con.execute( f'SELECT COUNT(*) FROM {ACCESS_TABLE}' ).fetchone()[0] == 0
+	assert evictions == []
+
+	# eviction runs only when the stored size passes the limit
+	session.get( f'{server}/export/1', expire_after=-1 )
+	assert evictions == [] and session.size < 5000
+	for i in range( 2, 5 ):
+		session.get( f'{server}/export/{i}', expire_after=-1 )
+	assert len( evictions ) > 0 and session.size <= 5000 and session.status()['responses'] < 4
+
+def test_activity_cache( tmp_path, monkeypatch ):
+	cache = ActivityCache()
+	for i in range( 3 ):
+		cache.put( f'key{i}', Activity( name=f'activity {i}', starttime=datetime( 2024, 6, 1, 10 + i, tzinfo=UTC ), duration=timedelta( minutes=i ) ) )
+	assert cache.get( 'key0' ).name == 'activity 0' and cache.get( 'key2' ).duration == timedelta( minutes=2 ) and cache.get( 'key3' ) is None
+
+	# least recently used activity is evicted first
+	assert cache.evict( cache.size - 1 ) == [ 'key1' ]
+
+	# activities loaded via handler are taken from the cache as long as the file does not change
+	path, handler = tmp_path / 'track.gpx', GPXImporter()
+	path.write_text( synthetic_gpx( datetime( 2024, 6, 1, 10 ), 100 ) )
+	activity = handler.load_as_activity( path=path, cache=cache )
+	assert handler.cache_key( path ).startswith( f'{path}|{path.stat().st_size}|' ) and cache.get( handler.cache_key( path ) ) == Activity.from_dict( { **activity.to_dict(), 'resources': [] } )
+
+	monkeypatch.setattr( GPXImporter, 'load', lambda *args, **kwargs: None ) # any parsing fails from now on
+	cached = handler.load_as_activity( path=path, cache=cache )
+	assert cached.starttime == activity.starttime and cached.distance == activity.distance and cached.resources[0].path == 'track.gpx'
+
+	# changed files result in a different key
+	key = handler.cache_key( path )
+	path.write_text( synthetic_gpx( datetime( 2024, 6, 2, 10 ), 101 ) )
+	assert handler.cache_key( path ) != key and cache.get( handler.cache_key( path ) ) is None
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_activity_cache_service( service: Mock, monkeypatch ):
+	content = synthetic_gpx( datetime( 2024, 6, 1, 10 ), 100 ).encode( 'UTF-8' )
+	r = Resource( uid='mock:1001', path='1001.gpx', type=GPX_TYPE )
+	service.stream_resource( r, iter( [ content ] ) )
+	activity = Service.as_activity_from( r )
+
+	# unchanged resources are not read and parsed again
+	monkeypatch.setattr( GPXImporter, 'as_activity', lambda *args, **kwargs: None )
+	for a in [ Service.as_activity_from( r ), Service.as_activity( r ) ]:
+		assert a.starttime == activity.starttime and a.duration == activity.duration and a.resources[0] is r
+	assert r.content is None and r.raw is None
+	assert ActivityCache.for_context( service.ctx ).status()['hits'] == 2
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_as_activity_content_only( service: Mock, monkeypatch ):
+	start = datetime( 2024, 6, 1, 10 )
+	gpx, tcx = Resource( uid='mock:1001', path='1001.gpx', type=GPX_TYPE ), Resource( uid='mock:1002', path='1002.tcx', type=TCX_TYPE )
+	service.stream_resource( gpx, iter( [ synthetic_gpx( start, 100 ).encode( 'UTF-8' ) ] ) )
+	service.stream_resource( tcx, iter( [ synthetic_tcx( start, 100 ).encode( 'UTF-8' ) ] ) )
+
+	# reimporting does not build object trees, activities are created from the content only
+	monkeypatch.setattr( 'tracs.plugins.gpx.parse_gpx', lambda *args, **kwargs: fail( 'parse_gpx must not be called' ) )
+	monkeypatch.setattr( 'tracs.plugins.tcx.fromstring', lambda *args, **kwargs: fail( 'fromstring must not be called' ) )
+	for r in [ gpx, tcx ]:
+		assert Service.as_activity( r ).starttime == start.replace( tzinfo=UTC ) and r.content and r.raw is None and r.data is None
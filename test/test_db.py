@@ -14,6 +14,7 @@ from tracs.plugins.polar import POLAR_FLOW_TYPE
 from tracs.plugins.strava import STRAVA_TYPE
 from tracs.plugins.tcx import TCX_TYPE
 from tracs.resources import Resource
+from tracs.uid import UID
 
 def test_new_db_without_path():
 	db = ActivityDb( path=None )
@@ -102,6 +103,35 @@ def test_contains( db ):
 	assert not db.contains_resource( uid='polar:1001', path='polar/1/0/0/1001/1001.xxx' )
 	assert not db.contains_resource( uid='polar:999', path='999.gpx' )
 
+	# uid denotes the resource when path is missing, uids of callers are left untouched
+	assert db.contains_resource( uid='polar:1001/1001.gpx', path=None ) and not db.contains_resource( uid='polar:1001', path=None )
+	uid = UID( 'polar:1001/1001.gpx' )
+	assert db.contains_resource( uid, None ) and db.contains_resource( uid, 'polar/1/0/0/1001/1001.gpx' )
+	assert uid.path == '1001.gpx' and uid.to_str() == 'polar:1001/1001.gpx'
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_known_resources( db ):
+	known = Resource( uid='polar:1001', path='polar/1/0/0/1001/1001.gpx' )
+	short = Resource( uid='polar:1005', path='1005.gpx' )
+	unknown = Resource( uid='polar:999', path='999.gpx' )
+
+	assert db.known_resources( [] ) == set()
+	assert db.known_resources( [known, short, unknown] ) == { known, short }
+
+	# index is kept up to date when inserting activities
+	db.insert( Activity( uid='polar:999', resources=[ Resource( uid='polar:999', path='polar/9/9/9/999/999.gpx' ) ] ) )
+	assert db.known_resources( [unknown] ) == { unknown }
+	assert db.contains_resource( 'polar:999', '999.gpx' )
+
+	# digests follow changed content of known resources, unknown resources are not added
+	db.update_resource_digest( Resource( uid='polar:999', path='999.gpx', digest='d1' ) )
+	db.update_resource_digest( Resource( uid='polar:998', path='998.gpx', digest='d2' ) )
+	assert db.resource_key_for_digest( 'd1' ) == ( 'polar', 999, '999.gpx' ) and db.resource_key_for_digest( 'd2' ) is None
+	assert not db.contains_resource( 'polar:998', '998.gpx' )
+
+	db.update_resource_digest( Resource( uid='polar:999', path='999.gpx', digest='d3' ) )
+	assert db.resource_key_for_digest( 'd1' ) is None and db.resource_key_for_digest( 'd3' ) == ( 'polar', 999, '999.gpx' )
+
 @mark.context( env='default', persist='clone', cleanup=True )
 @mark.db( summary_types=[POLAR_FLOW_TYPE, STRAVA_TYPE], recording_types=[GPX_TYPE, TCX_TYPE] )
 def test_get( db ):
@@ -1,12 +1,12 @@
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
 from pytest import mark
 
 from test.conftest import Environment
 from tracs.activity import Activity
 from tracs.config import ApplicationContext
-from tracs.group import group_activities2
-from tracs.group import ungroup_activities
+from tracs.group import find_group_candidates, group_activities, group_activities2, SCORE_THRESHOLD, similarity
+from tracs.group import part_activities, ungroup_activities
 from tracs.registry import Registry
 
 @mark.xfail # todo: needs improvement
@@ -35,3 +35,72 @@ def test_ungroup_activities( env: Environment ):
 	env.db.register_summary_types( *[ rt.type for rt in Registry.instance().resource_types.values() if rt.summary ] )
 	g = env.db.get_by_id( 2001 )
 	result = ungroup_activities( env.ctx, [g], force=True )
+
+def test_similarity():
+	a = Activity( starttime=datetime( 2024, 6, 1, 10 ), endtime=datetime( 2024, 6, 1, 11 ), distance=30000, duration=timedelta( hours=1 ),
+	              location_latitude_start=51.0, location_longitude_start=13.0, uid='polar:1' )
+	b = Activity( starttime=datetime( 2024, 6, 1, 10, 0, 30 ), endtime=datetime( 2024, 6, 1, 11 ), distance=29800, duration=timedelta( minutes=59 ),
+	              location_latitude_start=51.0001, location_longitude_start=13.0, uid='strava:1' )
+	c = Activity( starttime=datetime( 2024, 6, 1, 10, 30 ), endtime=datetime( 2024, 6, 1, 11 ), distance=5000, uid='strava:2' )
+
+	assert similarity( a, a ) == 1.0
+	assert 0.95 < similarity( a, b ) < 1.0
+	assert similarity( a, c ) < 0.5
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+def test_group_candidates( env: Environment, monkeypatch ):
+	ctx = env.ctx
+	start = datetime( 2024, 6, 1, 10 )
+	activities = []
+	for day in range( 3 ):
+		s = start + timedelta( days=day )
+		activities.append( Activity( starttime=s, endtime=s + timedelta( hours=1 ), distance=30000, uid=f'polar:{day}' ) )
+		activities.append( Activity( starttime=s + timedelta( seconds=10 ), endtime=s + timedelta( hours=1 ), distance=30100, uid=f'strava:{day}' ) )
+	# a weak candidate: overlapping, but very different
+	activities.append( Activity( starttime=start + timedelta( minutes=50 ), endtime=start + timedelta( hours=2 ), distance=2000, uid='bikecitizens:1' ) )
+	ctx.db.insert( *activities )
+
+	candidates = find_group_candidates( ctx.db.activities )
+	assert len( candidates ) == 3
+	assert candidates[-1].score < SCORE_THRESHOLD <= candidates[0].score
+	assert [ len( c.members ) for c in candidates ] == [ 2, 2, 3 ]
+
+	commits = []
+	commit = ctx.db.commit
+	ctx.db.commit = lambda do_commit=True: ( do_commit and commits.append( 1 ) ) or commit( do_commit )
+
+	monkeypatch.setattr( 'tracs.group.confirm_grouping', lambda *args, **kwargs: False ) # weak candidate is rejected
+	accepted = group_activities( ctx, ctx.db.activities, auto=True, pretend=True )
+	assert len( accepted ) == 2 and len( ctx.db.activities ) == 7 and commits == []
+
+	accepted = group_activities( ctx, ctx.db.activities, auto=True )
+	assert len( accepted ) == 2 and commits == [ 1 ]
+	assert sorted( a.uid.classifier for a in ctx.db.activities ) == [ 'bikecitizens', 'group', 'group', 'polar', 'strava' ]
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+def test_group_twice( env: Environment ):
+	ctx, start = env.ctx, datetime( 2024, 6, 1, 10 )
+	ctx.db.insert(
+		Activity( starttime=start, endtime=start + timedelta( hours=1 ), distance=30000, uid='polar:1' ),
+		Activity( starttime=start + timedelta( seconds=10 ), endtime=start + timedelta( hours=1 ), distance=30100, uid='strava:1' ),
+	)
+	assert len( group_activities( ctx, ctx.db.activities, auto=True ) ) == 1
+	assert [ a.uid.to_str() for a in ctx.db.activities ] == [ 'group:240601100000' ]
+
+	# grouping the same cluster again with a new member must not drop the existing group
+	ctx.db.insert( Activity( starttime=start + timedelta( seconds=20 ), endtime=start + timedelta( hours=1 ), distance=29900, uid='bikecitizens:1' ) )
+	assert len( group_activities( ctx, ctx.db.activities, auto=True ) ) == 1
+	assert [ a.uid.to_str() for a in ctx.db.activities ] == [ 'group:240601100000' ]
+	assert ctx.db.activities[0].metadata.members == sorted( [ 'bikecitizens:1', 'group:240601100000' ] )
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+def test_part_activities( env: Environment ):
+	a = Activity( starttime=datetime( 2024, 6, 1, 10 ), endtime=datetime( 2024, 6, 1, 11 ), uid='polar:1' )
+	b = Activity( starttime=datetime( 2024, 6, 1, 10, 30 ), endtime=datetime( 2024, 6, 1, 12 ), uid='polar:2' )
+	c = Activity( starttime=datetime( 2024, 6, 1, 11, 30 ), endtime=datetime( 2024, 6, 1, 12, 30 ), uid='polar:3' )
+	inserted = []
+	env.ctx.db.insert = lambda *activities: inserted.extend( activities ) or [ 1 ]
+	part_activities( [ c, b, a ], force=True, ctx=env.ctx )
+
+	# overlapping activities are skipped, gaps are measured against the last part
+	assert [ ( p.uids, p.gap ) for p in inserted[0].parts ] == [ ( [ 'polar:1' ], time( 0 ) ), ( [ 'polar:3' ], time( 0, 30 ) ) ]
@@ -1,21 +1,35 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from csv import Error as CSVError, field_size_limit, reader
+from datetime import datetime, timedelta
+from io import StringIO
+from math import isnan
+from time import perf_counter
+
+from dateutil.tz import UTC
+
 from fs.errors import ResourceNotFound
 from fs.osfs import OSFS
+from gpxpy import parse as parse_gpx
 from gpxpy.gpx import GPX
 from lxml.etree import tostring
 from lxml.objectify import ObjectifiedElement
-from pytest import mark, raises
+from pytest import fail, mark, raises
 
+from helpers import skip_benchmark, synthetic_fit, synthetic_gpx, synthetic_tcx
+from tracs.activity_types import ActivityTypes
 from tracs.errors import ResourceImportException
 from tracs.plugins.bikecitizens import BIKECITIZENS_TYPE, BikecitizensActivity, BikecitizensImporter
 from tracs.plugins.csv import CSV_TYPE, CSVHandler
-from tracs.plugins.gpx import GPX_TYPE, GPXImporter
+from tracs.plugins.fit import decode_fit, FIT_TYPE, FITData, FITImporter
+from tracs.plugins.gpx import GPX_TYPE, GPXImporter, GPXTracks, read_gpx
 from tracs.plugins.json import JSON_TYPE, JSONHandler
 from tracs.plugins.polar import POLAR_EXERCISE_DATA_TYPE, POLAR_FLOW_TYPE, PolarExerciseDataActivity, PolarFlowExercise, PolarFlowImporter
 from tracs.plugins.strava import STRAVA_TYPE, StravaActivity, StravaHandler
-from tracs.plugins.tcx import Activity as TCXActivity, Author, Creator, Lap, Plan, TCX_TYPE, TCXImporter, Trackpoint, Training, TrainingCenterDatabase
+from tracs.plugins.tcx import Activity as TCXActivity, Author, Creator, Lap, Plan, read_tcx, TCX_TYPE, TCXImporter, Trackpoint, Training, TrainingCenterDatabase
 from tracs.plugins.waze import WAZE_TYPE, WazeActivity, WazeImporter
 from tracs.plugins.xml import XML_TYPE, XMLHandler
 from tracs.registry import Registry
+from tracs.resources import Resource
 
 @mark.file( 'templates/polar/2020.json' )
 def test_resource_handler( path ):
@@ -43,6 +57,25 @@ def test_resource_handler( path ):
 	with raises( ResourceNotFound ):
 		handler.load( fs=fs, path='some_non_existing_path' )
 
+def test_load_many( tmp_path ):
+	starttimes = [ datetime( 2024, 6, 1, 10 ) + timedelta( hours=h ) for h in range( 12 ) ]
+	for index, starttime in enumerate( starttimes ):
+		( tmp_path / f'{index}.gpx' ).write_text( synthetic_gpx( starttime, points=200 ) )
+	paths = [ tmp_path / f'{index}.gpx' for index in range( len( starttimes ) ) ] + [ tmp_path / 'missing.gpx' ]
+	fs = OSFS( str( tmp_path ) )
+
+	# a single handler is shared by all threads, results must not get mixed up
+	handler = GPXImporter()
+	with ThreadPoolExecutor( max_workers=4 ) as executor:
+		for resources in [ handler.load_many( paths ), handler.load_many( paths, executor=executor ), handler.load_many( [ p.name for p in paths ], fs=fs, executor=executor ) ]:
+			assert [ r.raw.tracks[0].segments[0].points[0].time.replace( tzinfo=None ) for r in resources[:-1] ] == starttimes
+			assert [ r.path for r in resources[:-1] ] == [ p.name for p in paths[:-1] ] and resources[-1] is None
+
+	with ProcessPoolExecutor( max_workers=2 ) as executor:
+		resources = handler.load_many( paths, executor=executor )
+		assert [ r.raw.tracks[0].segments[0].points[0].time.replace( tzinfo=None ) for r in resources[:-1] ] == starttimes
+		assert resources[-1] is None
+
 @mark.file( 'environments/default/takeouts/waze/2020-09/account_activity_3.csv' )
 def test_csv_handler( path ):
 	handler = CSVHandler()
@@ -52,6 +85,32 @@ def test_csv_handler( path ):
 	assert resource.type == CSV_TYPE
 	assert type( resource.raw ) is list and len( resource.raw ) == 38
 
+	# field size limit applies to the handler only, the limit of the csv module is not changed
+	handler.field_size_limit = 1000
+	with raises( CSVError ):
+		handler.load( path=path )
+	assert field_size_limit() == 131072 and len( CSVHandler().load( path=path ).raw ) == 38
+
+	# rows are read lazily, quoted fields may contain delimiters and line breaks
+	rows = handler.rows( b'a,"b,""c""",d\n\n"x\ny",z\r\n' )
+	assert next( rows ) == [ 'a', 'b,"c"', 'd' ] and list( rows ) == [ [], [ 'x\ny', 'z' ] ]
+
+	# quotes inside unquoted fields are taken literally and do not continue the record, same as with csv.reader()
+	content = 'home,my 12" screen,1\nwork,"desk, ""big""",2\r\nx"y,"a\nb",3\n\nlast,"",4'
+	assert list( handler.rows( content ) ) == list( reader( StringIO( content, newline='' ) ) )
+	assert list( handler.rows( content ) )[0] == [ 'home', 'my 12" screen', '1' ]
+
+	# fields beyond the process-wide limit of the csv module are read as long as the handler limit allows it
+	big = 'x' * 200000
+	content = f'a,"{big}\n""{big}""",b\r\nc,{big}\rd,"e""f"g\n'
+	handler.field_size_limit = 500000
+	assert list( handler.rows( content ) ) == [ [ 'a', f'{big}\n"{big}"', 'b' ], [ 'c', big ], [ 'd', 'e"fg' ] ]
+	assert field_size_limit() == 131072
+
+	handler.field_size_limit = 1000
+	with raises( CSVError ):
+		list( handler.rows( content ) )
+
 @mark.file( 'templates/polar/2020.json' )
 def test_json_importer( path ):
 	handler = JSONHandler()
@@ -74,7 +133,7 @@ def test_xml_importer( path ):
 	assert resource.raw.tag == '{http://www.topografix.com/GPX/1/1}gpx'
 
 @mark.file( 'templates/gpx/mapbox.gpx' )
-def test_gpx_importer( path ):
+def test_gpx_importer( path, monkeypatch ):
 	handler = GPXImporter()
 	assert handler.TYPE == GPX_TYPE
 
@@ -85,6 +144,12 @@ def test_gpx_importer( path ):
 	activity = handler.load_as_activity( path=path )
 	assert activity.starttime.isoformat() == '2012-10-24T23:29:40+00:00'
 
+	# loading from a path does not build the GPX object tree, raw is left for lazy loading
+	monkeypatch.setattr( 'tracs.plugins.gpx.parse_gpx', lambda *args, **kwargs: fail( 'parse_gpx must not be called' ) )
+	activity = handler.load_as_activity( path=path )
+	assert activity.starttime.isoformat() == '2012-10-24T23:29:40+00:00'
+	assert activity.resources[0].content and activity.resources[0].raw is None
+
 @mark.file( 'environments/default/takeouts/drivey/drive-20240913-182956.gpx' )
 def test_gpx_importer_empty( path ):
 	handler = GPXImporter()
@@ -95,8 +160,53 @@ def test_gpx_importer_empty( path ):
 	with raises( ResourceImportException ):
 		handler.load_as_activity( path=path )
 
+@mark.file( 'templates/gpx/mapbox.gpx' )
+def test_gpx_reader( path ):
+	content = path.read_bytes()
+	tracks, gpx = read_gpx( content ), parse_gpx( content )
+	assert len( tracks ) == 206 and tracks.segments == [0]
+	assert list( tracks.hr[:3] ) == [ 130, 134, 139 ] and tracks.ele[0] == 25.600000381469727
+
+	reference = GPXTracks.from_gpx( gpx )
+	assert ( tracks.time, tracks.lat, tracks.lon, tracks.ele ) == ( reference.time, reference.lat, reference.lon, reference.ele )
+	assert tracks.time_bounds() == ( gpx.get_time_bounds().start_time, gpx.get_time_bounds().end_time )
+	assert tracks.duration() == gpx.get_duration() and tracks.length_2d() == gpx.length_2d()
+
+	# activities are created without building a GPX object tree, resulting fields are the same
+	handler, resource = GPXImporter(), Resource( type=GPX_TYPE, content=content )
+	activity = handler.load_as_activity( resource=resource )
+	assert resource.raw is None and activity.resources[0] is resource
+	expected = handler.as_activity( Resource( type=GPX_TYPE, raw=gpx ) )
+	for f in [ 'uid', 'name', 'starttime', 'endtime', 'starttime_local', 'duration', 'distance', 'location_latitude_start', 'location_longitude_end' ]:
+		assert getattr( activity, f ) == getattr( expected, f )
+
+def test_reader_times( monkeypatch ):
+	# times ending with Z are read via fromisoformat() on all supported Python versions, without falling back to slower parsers
+	monkeypatch.setattr( 'tracs.plugins.gpx.parse_time', lambda *args, **kwargs: fail( 'parse_time must not be called' ) )
+	monkeypatch.setattr( 'tracs.plugins.tcx.parse_dt', lambda *args, **kwargs: fail( 'parse_dt must not be called' ) )
+	start = datetime( 2024, 6, 1, 10 )
+	assert read_gpx( synthetic_gpx( start, points=10 ) ).time_bounds()[0] == start.replace( tzinfo=UTC )
+	assert read_tcx( synthetic_tcx( start, points=10 ) ).time == start.replace( tzinfo=UTC )
+
+def test_gpx_reader_segments():
+	content = synthetic_gpx( datetime( 2024, 6, 1, 10 ), points=20 ).replace( '</trkpt><trkpt', '</trkpt></trkseg><trkseg><trkpt', 1 )
+	content = content.replace( '<trk>', '<metadata><name>document</name></metadata><trk><name>track</name>' )
+	tracks, gpx = read_gpx( content ), parse_gpx( content )
+	assert tracks.segments == [ 0, 1 ] and len( tracks ) == 20 and tracks.name == gpx.name == 'document'
+	assert tracks.duration() == gpx.get_duration() == 18
+	assert tracks.length_2d() == gpx.length_2d()
+
+@skip_benchmark
+def test_benchmark_gpx_reader():
+	content, handler = synthetic_gpx( datetime( 2024, 6, 1, 10 ), points=50000 ).encode( 'UTF-8' ), GPXImporter()
+	start = perf_counter()
+	handler.as_activity( Resource( type=GPX_TYPE, raw=handler.load_raw( content ) ) )
+	middle = perf_counter()
+	handler.load_as_activity( resource=Resource( type=GPX_TYPE, content=content ) )
+	print( f'created activity from gpx with 50000 points in {middle - start:.2f}s (gpxpy) / {perf_counter() - middle:.2f}s (iterparse)' )
+
 @mark.file( 'templates/tcx/sample.tcx' )
-def test_tcx_importer( path ):
+def test_tcx_importer( path, monkeypatch ):
 	handler = TCXImporter()
 	assert handler.TYPE == TCX_TYPE
 
@@ -107,6 +217,88 @@ def test_tcx_importer( path ):
 	activity = handler.load_as_activity( path=path )
 	assert activity.starttime.isoformat() == '2010-06-26T10:06:11+00:00'
 
+	# loading from a path does not build the object tree, raw and data are left for lazy loading
+	monkeypatch.setattr( 'tracs.plugins.tcx.fromstring', lambda *args, **kwargs: fail( 'fromstring must not be called' ) )
+	monkeypatch.setattr( TrainingCenterDatabase, 'from_xml', lambda *args, **kwargs: fail( 'from_xml must not be called' ) )
+	activity = handler.load_as_activity( path=path )
+	assert activity.starttime.isoformat() == '2010-06-26T10:06:11+00:00'
+	assert activity.resources[0].content and activity.resources[0].raw is None and activity.resources[0].data is None
+
+@mark.file( 'templates/tcx/sample.tcx' )
+def test_tcx_reader( path ):
+	tcx = read_tcx( path.read_bytes() )
+	assert len( tcx.laps ) == 1 and tcx.trackpoints == 7
+	lap = tcx.laps[0]
+	assert lap.start_time == '2010-06-26T10:06:11Z' and lap.distance_meters == 9762.4433594 and lap.calories == 493
+	assert lap.lat[0] == 40.7780135 and list( lap.hr[:3] ) == [ 148, 148, 152 ] and lap.cadence[6] == 42
+	assert tcx.time.isoformat() == '2010-06-26T10:06:11+00:00' and tcx.time_end.isoformat() == '2010-06-26T10:06:30+00:00'
+
+	# activities are created without building an object tree, resulting fields are the same
+	handler, resource = TCXImporter(), Resource( type=TCX_TYPE, content=path.read_bytes() )
+	activity = handler.load_as_activity( resource=resource )
+	assert resource.raw is None and resource.data is None
+	expected = handler.as_activity( Resource( type=TCX_TYPE, data=handler.load( path=path ).data ) )
+	for f in [ 'uid', 'starttime', 'endtime', 'starttime_local', 'duration', 'distance' ]:
+		assert getattr( activity, f ) == getattr( expected, f )
+
+	# multiple laps
+	tcx = read_tcx( synthetic_tcx( datetime( 2024, 6, 1, 10 ), points=100, laps=4 ) )
+	assert [ len( l ) for l in tcx.laps ] == [ 25 ] * 4 and tcx.laps[1].start_time == '2024-06-01T10:00:25.000Z'
+	assert tcx.time_end - tcx.time == timedelta( seconds=99 )
+
+@skip_benchmark
+def test_benchmark_tcx_reader():
+	content, handler = synthetic_tcx( datetime( 2024, 6, 1, 10 ), points=50000, laps=50 ).encode( 'UTF-8' ), TCXImporter()
+	start = perf_counter()
+	handler.as_activity( Resource( type=TCX_TYPE, data=handler.load( content=content ).data ) )
+	middle = perf_counter()
+	handler.load_as_activity( resource=Resource( type=TCX_TYPE, content=content ) )
+	print( f'created activity from tcx with 50 laps and 50000 points in {middle - start:.2f}s (objectify) / {perf_counter() - middle:.2f}s (iterparse)' )
+
+def test_fit_decoder():
+	starttime = datetime( 2024, 6, 1, 10, tzinfo=UTC )
+	fit = decode_fit( synthetic_fit( starttime, points=100 ) )
+	assert len( fit ) == 100 and fit.time[0] == starttime.timestamp() and fit.time[99] - fit.time[0] == 99
+	assert round( fit.lat[0], 6 ) == 51.0 and round( fit.lon[0], 6 ) == 13.0 and list( fit.alt[:2] ) == [ 100, 101 ]
+	assert fit.hr[0] == 120 and isnan( fit.hr[1] ) and fit.distance[99] == 297 and fit.speed[0] == 3 and isnan( fit.power[0] )
+	assert fit.file_id['time_created'] == starttime and len( fit.laps ) == 1 and len( fit.sessions ) == 1
+
+	# compressed timestamps, developer fields, big endian architecture and multiple laps result in the same records
+	for kwargs in [ dict( compressed=True, developer=True ), dict( compressed=True, big_endian=True, laps=4 ) ]:
+		other = decode_fit( synthetic_fit( starttime, points=100, **kwargs ) )
+		assert other.time == fit.time and other.lat == fit.lat and other.distance == fit.distance
+	assert list( decode_fit( synthetic_fit( starttime, points=100, developer=True ) ).developer['stride'][:3] ) == [ 80, 81, 82 ]
+	assert [ l['start_time'] for l in other.laps ] == [ starttime + timedelta( seconds=s ) for s in [ 0, 25, 50, 75 ] ]
+
+	# activity is created from session and records
+	activity = FITImporter().load_as_activity( resource=Resource( type=FIT_TYPE, content=synthetic_fit( starttime, points=100, laps=4 ) ) )
+	assert activity.uid.uid == 'fit:240601100000' and activity.type == ActivityTypes.run
+	assert activity.starttime == starttime and activity.endtime == starttime + timedelta( seconds=99 ) and activity.duration == timedelta( seconds=99 )
+	assert activity.distance == 297 and activity.calories == 40 and activity.heartrate == 139 and activity.heartrate_max == 159 and activity.speed == 3
+	assert activity.elevation_min == 100 and activity.elevation_max == 149 and round( activity.location_latitude_end, 4 ) == 51.0027
+
+	# sport 43 is windsurfing, yoga is a sub sport of training
+	for sport, sub_sport, expected in [ ( 43, None, ActivityTypes.surf_wind ), ( 10, 43, ActivityTypes.yoga ), ( 10, 0, ActivityTypes.gym ) ]:
+		fit = FITData( sessions=[ { 'start_time': starttime, 'sport': sport, 'sub_sport': sub_sport } ] )
+		assert FITImporter().as_activity( Resource( type=FIT_TYPE, raw=fit ) ).type == expected
+
+	# session without elapsed time and without timed records
+	activity = FITImporter().as_activity( Resource( type=FIT_TYPE, raw=FITData( sessions=[ { 'start_time': starttime } ] ) ) )
+	assert activity.starttime == activity.endtime == starttime and activity.duration == timedelta( 0 )
+
+	with raises( ValueError ):
+		decode_fit( b'not a fit file' )
+	with raises( ValueError ):
+		decode_fit( synthetic_fit( starttime, points=100 )[:-200] )
+
+@skip_benchmark
+def test_benchmark_fit_decoder():
+	content, handler = synthetic_fit( datetime( 2024, 6, 1, 10, tzinfo=UTC ), points=4 * 3600, laps=4, compressed=True ), FITImporter()
+	start = perf_counter()
+	activity = handler.load_as_activity( resource=Resource( type=FIT_TYPE, content=content ) )
+	print( f'created activity from fit with 4 laps and {4 * 3600} records in {( perf_counter() - start ) * 1000:.1f}ms' )
+	assert activity.duration == timedelta( seconds=4 * 3600 - 1 )
+
 @mark.skip
 def test_tcx_export():
 	tcx = TrainingCenterDatabase(
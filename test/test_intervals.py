@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+from attrs import define
+
+from tracs.activity import Activity
+from tracs.group import group_activities2
+from tracs.intervals import IntervalIndex
+
+@define
+class Item:
+
+	name: str
+	starttime: datetime
+	endtime: datetime = None
+
+def dt( hour: int, minute: int = 0 ) -> datetime:
+	return datetime( 2024, 6, 1, hour, minute )
+
+def test_clusters():
+	a, b, c = Item( 'a', dt( 10 ), dt( 11 ) ), Item( 'b', dt( 10, 30 ), dt( 12 ) ), Item( 'c', dt( 12, 5 ), dt( 13 ) )
+	d, e = Item( 'd', dt( 15 ) ), Item( 'e', dt( 15 ) )
+
+	index = IntervalIndex( [ e, c, a, d, b ] )
+	assert [ [ i.name for i in cl ] for cl in index.clusters() ] == [ ['a', 'b'], ['c'], ['e', 'd'] ]
+	assert [ [ i.name for i in cl ] for cl in index.clusters( gap=timedelta( minutes=5 ) ) ] == [ ['a', 'b', 'c'], ['e', 'd'] ]
+
+def test_clusters_large():
+	start = datetime( 2000, 1, 1 )
+	items = [ Item( str( i ), start + timedelta( hours=i // 2 * 3 ), start + timedelta( hours=i // 2 * 3 + 1 ) ) for i in range( 100_000 ) ]
+	clusters = IntervalIndex( reversed( items ) ).clusters()
+	assert len( clusters ) == 50_000 and all( len( c ) == 2 for c in clusters )
+
+def test_group_activities():
+	a1 = Activity( name='a1', starttime=dt( 10 ), endtime=dt( 11 ), uid='a:1' )
+	a2 = Activity( name='a2', starttime=dt( 10, 1 ), endtime=dt( 11, 1 ), uid='b:1' )
+	a3 = Activity( name='a3', starttime=dt( 11, 30 ), endtime=dt( 12 ), uid='a:2' ) # no overlap
+	a4 = Activity( name='a4', starttime=dt( 14 ), uid='a:3' ) # no end time
+	a5 = Activity( name='a5', starttime=dt( 14, 2 ), uid='b:3' )
+
+	groups = group_activities2( [ a5, a3, a1, a4, a2 ] )
+	assert [ g.members for g in groups ] == [ [a1, a2], [a4, a5] ]
+	assert groups[0].time == a1.starttime
+
+	groups = group_activities2( [ a5, a3, a1, a4, a2 ], gap=timedelta( minutes=30 ) )
+	assert [ g.members for g in groups ] == [ [a1, a2, a3], [a4, a5] ]
@@ -3,9 +3,11 @@ from __future__ import annotations
 
 from io import UnsupportedOperation
 from logging import getLogger
+from time import perf_counter
 
 from pytest import mark, raises
 
+from helpers import skip_benchmark, write_synthetic_gpx
 from tracs.aio import import_activities
 from tracs.plugins.local import Local
 
@@ -67,3 +69,66 @@ def test_unified_import( service ):
 def test_unified_import_fail( service ):
 	with raises( UnsupportedOperation ):
 		activities, fs = service.unified_import( service.ctx, classifier='drivey', location='something_that_does_not_exist' )
+
+# noinspection PyUnresolvedReferences
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Local, init=True, register=True )
+def test_batched_import( service, tmp_path ):
+	write_synthetic_gpx( tmp_path, 50 )
+
+	commits = []
+	commit = service.ctx.db.commit
+	service.ctx.db.commit = lambda *args, **kwargs: commits.append( len( service.ctx.db.activities ) ) or commit( *args, **kwargs )
+
+	service._import_activities( ctx=service.ctx, classifier='local', location=str( tmp_path ), commit_every=20 )
+	assert commits == [ 20, 40, 50 ]
+	assert len( service.ctx.db.activities ) == 50
+	assert service.ctx.db.activity_keys == list( range( 1, 51 ) )
+
+	# second import updates nothing
+	service._import_activities( ctx=service.ctx, classifier='local', location=str( tmp_path ), commit_every=20 )
+	assert len( service.ctx.db.activities ) == 50
+
+# noinspection PyUnresolvedReferences
+@skip_benchmark
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Local, init=True, register=True )
+def test_benchmark_local_import( service, tmp_path ):
+	write_synthetic_gpx( tmp_path, 5000 )
+
+	for commit_every in [ 1, 0 ]:
+		service.ctx.db._activities.clear()
+		start = perf_counter()
+		service._import_activities( ctx=service.ctx, classifier='local', location=str( tmp_path ), force=True, commit_every=commit_every )
+		print( f'imported 5000 GPX files with commit_every={commit_every} in {perf_counter() - start:.1f}s' )
+		assert len( service.ctx.db.activities ) == 5000
+
+# noinspection PyUnresolvedReferences
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Local, init=True, register=True )
+def test_parallel_import( service, tmp_path ):
+	write_synthetic_gpx( tmp_path, 20 )
+	tmp_path.joinpath( '00005.gpx' ).write_text( 'not a gpx file' )
+
+	activities, fs = service.unified_import( service.ctx, classifier='local', location=str( tmp_path ), workers=4, processes=2 )
+	assert len( activities ) == 19
+	assert activities == sorted( activities, key=lambda a: a.starttime ) # order of paths is kept
+	assert all( fs.exists( a.resources[0].path ) for a in activities )
+	assert service.metrics['parse'].processed == 20 and service.metrics['parse'].dropped == 1
+
+# noinspection PyUnresolvedReferences
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Local, init=True, register=True )
+def test_import_identical_content( service, tmp_path ):
+	write_synthetic_gpx( tmp_path, 5 )
+	service._import_activities( ctx=service.ctx, classifier='local', location=str( tmp_path ) )
+	assert all( a.resources[0].digest for a in service.ctx.db.activities )
+
+	# identical content is skipped before parsing, even from a different location
+	write_synthetic_gpx( tmp_path / 'copy', 5 )
+	activities, fs = service.unified_import( service.ctx, classifier='local', location=str( tmp_path / 'copy' ) )
+	assert activities == []
+	assert service.metrics['read'].dropped == 5 and service.metrics['parse'].processed == 0
+
+	activities, fs = service.unified_import( service.ctx, classifier='local', location=str( tmp_path / 'copy' ), force=True )
+	assert len( activities ) == 5
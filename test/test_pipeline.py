@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from random import random
+from threading import current_thread, Lock
+from time import perf_counter, sleep
+from typing import List
+
+from pytest import mark, raises
+
+from test.mock import Mock, MOCK_TYPE
+from tracs.aio import import_activities
+from tracs.pipeline import Coordinator, Pipeline, Stage
+from tracs.resources import Resource
+from tracs.service import parse_activity
+
+def test_pipeline():
+	def slow_square( x: int ) -> int:
+		sleep( random() / 100 )
+		return x * x
+
+	def drop_odd( x: int ):
+		return x if x % 2 == 0 else None
+
+	results = []
+	pipeline = Pipeline( Stage( 'square', slow_square, workers=4 ), Stage( 'even', drop_odd, workers=2 ), queue_size=2 )
+	metrics = pipeline.run( range( 20 ), results.append )
+
+	# results arrive in order, although stages run with several workers
+	assert results == [ x * x for x in range( 0, 20, 2 ) ]
+
+	assert metrics['square'].processed == 20 and metrics['square'].dropped == 0
+	assert metrics['even'].processed == 20 and metrics['even'].dropped == 10
+	assert metrics['sink'].processed == 10
+	assert 0 < metrics['square'].max_queue_depth <= 2
+	assert metrics['square'].throughput > 0
+
+def test_pipeline_errors():
+	def fail_on_three( x: int ) -> int:
+		if x == 3:
+			raise ValueError
+		return x
+
+	results = []
+	metrics = Pipeline( Stage( 'fail', fail_on_three ) ).run( range( 5 ), results.append )
+	assert results == [0, 1, 2, 4]
+	assert metrics['fail'].errors == 1 and metrics['fail'].dropped == 1
+
+	# empty input
+	assert Pipeline( Stage( 'fail', fail_on_three, workers=3 ) ).run( [], results.append )['fail'].processed == 0
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_import_pipeline( service: Mock ):
+	service.import_activities( skip_link=True, amount=10, workers=4, queue_size=2 )
+
+	# ids are assigned in a deterministic order, regardless of the number of workers
+	assert [ ( a.id, a.uid.local_id ) for a in service.ctx.db.activities ] == [ ( i, 1011 - i ) for i in range( 1, 11 ) ]
+	assert service.metrics['download'].processed == 10 and service.metrics['sink'].processed == 10
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_import_pipeline_processes( service: Mock, monkeypatch ):
+	in_flight, peak, lock = [ 0 ], [ 0 ], Lock()
+
+	def slow_parse( handler_cls, resource ):
+		with lock:
+			in_flight[0] += 1
+			peak[0] = max( peak[0], in_flight[0] )
+		sleep( 0.05 )
+		with lock:
+			in_flight[0] -= 1
+		return parse_activity( handler_cls, resource )
+
+	# threads stand in for processes, parsing is the same
+	monkeypatch.setattr( 'tracs.service.ProcessPoolExecutor', lambda max_workers, **kwargs: ThreadPoolExecutor( max_workers=max_workers ) )
+	monkeypatch.setattr( 'tracs.service.parse_activity', slow_parse )
+	service.import_activities( skip_link=True, amount=8, workers=4, processes=4 )
+
+	# several parses are in flight at the same time, ids are still assigned in order
+	assert peak[0] > 1 and service.metrics['parse'].processed == 8
+	assert [ ( a.id, a.uid.local_id ) for a in service.ctx.db.activities ] == [ ( i, 1009 - i ) for i in range( 1, 9 ) ]
+
+def test_coordinator():
+	coordinator, calls = Coordinator(), []
+
+	def record( x: int ) -> int:
+		calls.append( ( x, current_thread() ) )
+		return x * x
+
+	def fail():
+		raise ValueError
+
+	def job( x: int ) -> int:
+		sleep( random() / 100 )
+		return coordinator.submit( record, x )
+
+	with ThreadPoolExecutor( max_workers=4 ) as executor:
+		futures = [ executor.submit( job, x ) for x in range( 8 ) ]
+		failing = executor.submit( coordinator.submit, fail )
+		coordinator.run( [ *futures, failing ] )
+
+	# all calls have been carried out by the coordinator thread, errors are raised in the submitting thread
+	assert [ f.result() for f in futures ] == [ x * x for x in range( 8 ) ]
+	assert all( t is current_thread() for _, t in calls )
+	with raises( ValueError ):
+		failing.result()
+
+	# after the loop has finished calls are carried out right away
+	assert coordinator.submit( record, 10 ) == 100
+
+class SlowMock( Mock ):
+
+	def fetch( self, force: bool, pretend: bool, **kwargs ) -> List[Resource]:
+		sleep( 0.3 )
+		return [
+			Resource( uid=f'{self.name}:{i}/{i}.json', path=f'{self.name}/{i}/{i}.json', type=MOCK_TYPE, text=f'{self.name}:{i} content' )
+			for i in range( 1001, 1000 + kwargs.get( 'amount', 1 ) + 1 )
+		]
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_import_parallel( service: Mock ):
+	ctx, writers = service.ctx, set()
+	for name in [ 'mocka', 'mockb', 'mockc' ]:
+		ctx.registry.services[name] = SlowMock( ctx=ctx, name=name, display_name=name )
+
+	upsert_activities = ctx.db.upsert_activities
+	def upsert( activities ):
+		writers.add( current_thread() )
+		return upsert_activities( activities )
+	ctx.db.upsert_activities = upsert
+
+	start = perf_counter()
+	import_activities( ctx, [ 'mocka', 'mockb', 'mockc' ], skip_link=True, amount=5 )
+
+	# services are fetched at the same time, the import takes about as long as the slowest service
+	assert perf_counter() - start < 0.8
+	assert sorted( a.uid.classifier for a in ctx.db.activities ) == [ 'mocka' ] * 5 + [ 'mockb' ] * 5 + [ 'mockc' ] * 5
+	assert writers == { current_thread() }
+
+	# services continue to work with the original context
+	assert all( ctx.registry.services[name].ctx is ctx for name in [ 'mocka', 'mockb', 'mockc' ] )
@@ -1,15 +1,27 @@
 
 from datetime import datetime, timedelta
 from datetime import timezone
+from io import BytesIO
+from json import dumps, loads
+from math import isnan
+from time import perf_counter
+from types import SimpleNamespace
+from typing import List, Tuple
+from zipfile import ZIP_DEFLATED, ZipFile
 
 from dateutil.tz import tzlocal, UTC
 from pytest import mark
 
-from test.helpers import skip_live
+from test.helpers import skip_benchmark, skip_live, synthetic_gpx, synthetic_tcx
+from tracs.activity import Activity
 from tracs.activity_types import ActivityTypes
-from tracs.plugins.polar import BASE_URL, PolarFitnessTestImporter, PolarOrthostaticTestImporter, PolarRRRecordingImporter
+from tracs.plugins.polar import BASE_URL, PolarCsvImporter, PolarFitnessTestImporter, PolarHrvImporter, PolarOrthostaticTestImporter, PolarRRRecordingImporter
 from tracs.plugins.polar import Polar, PolarFlowExercise
-from tracs.plugins.polar import PolarFlowImporter
+from tracs.plugins.polar import decompress_resources, POLAR_FLOW_TYPE, POLAR_ZIP_GPX_TYPE, POLAR_ZIP_TCX_TYPE, PolarFlowImporter
+from tracs.plugins.gpx import GPX_TYPE
+from tracs.plugins.tcx import TCX_TYPE
+from tracs.resources import Resource
+from tracs.service import Service
 from tracs.utils import FsPath
 
 importer = PolarFlowImporter()
@@ -51,6 +63,16 @@ def test_rrrecording( fspath: FsPath ):
 	assert test.uid == 'polar:100014'
 	assert test.starttime == datetime( 2017, 1, 16, 20, 34, 58, tzinfo=UTC )
 
+@mark.file( 'environments/default/db/polar/2/0/0/200001/200001.csv' )
+def test_csv_exercise( path ):
+	exercise = PolarCsvImporter().load( path=path ).data
+	assert exercise.summary['Sport'] == 'STRENGTH_TRAINING' and exercise.summary['Start time'] == '12:14:13'
+	assert len( exercise ) == 2469 and exercise.sample_rate == 1 and exercise.time[-1] == 2468
+	assert list( exercise.hr[:3] ) == [ 125, 125, 125 ] and exercise.temperature[1] == 29.9 and isnan( exercise.speed[0] )
+
+	hrv = PolarHrvImporter().load( path=path.with_suffix( '.hrv.csv' ) ).data
+	assert len( hrv ) == 5246 and list( hrv.rr[:3] ) == [ 2004, 498, 497 ] and not any( hrv.offline )
+
 @mark.context( env='live', persist='clone', cleanup=False )
 @mark.service( cls=Polar, init=True, register=True )
 def test_constructor( service: Polar ):
@@ -69,3 +91,64 @@ def test_live_workflow( service ):
 
 	fetched = service.fetch( force=False, pretend=False )
 	assert len( fetched ) > 0
+
+def multipart_resources( parts: int, points: int = 10 ) -> Tuple[Resource, List[Resource]]:
+	start = datetime( 2020, 6, 1, 8, 0, 0 )
+	summary = Resource( uid='polar:1001', path='1001.json', type=POLAR_FLOW_TYPE )
+	zipped = []
+	for type, suffix, fn in [ ( POLAR_ZIP_GPX_TYPE, 'gpx', synthetic_gpx ), ( POLAR_ZIP_TCX_TYPE, 'tcx', synthetic_tcx ) ]:
+		buffer = BytesIO()
+		with ZipFile( buffer, 'w', compression=ZIP_DEFLATED ) as zip_file:
+			for i in range( parts ):
+				zip_file.writestr( f'1001_{i}.{suffix}', fn( start + timedelta( hours=i * 2 ), points ) )
+		zipped.append( Resource( uid='polar:1001', path=f'1001.{suffix}.zip', type=type, content=buffer.getvalue() ) )
+	return summary, zipped
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Polar, init=True, register=True )
+def test_multipart( service: Polar, monkeypatch ):
+	summary, zipped = multipart_resources( 10 )
+	recordings = [ r for z in zipped for r in decompress_resources( z ) ]
+	assert len( recordings ) == 20
+	assert [ r.type for r in recordings ] == [ GPX_TYPE ] * 10 + [ TCX_TYPE ] * 10
+	assert all( r.raw is None for r in recordings ) # nothing is parsed during extraction
+
+	parsed = []
+	as_activity_from = Service.as_activity_from
+	monkeypatch.setattr( Service, 'as_activity_from', lambda resource, **kwargs: parsed.append( resource.path ) or as_activity_from( resource, **kwargs ) )
+
+	activity = Activity( uid='polar:1001' )
+	activities = service.postprocess_activities( [ activity ], [ summary, *zipped, *recordings ] )
+	assert len( activities ) == 11 and len( activity.parts ) == 10
+	assert sorted( parsed ) == sorted( r.path for r in recordings ) # each member is parsed exactly once
+	assert [ a.uid for a in activities[1:] ] == [ f'polar:1001#{i}' for i in range( 1, 11 ) ]
+	assert all( any( r.type == TCX_TYPE for r in a.resources ) for a in activities[1:] ) # tcx is preferred
+
+@skip_benchmark
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Polar, init=True, register=True )
+def test_benchmark_multipart( service: Polar ):
+	summary, zipped = multipart_resources( 10, points=3600 )
+	start = perf_counter()
+	recordings = [ r for z in zipped for r in decompress_resources( z ) ]
+	activities = service.postprocess_activities( [ Activity( uid='polar:1001' ) ], [ summary, *zipped, *recordings ] )
+	print( f'extracted and parsed 10-part multisport activity ({sum( len( z.content ) for z in zipped )} bytes zipped) in {perf_counter() - start:.2f}s' )
+	assert len( activities ) == 11
+
+@mark.context( env='default', persist='mem', cleanup=True )
+@mark.service( cls=Polar, init=True, register=True )
+def test_fetch_windows( service: Polar, monkeypatch ):
+	template = loads( service.dbfs.readbytes( 'polar/1/0/0/100001/100001.json' ) )
+	requested = []
+
+	def get( url, **kwargs ):
+		requested.append( url.split( '?' )[1] )
+		year = int( url.split( '&end=' )[1][-4:] )
+		ids = [ year * 10 + i for i in range( 3 ) ] + ( [ 20190 ] if year == 2020 else [] ) # one duplicate
+		return SimpleNamespace( content=dumps( [ { **template, 'listItemId': i } for i in ids ] ) )
+
+	monkeypatch.setattr( service, '_session', SimpleNamespace( get=get, policy=SimpleNamespace( expire_after=lambda: None ) ) )
+
+	fetched = service.fetch( False, False, workers=3, range_from=datetime( 2019, 3, 1, tzinfo=UTC ), range_to=datetime( 2021, 5, 1, tzinfo=UTC ) )
+	assert sorted( requested ) == [ 'start=01.01.2020&end=31.12.2020', 'start=01.01.2021&end=01.05.2021', 'start=01.03.2019&end=31.12.2019' ]
+	assert [ r.local_id for r in fetched ] == [ 20190, 20191, 20192, 20200, 20201, 20202, 20210, 20211, 20212 ]
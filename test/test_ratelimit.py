@@ -0,0 +1,132 @@
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+from dateutil.tz import UTC
+from pytest import fixture, raises
+
+from tracs.ratelimit import parse_rate_headers, PERIOD_DAY, RateLimitedSession, RateLimiter, RateLimitExceeded, RateWindow
+
+class RateLimitHandler( BaseHTTPRequestHandler ):
+	"""
+	Stand-in for the Strava API: counts requests and reports usage/limits like Strava does.
+	"""
+
+	limits = ( 5, 8 )
+	usage = [ 0, 0 ]
+
+	def do_GET( self ):
+		RateLimitHandler.usage = [ u + 1 for u in RateLimitHandler.usage ]
+		exceeded = any( u > l for u, l in zip( RateLimitHandler.usage, RateLimitHandler.limits ) )
+		self.send_response( 429 if exceeded else 200 )
+		self.send_header( 'X-RateLimit-Limit', ','.join( str( l ) for l in RateLimitHandler.limits ) )
+		self.send_header( 'X-RateLimit-Usage', ','.join( str( u ) for u in RateLimitHandler.usage ) )
+		self.send_header( 'Content-Length', '0' )
+		self.end_headers()
+
+	def log_message( self, format, *args ):
+		pass
+
+@fixture
+def server() -> str:
+	RateLimitHandler.usage = [ 0, 0 ]
+	httpd = ThreadingHTTPServer( ( '127.0.0.1', 0 ), RateLimitHandler )
+	Thread( target=httpd.serve_forever, daemon=True ).start()
+	yield f'http://127.0.0.1:{httpd.server_address[1]}'
+	httpd.shutdown()
+
+class Clock:
+
+	def __init__( self, now: datetime ):
+		self.now = now
+		self.sleeps = []
+
+	def __call__( self ) -> datetime:
+		return self.now
+
+	def sleep( self, seconds: float ) -> None:
+		self.sleeps.append( seconds )
+		self.now += timedelta( seconds=seconds )
+
+def limiter( clock: Clock, **kwargs ) -> RateLimiter:
+	return RateLimiter(
+		RateWindow( name='short', limit=100 ),
+		RateWindow( name='daily', limit=1000, period=PERIOD_DAY ),
+		clock=clock, sleeper=clock.sleep, **kwargs
+	)
+
+def test_window():
+	window = RateWindow( name='short', limit=10 )
+	window.refresh( datetime( 2024, 6, 1, 10, 7, 12, tzinfo=UTC ) )
+	assert window.reset == datetime( 2024, 6, 1, 10, 15, tzinfo=UTC ) and window.remaining() == 10
+
+	window.usage = 8
+	assert window.remaining() == 2 and window.remaining( reserve=2 ) == 0
+	window.refresh( datetime( 2024, 6, 1, 10, 15, tzinfo=UTC ) )
+	assert window.usage == 0 and window.reset == datetime( 2024, 6, 1, 10, 30, tzinfo=UTC )
+
+	daily = RateWindow( name='daily', period=PERIOD_DAY )
+	assert daily.next_reset( datetime( 2024, 6, 1, 23, 59, tzinfo=UTC ) ) == datetime( 2024, 6, 2, tzinfo=UTC )
+
+def test_parse_headers():
+	assert parse_rate_headers( {} ) is None
+	assert parse_rate_headers( { 'X-RateLimit-Usage': '3,30', 'X-RateLimit-Limit': '200,2000' } ) == ( [3, 30], [200, 2000] )
+	headers = { 'X-RateLimit-Usage': '3,30', 'X-RateLimit-Limit': '200,2000', 'X-ReadRateLimit-Usage': '2,20', 'X-ReadRateLimit-Limit': '100,1000' }
+	assert parse_rate_headers( headers ) == ( [2, 20], [100, 1000] )
+
+def test_limiter_pauses():
+	clock = Clock( datetime( 2024, 6, 1, 10, 14, tzinfo=UTC ) )
+	rl = limiter( clock )
+
+	# server reports that 98 out of 100 requests are used up: two more requests are possible in this window
+	rl.acquire()
+	rl.update( { 'X-RateLimit-Usage': '98,500', 'X-RateLimit-Limit': '100,1000' } )
+	rl.acquire()
+	rl.acquire()
+	assert clock.sleeps == []
+	rl.acquire()
+	assert clock.sleeps == [ 60.0 ] and rl.windows[0].usage == 1 and rl.windows[1].usage == 503
+
+	# daily budget is exhausted, pausing for the rest of the day takes too long
+	rl.update( { 'X-RateLimit-Usage': '1,1000', 'X-RateLimit-Limit': '100,1000' } )
+	with raises( RateLimitExceeded ) as exc:
+		rl.acquire()
+	assert exc.value.reset == datetime( 2024, 6, 2, tzinfo=UTC ) and clock.sleeps == [ 60.0 ]
+
+def test_limiter_state():
+	clock, states = Clock( datetime( 2024, 6, 1, 10, 14, tzinfo=UTC ) ), []
+	rl = limiter( clock, on_update=states.append )
+	rl.update( { 'X-RateLimit-Usage': '10,1000', 'X-RateLimit-Limit': '100,1000' } )
+	assert states[-1] == {
+		'short': { 'limit': 100, 'usage': 10, 'reset': '2024-06-01T10:15:00+00:00' },
+		'daily': { 'limit': 1000, 'usage': 1000, 'reset': '2024-06-02T00:00:00+00:00' },
+	}
+
+	# a new run continues with the persisted budget and stops before issuing a request
+	with raises( RateLimitExceeded ):
+		limiter( clock, state=states[-1] ).acquire()
+
+	# budget is refilled on the next day
+	clock.now = datetime( 2024, 6, 2, 0, 1, tzinfo=UTC )
+	limiter( clock, state=states[-1] ).acquire()
+
+def test_session( server ):
+	clock = Clock( datetime( 2024, 6, 1, 10, 0, tzinfo=UTC ) )
+	rl = limiter( clock, max_wait=900 )
+	session = RateLimitedSession( rl )
+
+	# limits are taken from the server: 5 requests per window, 8 per day
+	responses = [ session.get( f'{server}/activities/{i}' ).status_code for i in range( 5 ) ]
+	assert responses == [ 200 ] * 5 and rl.windows[0].limit == 5 and clock.sleeps == []
+
+	# next request waits for the next window, the server is not asked before
+	RateLimitHandler.usage[0] = 0 # server starts a new window as well
+	assert session.get( f'{server}/activities/5' ).status_code == 200
+	assert clock.sleeps == [ 900.0 ] and RateLimitHandler.usage == [ 1, 6 ]
+
+	# daily limit is exhausted after 8 requests, the session stops without tripping the limit
+	session.get( f'{server}/activities/6' )
+	session.get( f'{server}/activities/7' )
+	with raises( RateLimitExceeded ):
+		session.get( f'{server}/activities/8' )
+	assert RateLimitHandler.usage == [ 3, 8 ]
@@ -1,11 +1,19 @@
 
+import tracemalloc
+from datetime import datetime, timedelta
 from pathlib import Path
+from time import perf_counter
 
+from dateutil.tz import UTC
 from pytest import mark, raises
 
+from test.helpers import skip_benchmark, synthetic_gpx
 from test.mock import Mock
-from tracs.resources import Resource
-from tracs.service import Service
+from tracs.journal import ImportJournal
+from tracs.plugins.gpx import GPX_TYPE
+from tracs.ratelimit import RateLimitExceeded
+from tracs.resources import content_digest, Resource
+from tracs.service import DOWNLOAD_CHUNK_SIZE, Service
 
 def test_constructor():
 	mock = Mock()
@@ -110,7 +118,7 @@ def test_fetch( service: Mock ):
 	service.import_activities( skip_download=True, skip_link=True )
 	assert mfs.getmodified( '1/0/0/1001/1001.json' ) == mtime
 	service.import_activities( force=True, skip_download=True, skip_link=True )
-	assert mfs.getmodified( '1/0/0/1001/1001.json' ) > mtime
+	assert mfs.getmodified( '1/0/0/1001/1001.json' ) == mtime # content is identical, file is not written again
 
 	# test pretend flag
 	mtime = mfs.getmodified( '1/0/0/1001/1001.json' )
@@ -141,3 +149,187 @@ def test_filter_fetched( service ):
 	assert service.filter_fetched( resources, 'polar:10', 'polar:20' ) == [resources[0], resources[1]]
 	assert service.filter_fetched( resources, *[r.uid for r in resources] ) == resources
 	assert service.filter_fetched( resources ) == []
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_last_fetch( service: Mock ):
+	ranges = []
+	fetch = service.fetch
+	service.fetch = lambda force, pretend, **kwargs: ranges.append( kwargs.get( 'range_from' ) ) or fetch( force, pretend, **kwargs )
+
+	assert service.last_fetch is None
+	service.import_activities( skip_download=True, skip_link=True, days_range=90, overlap=3 )
+	assert ranges[-1] < datetime.now( UTC ) - timedelta( days=89 )
+	last_fetch = service.last_fetch
+	assert last_fetch > datetime.now( UTC ) - timedelta( minutes=1 )
+	assert service.ctx.state.plugins.mock.last_fetch == last_fetch.isoformat()
+
+	# next import starts at the watermark minus overlap, unless all activities are requested
+	service.import_activities( skip_download=True, skip_link=True, days_range=90, overlap=3 )
+	assert ranges[-1] == last_fetch - timedelta( days=3 )
+
+	service.import_activities( skip_download=True, skip_link=True, fetch_all=True, first_year=2010 )
+	assert ranges[-1] == datetime( 2010, 1, 1, tzinfo=UTC )
+
+	# pretend mode does not move the watermark
+	service.import_activities( force=True, pretend=True, skip_download=True, skip_link=True )
+	assert service.last_fetch == last_fetch
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_resume( service: Mock ):
+	downloads = []
+	download = service.download
+	service.download = lambda summary, **kwargs: downloads.append( summary.uid ) or download( summary, **kwargs )
+
+	# simulate an interrupted import: summaries have been fetched, first activity has been downloaded, but not added
+	summaries = service.fetch( False, False, amount=3 )
+	resources = download( summaries[0] )
+	service.persist_resources( [ summaries[0], *resources ], force=False, pretend=False )
+	journal = ImportJournal( service.ctx.var_fs, service.name )
+	journal.start( summaries )
+	journal.downloaded( summaries[0], resources )
+	assert [ ( s.uid, s.path ) for s in journal.load()[0] ] == [ ( s.uid, s.path ) for s in summaries ]
+
+	# summaries which have been committed are not imported again, upserts without commit are
+	journal.upserted( summaries[2] )
+	journal.committed()
+	journal.upserted( summaries[1] )
+	assert [ ( s.uid, s.path ) for s in journal.load()[0] ] == [ ( s.uid, s.path ) for s in summaries[:2] ]
+	service.persist_activities( [ Service.as_activity_from( summaries[2] ) ], force=False, pretend=False )
+
+	service.import_activities( resume=True, force=True, skip_link=True ) # force: known resources are not filtered out
+	assert downloads == [ 'mock:1002/1002.json' ]
+	assert all( service.ctx.db.contains_resource( s.uid, s.path ) for s in summaries )
+	assert not journal.exists()
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_persist_identical_content( service: Mock ):
+	service.import_activities( skip_link=True )
+	activity = service.ctx.db.activities[0]
+	assert all( r.digest for r in activity.resources )
+
+	writes = []
+	writebytes = service.dbfs.writebytes
+	service.dbfs.writebytes = lambda path, content: writes.append( path ) or writebytes( path, content )
+
+	# byte-identical downloads are not written again, even when forced
+	resource = service.download( summary=activity.resources[0] )[0]
+	service.persist_resource( resource, force=True, pretend=False )
+	assert writes == []
+
+	original = resource.content
+	resource.content = resource.content.replace( b'2016', b'2017' )
+	service.persist_resource( resource, force=True, pretend=False )
+	assert len( writes ) == 1
+
+	# the index follows the written content: the original content is different from the file now
+	resource.content = original
+	service.persist_resource( resource, force=True, pretend=False )
+	assert len( writes ) == 2 and service.dbfs.readbytes( resource.path ) == original
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_rate_limit_exhausted( service: Mock ):
+	downloads = []
+	download = service.download
+
+	def exhausting_download( summary, **kwargs ):
+		if downloads:
+			raise RateLimitExceeded( 'rate limit exhausted' )
+		downloads.append( summary.uid )
+		return download( summary, **kwargs )
+
+	service.download = exhausting_download
+	service.import_activities( skip_link=True, workers=1, amount=3 )
+
+	# import stops early: journal is kept for resuming, watermark does not move
+	assert len( downloads ) == 1 and len( service.ctx.db.activities ) == 1
+	assert ImportJournal( service.ctx.var_fs, service.name ).exists()
+	assert service.last_fetch is None
+
+	service.download = download
+	service.import_activities( resume=True, skip_link=True )
+	assert len( service.ctx.db.activities ) == 3 and service.last_fetch is not None
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_failed_download( service: Mock ):
+	download = service.download
+
+	def failing_download( summary, **kwargs ):
+		if summary.uid.local_id == 1002:
+			raise OSError( 'connection reset' )
+		return download( summary, **kwargs )
+
+	service.download = failing_download
+	service.import_activities( skip_link=True, workers=1, amount=3 )
+
+	# failed activity is dropped: journal is kept and watermark does not move, so it will be fetched again
+	assert len( service.ctx.db.activities ) == 2 and service.metrics['download'].errors == 1
+	assert ImportJournal( service.ctx.var_fs, service.name ).exists()
+	assert service.last_fetch is None
+
+	service.download = download
+	service.import_activities( resume=True, skip_link=True )
+	assert len( service.ctx.db.activities ) == 3 and service.last_fetch is not None
+	assert not ImportJournal( service.ctx.var_fs, service.name ).exists()
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_stream_resource( service: Mock ):
+	content = synthetic_gpx( datetime( 2024, 6, 1, 10 ), 100 ).encode( 'UTF-8' )
+	r = Resource( uid='mock:1001', path='1001.gpx', type=GPX_TYPE )
+	assert service.stream_resource( r, ( content[i:i + 64] for i in range( 0, len( content ), 64 ) ) )
+	assert r.path == 'mock/1/0/0/1001/1001.gpx' and r.content is None and r.digest == content_digest( content )
+	assert service.dbfs.readbytes( r.path ) == content
+	assert service.dbfs.listdir( 'mock/1/0/0/1001' ) == [ '1001.gpx' ]
+
+	# parsers read streamed content from the db, content is not kept
+	activity = Service.as_activity_from( r )
+	assert activity.starttime == datetime( 2024, 6, 1, 10, tzinfo=UTC ) and r.content is None and r.raw is None # no gpx object tree is built
+
+	# persisting does not write the resource again
+	service.persist_resource( r, force=True, pretend=False )
+
+	# empty downloads and failed downloads leave no trace, existing files are not touched
+	assert not service.stream_resource( Resource( uid='mock:1002', path='1002.gpx', type=GPX_TYPE ), iter( [] ) )
+	assert not service.dbfs.exists( 'mock/1/0/0/1002' ) or service.dbfs.listdir( 'mock/1/0/0/1002' ) == []
+
+	def failing():
+		yield b'<?xml'
+		raise OSError( 'connection reset' )
+
+	with raises( OSError ):
+		service.stream_resource( Resource( uid='mock:1001', path='1001.gpx', type=GPX_TYPE ), failing() )
+	assert service.dbfs.readbytes( r.path ) == content and service.dbfs.listdir( 'mock/1/0/0/1001' ) == [ '1001.gpx' ]
+
+	# pretend mode keeps content in memory
+	r = Resource( uid='mock:1003', path='1003.gpx', type=GPX_TYPE )
+	assert service.stream_resource( r, iter( [ content ] ), pretend=True ) and r.content == content
+	assert not service.dbfs.exists( 'mock/1/0/0/1003/1003.gpx' )
+
+@skip_benchmark
+@mark.context( env='empty', persist='clone', cleanup=True )
+@mark.service( cls=Mock, init=True, register=True )
+def test_benchmark_streaming_memory( service: Mock ):
+	payload = synthetic_gpx( datetime( 2024, 6, 1, 10 ), 2000 ).encode( 'UTF-8' )
+
+	def download_in_memory( summary, **kwargs ):
+		return [ Resource( uid=summary.uid, path=f'{summary.local_id}.gpx', type=GPX_TYPE, content=bytes( bytearray( payload ) ) ) ] # a fresh copy, as with a real download
+
+	def download_streamed( summary, **kwargs ):
+		resource = Resource( uid=summary.uid, path=f'{summary.local_id}.gpx', type=GPX_TYPE )
+		service.stream_resource( resource, ( payload[i:i + DOWNLOAD_CHUNK_SIZE] for i in range( 0, len( payload ), DOWNLOAD_CHUNK_SIZE ) ) )
+		return [ resource ]
+
+	for name, download in [ ( 'in memory', download_in_memory ), ( 'streamed', download_streamed ) ]:
+		service.download = download
+		tracemalloc.start()
+		start = perf_counter()
+		service.import_activities( force=True, skip_link=True, amount=500, workers=4 )
+		elapsed, peak = perf_counter() - start, tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print( f'imported 500 activities ({len( payload )} bytes each, {name}) in {elapsed:.2f}s, peak memory {peak / 1048576:.1f} MB' )
+		assert len( service.ctx.db.activities ) == 500
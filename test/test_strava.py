@@ -2,6 +2,7 @@
 from datetime import datetime, timedelta
 from datetime import time
 from datetime import timezone
+from types import SimpleNamespace
 
 from dateutil.tz import tzlocal
 from pytest import mark
@@ -9,7 +10,11 @@ from pytest import mark
 from test.helpers import skip_live
 from tracs.activity_types import ActivityTypes
 from tracs.plugins.strava import Strava, StravaActivity
-from tracs.plugins.strava import StravaHandler
+from tracs.plugins.image import JPEG_TYPE
+from tracs.plugins.strava import StravaHandler, to_stream
+from tracs.plugins.stravaweb import Strava as StravaWeb
+from tracs.resources import content_digest, Resource
+from tracs.streams import Point
 
 @mark.file( 'environments/default/db/strava/2/0/0/200002/200002.json' )
 def test_init_from_raw( path ):
@@ -44,3 +49,91 @@ def test_workflow( service ):
 	service.login()
 	fetched = service.fetch( False, False, range_from = datetime( 2020, 1, 1 ), range_to=datetime( 2023, 12, 31 ) )
 	assert len( fetched ) > 0
+
+def test_to_stream():
+	data = {
+		'time': [ 0, 1, 2, 4 ],
+		'latlng': [ [ 51.1, 13.1 ], [ 51.2, 13.2 ], None, [ 51.4, 13.4 ] ],
+		'distance': [ 0.0, 2.5, 5.0, 10.0 ],
+		'altitude': [ 100.0, 100.5 ],
+		'heartrate': [ 90, 91, 92, 93 ],
+	}
+	streams = { k: SimpleNamespace( data=v ) for k, v in data.items() }
+	stream = to_stream( streams, datetime( 2024, 6, 1, 10, tzinfo=timezone.utc ) )
+
+	assert stream.length == 4 and stream.has_coordinates()
+	assert stream.points[3] == Point( datetime( 2024, 6, 1, 10, 0, 4, tzinfo=timezone.utc ), 51.4, 13.4, distance=10.0, hr=93 )
+	assert stream.points[2].lat is None and stream.points[2].alt is None
+
+@mark.context( env='default', persist='mem', cleanup=True )
+@mark.service( cls=Strava, init=True, register=True )
+def test_fetch_details( service, monkeypatch ):
+	template = service.dbfs.readbytes( 'strava/2/0/0/200002/200002.json' )
+	requested = []
+
+	def get_activity( activity_id, **kwargs ):
+		requested.append( activity_id )
+		return StravaActivity.parse_raw( template.replace( b'200002', str( activity_id ).encode() ) )
+
+	client = SimpleNamespace(
+		get_activities=lambda **kwargs: [ SimpleNamespace( id=i ) for i in [ 300001, 200002, 300002 ] ],
+		get_activity=get_activity,
+	)
+	monkeypatch.setattr( service, '_client', client )
+
+	# details of known activities are taken from the db, order of the listing is kept
+	fetched = service.fetch( False, False, range_from=datetime( 2018, 1, 1 ), range_to=datetime( 2024, 1, 1 ), workers=3 )
+	assert [ str( r.uid ) for r in fetched ] == [ 'strava:300001', 'strava:200002', 'strava:300002' ]
+	assert sorted( requested ) == [ 300001, 300002 ]
+	assert fetched[1].data.name == StravaActivity.parse_raw( template ).name
+
+	# details are cached in memory
+	service.fetch( False, False, range_from=datetime( 2018, 1, 1 ), range_to=datetime( 2024, 1, 1 ), workers=3 )
+	assert len( requested ) == 2
+	assert service.activity_detail( 300001 ) is fetched[0].data
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=Strava, init=True, register=True )
+def test_download_photo( service, monkeypatch ):
+	content = bytes( range( 256 ) ) * 1000
+
+	class Response:
+		status_code = 200
+		def __enter__( self ): return self
+		def __exit__( self, *args ): pass
+		def iter_content( self, chunk_size ): return ( content[i:i + chunk_size] for i in range( 0, len( content ), chunk_size ) )
+
+	monkeypatch.setattr( 'tracs.plugins.strava.rqget', lambda url, **kwargs: Response() )
+
+	resource = Resource( uid='strava:1001', path='1001.1.jpg', type=JPEG_TYPE, source='https://localhost/1001.jpg' )
+	assert not service.download_photo( resource, pretend=True )
+	assert not service.dbfs.exists( 'strava/1/0/0/1001/1001.1.jpg' )
+
+	assert service.download_photo( resource )
+	assert service.dbfs.readbytes( 'strava/1/0/0/1001/1001.1.jpg' ) == content
+	assert resource.path == 'strava/1/0/0/1001/1001.1.jpg' and resource.content is None
+	assert resource.digest == content_digest( content )
+
+@mark.context( env='empty', persist='mem', cleanup=True )
+@mark.service( cls=StravaWeb, init=True, register=True )
+def test_web_fetch_pages( service, monkeypatch ):
+	start = datetime( 2024, 6, 1, tzinfo=timezone.utc )
+	models = [ { 'id': 1000 + i, 'start_time': ( start - timedelta( days=i ) ).isoformat() } for i in range( 45 ) ]
+	requested = []
+
+	def get( url, params, **kwargs ):
+		page = int( params.get( 'page' ) )
+		requested.append( page )
+		return SimpleNamespace( json=lambda: { 'total': len( models ), 'models': models[( page - 1 ) * 20:page * 20] } )
+
+	monkeypatch.setattr( service, '_session', SimpleNamespace( get=get, policy=SimpleNamespace( expire_after=lambda: None ) ) )
+
+	# all pages are fetched, including the last one, order is kept
+	fetched = service.fetch( False, False, workers=4 )
+	assert [ r.raw.get( 'id' ) for r in fetched ] == [ m.get( 'id' ) for m in models ]
+	assert sorted( requested ) == [ 1, 2, 3 ]
+
+	# fetching stops when the start of the range has been reached
+	requested.clear()
+	fetched = service.fetch( False, False, workers=1, range_from=start - timedelta( days=10 ) )
+	assert len( fetched ) == 20 and requested == [ 1 ]
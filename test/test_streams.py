@@ -1,7 +1,18 @@
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+from time import perf_counter
+from typing import List, Optional
+
+from dateutil.tz import UTC
+from geojson import dump as dump_geojson
+from lxml.etree import tostring
 from pytest import mark
 
+from helpers import skip_benchmark
 from tracs.plugins.gpx import GPXImporter
-from tracs.streams import Stream
+from tracs.resources import Resource
+from tracs.streams import as_csv, as_feature_collection, as_gpx, as_str, as_streams, Point, Stream
 
 @mark.file( 'templates/gpx/mapbox.gpx' )
 def test_gpx_importer( path ):
@@ -14,3 +25,71 @@ def test_gpx_importer( path ):
 	assert len( gpx.tracks ) == 1
 	assert len( gpx.tracks[0].segments ) == 1
 	assert len( gpx.tracks[0].segments[0].points ) == 206
+
+def gpx_resources( *paths: str ) -> List[Resource]:
+	return [ GPXImporter().load( path=p ) for p in paths ]
+
+def as_str_legacy( resources: List[Resource], fmt: str ) -> Optional[str]:
+	"""
+	Creates the output of as_str() via the object models of gpxpy and geojson, this is slow, but serves as reference.
+	"""
+	if fmt == 'csv':
+		return as_csv( as_streams( resources ) )
+	elif fmt == 'gpx':
+		return as_gpx( as_streams( resources ) ).to_xml( prettyprint=False )
+	elif fmt == 'geojson':
+		io = StringIO()
+		dump_geojson( as_feature_collection( as_streams( resources ) ), io )
+		return io.getvalue()
+	else:
+		return None
+
+def strava_stream( points: int = 20 ) -> Stream:
+	start = datetime( 2024, 6, 1, 10, tzinfo=UTC )
+	return Stream( points=[ Point(
+		start=start,
+		seconds=s,
+		latlng=( 51.0 + s * 0.00013, 13.0 + s * 0.00007 ) if s != 3 else None,
+		distance=s * 3.25,
+		alt=100.0 + s / 10 if s != 4 else None,
+		speed=3.25,
+		hr=100 + s % 7 if s != 5 else None,
+	) for s in range( points ) ] )
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_writers( ctx ):
+	paths = [ ctx.config_fs.getsyspath( p ) for p in ctx.config_fs.walk.files( filter=[ '*.gpx' ] ) ]
+	resources = gpx_resources( *paths, Path( __file__ ).parent / 'templates/gpx/mapbox.gpx' )
+	assert len( resources ) == 16
+
+	for fmt in [ 'csv', 'gpx', 'geojson' ]:
+		assert as_str( resources, fmt ) == as_str_legacy( resources, fmt )
+		assert as_str( resources[:1], fmt ) == as_str_legacy( resources[:1], fmt )
+
+def test_strava_writers():
+	stream = strava_stream()
+	assert stream.length == 20 and stream.points[3].lat is None and stream.points[5].hr is None and stream.points[6].hr == 106
+
+	kwargs = { 'track_name': 'Morning Ride <&>', 'track_type': '1' }
+	assert stream.as_gpx_str( **kwargs ) == stream.as_gpx( **kwargs ).to_xml( prettyprint=True )
+	assert stream.as_gpx_str( prettyprint=False ) == stream.as_gpx().to_xml( prettyprint=False )
+
+	kwargs = {
+		'average_heart_rate_bpm': 102.5, 'calories': 311, 'distance_meters': 61.75, 'id': '2024-06-01T12:00:00Z', 'intensity': 'Active',
+		'maximum_heart_rate_bpm': 106, 'maximum_speed': 3.25, 'start_date': datetime( 2024, 6, 1, 10, tzinfo=UTC ), 'total_time_seconds': 19,
+	}
+	assert stream.as_tcx_str( **kwargs ) == tostring( stream.as_tcx( **kwargs ).as_xml(), pretty_print=True ).decode( 'UTF-8' )
+	assert Stream().as_tcx_str( **kwargs ) == tostring( Stream().as_tcx( **kwargs ).as_xml(), pretty_print=True ).decode( 'UTF-8' )
+
+@skip_benchmark
+def test_benchmark_writers():
+	stream = strava_stream( 100000 )
+	for name, legacy, fast in [
+		( 'gpx', lambda: stream.as_gpx().to_xml( prettyprint=True ), lambda: stream.as_gpx_str() ),
+		( 'tcx', lambda: tostring( stream.as_tcx( start_date=datetime( 2024, 6, 1, 10, tzinfo=UTC ) ).as_xml(), pretty_print=True ), lambda: stream.as_tcx_str( start_date=datetime( 2024, 6, 1, 10, tzinfo=UTC ) ) ),
+	]:
+		start = perf_counter()
+		legacy()
+		middle = perf_counter()
+		fast()
+		print( f'wrote {name} with 100000 points in {middle - start:.2f}s (object tree) / {perf_counter() - middle:.2f}s (direct)' )
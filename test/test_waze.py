@@ -1,11 +1,17 @@
+from datetime import datetime
 from pathlib import Path
+from time import perf_counter
 from typing import cast
 
-from gpxpy.gpx import GPX
+from dateutil.tz import UTC
+
+from gpxpy.gpx import GPX, GPXTrack, GPXTrackPoint, GPXTrackSegment
 
 from pytest import mark
 
-from tracs.plugins.waze import AccountActivity, Waze, WAZE_ACCOUNT_ACTIVITY_TYPE, WAZE_ACCOUNT_INFO_TYPE, WAZE_TYPE, WazeAccountActivityImporter, WazeImporter
+from helpers import skip_benchmark, synthetic_waze_takeout
+from tracs.plugins.gpx import GPXImporter
+from tracs.plugins.waze import AccountActivity, LocationDetail, to_gpx, Waze, WAZE_ACCOUNT_ACTIVITY_TYPE, WAZE_ACCOUNT_INFO_TYPE, WAZE_TYPE, WazeAccountActivityImporter, WazeImporter
 
 @mark.file( 'environments/default/takeouts/waze/2020-09/account_activity_3.csv' )
 def test_read_account_activity_2020( path ):
@@ -30,6 +36,35 @@ def test_read_account_activity_2023( path ):
 	assert len( location_details[0].as_point_list() ) == 146
 	assert len( location_details[1].as_point_list() ) == 71
 
+def test_location_detail_columns():
+	ld = LocationDetail( coordinates='[{"0":"2020-07-12 07:47:43(54.614624; 13.360313) => 2020-07-12 07:48:01(54.614466; 13.360466)"}]' )
+	times, lats, lons = ld.columns()
+	assert list( lats ) == [ 54.614624, 54.614466 ] and list( lons ) == [ 13.360313, 13.360466 ]
+	assert ld.times() == [ datetime( 2020, 7, 12, 7, 47, 43 ), datetime( 2020, 7, 12, 7, 48, 1 ) ] # no zone in 2020 format
+	assert ld.id() == '200712074743'
+	assert ld.columns() is ld.columns() # parsed once
+
+	ld = LocationDetail( coordinates='2023-03-10 15:27:17 UTC(51.257366 12.73279)|2023-03-10 15:27:21 UTC(51.25733 12.730581)' )
+	assert ld.times()[0] == datetime( 2023, 3, 10, 15, 27, 17, tzinfo=UTC )
+	assert list( ld.columns()[1] ) == [ 51.257366, 51.25733 ]
+
+	ld = LocationDetail( coordinates='(11.420753 51.261308)|(11.420077 51.261603)' ) # lon/lat, without times
+	assert not ld.has_times()
+	assert list( ld.columns()[1] ) == [ 51.261308, 51.261603 ] and list( ld.columns()[2] ) == [ 11.420753, 11.420077 ]
+
+	content = to_gpx( ld )
+	assert len( GPXImporter().load( content=content ).raw.tracks[0].segments[0].points ) == 2 and b'lat="51.261308"' in content
+
+@mark.file( 'environments/default/db/waze/20/07/12/200712074743/200712074743.txt' )
+def test_to_gpx( path ):
+	ld = LocationDetail( coordinates=Path( path ).read_text( encoding='UTF-8' ) )
+
+	# output is identical to the output created via gpxpy
+	gpx = GPX()
+	gpx.tracks.append( GPXTrack() )
+	gpx.tracks[0].segments.append( GPXTrackSegment( points=[ GPXTrackPoint( time=p.time, latitude=p.lat, longitude=p.lon ) for p in ld.as_point_list() ] ) )
+	assert to_gpx( ld ) == gpx.to_xml().encode( 'UTF-8' )
+
 # dummy test case: can read, but data is not used anywhere
 @mark.file( 'environments/default/takeouts/waze/2023-04/account_activity_3.csv' )
 def test_read_account_info( path ):
@@ -62,4 +97,81 @@ def test_fetch_from_takeouts( service ):
 
 	for r in resources:
 		gpx = service.download( r, force=False, pretend=False )
-		assert len( gpx ) == 1 and isinstance( gpx[0].raw, GPX )
+		assert len( gpx ) == 1 and isinstance( GPXImporter().load( content=gpx[0].content ).raw, GPX )
+
+@skip_benchmark
+def test_benchmark_takeout( tmp_path ):
+	path = tmp_path / 'account_activity_3.csv'
+	path.write_text( synthetic_waze_takeout( 2000, 500 ), encoding='UTF-8' )
+
+	start = perf_counter()
+	location_details = cast( AccountActivity, WazeAccountActivityImporter().load( path=path ).data ).location_details
+	ids = [ ld.id() for ld in location_details if ld.has_times() ]
+	print( f'parsed {len( ids )} drives from {path.stat().st_size / 1e6:.0f} MB takeout in {perf_counter() - start:.1f}s' )
+
+	start = perf_counter()
+	for ld in location_details[:200]:
+		to_gpx( ld )
+	print( f'created 200 GPX files in {perf_counter() - start:.1f}s' )
+	assert len( ids ) == 2000
+
+@mark.context( env='default', persist='clone', cleanup=True )
+@mark.service( cls=Waze, init=True, register=True )
+def test_fetch_changed_takeouts( service, monkeypatch ):
+	parsed = []
+	parse = service._parse_takeouts
+	monkeypatch.setattr( service, '_parse_takeouts', lambda contents, processes=0: parsed.append( len( contents ) ) or parse( contents, processes ) )
+
+	def fetch( force: bool = False, pretend: bool = False, **kwargs ):
+		# takeouts are recorded after the import has completed
+		resources = service.fetch( force=force, pretend=pretend, from_takeouts=True, **kwargs )
+		service.postprocess_import( force=force, pretend=pretend )
+		return resources
+
+	# pretend does not record takeouts
+	assert len( fetch( pretend=True ) ) == 4
+	assert service.processed_takeouts == []
+
+	# nothing is recorded as long as the import has not completed
+	assert len( service.fetch( force=False, pretend=False, from_takeouts=True ) ) == 4
+	assert service.processed_takeouts == []
+
+	assert len( resources := fetch() ) == 4
+	assert [ r.uid.local_id for r in resources ] == sorted( r.uid.local_id for r in resources )
+	assert [ t['path'] for t in service.processed_takeouts ] == [ '2020-09/account_activity_3.csv', '2022-01/account_activity_3.csv', '2023-04/account_activity_3.csv' ]
+
+	# unchanged takeouts are neither read nor parsed
+	assert fetch() == []
+	assert parsed == [ 3, 3, 3, 0 ]
+
+	# touched, but identical content is not parsed, changed content is parsed
+	path = service.ctx.takeout_dir_path( service.name ) / '2022-01/account_activity_3.csv'
+	path.write_bytes( path.read_bytes() )
+	assert fetch() == []
+	path.write_bytes( path.read_bytes() + b'\n' )
+	assert len( fetch() ) == 2
+	assert parsed[-2:] == [ 0, 1 ]
+
+	# force parses everything, optionally in separate processes
+	assert len( fetch( force=True, processes=2 ) ) == 4
+
+	service.ctx.dump_state()
+	assert '2023-04/account_activity_3.csv' in service.ctx.config_fs.readtext( 'state.yaml' )
+
+@mark.context( env='default', persist='clone', cleanup=True )
+@mark.service( cls=Waze, init=True, register=True )
+def test_import_records_takeouts( service, monkeypatch ):
+	download = service.download
+
+	def failing_download( summary, **kwargs ):
+		if summary is resources[0]:
+			raise OSError( 'unable to write gpx' )
+		return download( summary, **kwargs )
+
+	# takeouts of a failed import are not recorded, they are processed again by the next import
+	resources = []
+	fetch = service.fetch
+	monkeypatch.setattr( service, 'fetch', lambda *args, **kwargs: resources.extend( fetch( *args, **kwargs ) ) or resources )
+	monkeypatch.setattr( service, 'download', failing_download )
+	service.import_activities( from_takeouts=True, skip_link=True )
+	assert len( resources ) == 4 and service.processed_takeouts == []
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time, timedelta
 from logging import getLogger
 from os import system
@@ -13,8 +14,9 @@ from rich.prompt import Confirm
 from tzlocal import get_localzone_name
 
 from tracs.activity import Activity
-from tracs.config import ApplicationContext
+from tracs.config import ApplicationContext, TaskContext
 from tracs.db import ActivityDb
+from tracs.pipeline import Coordinator
 from tracs.plugins.gpx import GPX_TYPE
 from tracs.registry import Registry
 from tracs.resources import Resource
@@ -33,19 +35,66 @@ MAXIMUM_OPEN = 8
 # also nice: https://github.com/luka1199/geo-heatmap
 
 def import_activities( ctx: ApplicationContext, sources: List[str], **kwargs ):
+	services = []
 	for src in (sources or ctx.registry.service_names() ):
 		if service := ctx.registry.services.get( src ):
-			log.debug( f'importing activities from service {src}' )
-			service.import_activities(
-				ctx=ctx,
-				force=ctx.force,
-				pretend=ctx.pretend,
-				first_year=ctx.config['import'].first_year,
-				days_range=ctx.config['import'].range,
-				**kwargs )
+			services.append( service )
 		else:
 			log.error( f'skipping import from service {src}, either service is unknown or disabled' )
 
+	kwargs = {
+		'force': ctx.force,
+		'pretend': ctx.pretend,
+		'first_year': ctx.config['import'].first_year,
+		'days_range': ctx.config['import'].range,
+		'overlap': ctx.config['import'].overlap,
+		'workers': ctx.config['import'].workers,
+		'processes': ctx.config['import'].processes,
+		'queue_size': ctx.config['import'].queue_size,
+		'commit_every': ctx.config['import'].commit_every,
+		'commit_interval': ctx.config['import'].commit_interval,
+		**kwargs
+	}
+
+	if len( services ) > 1 and ctx.config['import'].get( 'parallel', True ):
+		_import_parallel( ctx, services, **kwargs )
+	else:
+		for service in services:
+			log.debug( f'importing activities from service {service.name}' )
+			service.import_activities( ctx=ctx, **kwargs )
+
+def _import_parallel( ctx: ApplicationContext, services: List[Service], **kwargs ):
+	"""
+	Imports from several services at the same time: fetching and downloading runs on one thread per service, while
+	all db updates are carried out by a coordinator on the current thread. Each service reports its progress to a task
+	of its own in a shared progress display.
+	"""
+	log.debug( f'importing activities from services {", ".join( s.name for s in services )} in parallel' )
+
+	ctx.db.known_resources( [] ) # make sure the resource index exists before it is accessed from several threads
+	coordinator = Coordinator()
+	progress = ctx.create_progress() if not ctx.verbose else None
+	if progress:
+		progress.start()
+
+	try:
+		with ThreadPoolExecutor( max_workers=len( services ), thread_name_prefix='import' ) as executor:
+			futures = [ executor.submit( _import_from, s, TaskContext( ctx, progress, s.display_name ), coordinator=coordinator, **kwargs ) for s in services ]
+			coordinator.run( futures )
+	finally:
+		if progress:
+			progress.stop()
+
+def _import_from( service: Service, ctx: TaskContext, **kwargs ):
+	log.debug( f'importing activities from service {service.name}' )
+	service_ctx, service._ctx = service._ctx, ctx # let the service report to its own progress task
+	try:
+		service.import_activities( ctx=ctx, **kwargs )
+	except Exception:
+		log.error( f'error importing activities from service {service.name}', exc_info=True )
+	finally:
+		service._ctx = service_ctx
+
 def open_activities( ctx: ApplicationContext, activities: List[Activity] ) -> None:
 	if len( activities ) > MAXIMUM_OPEN:
 		log.warning( f'limit of number of activities to open is {MAXIMUM_OPEN}, ignoring the rest of provided {len( activities )} activities' )
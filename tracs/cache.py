@@ -0,0 +1,301 @@
+
+from __future__ import annotations
+
+from json import dumps, loads
+from logging import getLogger
+from sqlite3 import connect
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Optional
+from weakref import WeakKeyDictionary
+
+from attrs import define, field
+from fs.errors import NoSysPath
+from requests import PreparedRequest, Response
+from requests_cache import CachedSession, DO_NOT_CACHE, NEVER_EXPIRE, SQLiteCache
+from rich import box
+from rich.pretty import pretty_repr as pp
+from rich.table import Table as RichTable
+
+from tracs.activity import Activity
+from tracs.config import ApplicationContext
+
+log = getLogger( __name__ )
+
+HTTP_CACHE_FILENAME = 'http_cache.sqlite'
+ACTIVITY_CACHE_FILENAME = 'activity_cache.sqlite'
+ACCESS_TABLE = 'access'
+ACTIVITY_TABLE = 'activities'
+
+DEFAULT_TTL = 3600 # one hour
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024 # 256 MB
+DEFAULT_ACTIVITY_CACHE_SIZE = 64 * 1024 * 1024 # 64 MB
+
+@define
+class CachePolicy:
+	"""
+	Describes how long responses of a service are kept: summary listings become stale after ttl seconds and are
+	revalidated via ETag/Last-Modified afterwards, downloads of exports are immutable and use download_ttl.
+	"""
+
+	enabled: bool = field( default=True )
+	ttl: int = field( default=DEFAULT_TTL )
+	download_ttl: int = field( default=NEVER_EXPIRE )
+	max_size: int = field( default=DEFAULT_MAX_SIZE )
+
+	@classmethod
+	def from_config( cls, ctx: Optional[ApplicationContext], name: Optional[str] = None ) -> CachePolicy:
+		"""
+		Creates a policy from the global cache configuration, values from the cache section of a plugin take precedence.
+
+		:param ctx: context to read the configuration from
+		:param name: name of the plugin
+		:return: cache policy
+		"""
+		cfg = {}
+		try:
+			cfg.update( { k.lower(): v for k, v in ( ctx.config.get( 'cache' ) or {} ).items() } )
+			if name:
+				plugin_cfg = ( ctx.config.get( 'plugins' ) or {} ).get( name ) or {}
+				cfg.update( { k.lower(): v for k, v in ( plugin_cfg.get( 'cache' ) or {} ).items() } )
+		except AttributeError:
+			pass
+
+		return CachePolicy( **{ k: v for k, v in cfg.items() if k in [ 'enabled', 'ttl', 'download_ttl', 'max_size' ] and v is not None } )
+
+	def expire_after( self, download: bool = False ) -> int:
+		if not self.enabled:
+			return DO_NOT_CACHE
+		return self.download_ttl if download else self.ttl
+
+class HttpCache( CachedSession ):
+	"""
+	Session with a persistent response cache, backed by a SQLite database in the cache area of the context.
+	Nothing is cached unless a request explicitly asks for it by providing expire_after, this keeps login forms and
+	other session-related requests out of the cache. Size is limited by evicting the least recently used responses.
+	"""
+
+	def __init__( self, policy: CachePolicy = None, path: Optional[str] = None, **kwargs ):
+		self.policy = policy or CachePolicy()
+		backend = SQLiteCache( db_path=path, wal=True ) if path else SQLiteCache( db_path=HTTP_CACHE_FILENAME, use_memory=True )
+		super().__init__( backend=backend, expire_after=DO_NOT_CACHE, stale_if_error=True, allowable_methods=( 'GET', 'HEAD' ), **kwargs )
+		self._size: Optional[int] = None # running total of the stored size, calculated on first use
+
+		with self.cache.responses.connection( commit=True ) as con:
+			con.execute( f'CREATE TABLE IF NOT EXISTS {ACCESS_TABLE} (key TEXT PRIMARY KEY, accessed REAL)' )
+
+	@classmethod
+	def for_context( cls, ctx: ApplicationContext, name: Optional[str] = None, **kwargs ) -> HttpCache:
+		"""
+		Creates a new cache session, using the cache fs of the provided context. Falls back to an in-memory cache
+		if the fs does not provide system paths.
+
+		:param ctx: application context
+		:param name: name of the service using the session, used to look up the cache policy
+		:return: cache session
+		"""
+		try:
+			path = ctx.cache_fs.getsyspath( HTTP_CACHE_FILENAME )
+		except (AttributeError, NoSysPath):
+			path = None
+		return HttpCache( policy=CachePolicy.from_config( ctx, name ), path=path, **kwargs )
+
+	def send( self, request: PreparedRequest, **kwargs ) -> Response:
+		response = super().send( request, **kwargs )
+
+		if not ( key := getattr( response, 'cache_key', None ) ):
+			return response
+
+		# access is recorded for stored responses only, responses which are not cached don't appear in the access table
+		from_cache = getattr( response, 'from_cache', False )
+		with self.cache.responses.connection( commit=True ) as con:
+			stored = None if from_cache else con.execute( f'SELECT LENGTH(value) FROM {self.cache.responses.table_name} WHERE key = ?', ( key, ) ).fetchone()
+			if not from_cache and stored is None:
+				return response
+			con.execute( f'INSERT OR REPLACE INTO {ACCESS_TABLE} (key, accessed) VALUES (?, ?)', ( key, time() ) )
+
+		# eviction only runs when the running total passes the limit, replaced responses might be counted twice,
+		# which is corrected by the eviction
+		if not from_cache:
+			self._size = self.size if self._size is None else self._size + stored[0]
+			if self._size > self.policy.max_size:
+				self.evict()
+
+		return response
+
+	@property
+	def size( self ) -> int:
+		with self.cache.responses.connection() as con:
+			return con.execute( f'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM {self.cache.responses.table_name}' ).fetchone()[0]
+
+	def evict( self, max_size: Optional[int] = None ) -> List[str]:
+		"""
+		Removes the least recently used responses until the cache does not exceed the provided size.
+
+		:param max_size: maximum size in bytes, defaults to the max size of the cache policy
+		:return: keys of the evicted responses
+		"""
+		max_size = self.policy.max_size if max_size is None else max_size
+		table = self.cache.responses.table_name
+		with self.cache.responses.connection() as con:
+			rows = con.execute(
+				f'SELECT r.key, LENGTH(r.value) FROM {table} r LEFT JOIN {ACCESS_TABLE} a ON r.key = a.key ORDER BY COALESCE(a.accessed, 0)'
+			).fetchall()
+
+		total, evicted = sum( size for key, size in rows ), []
+		for key, size in rows:
+			if total <= max_size:
+				break
+			evicted.append( key )
+			total -= size
+
+		self._size = total
+		if evicted:
+			log.debug( f'evicting {len( evicted )} responses from http cache' )
+			self.cache.delete( *evicted )
+			with self.cache.responses.connection( commit=True ) as con:
+				con.executemany( f'DELETE FROM {ACCESS_TABLE} WHERE key = ?', [ ( key, ) for key in evicted ] )
+
+		return evicted
+
+	def clear( self ) -> None:
+		self.cache.clear()
+		self._size = 0
+		with self.cache.responses.connection( commit=True ) as con:
+			con.execute( f'CREATE TABLE IF NOT EXISTS {ACCESS_TABLE} (key TEXT PRIMARY KEY, accessed REAL)' )
+			con.execute( f'DELETE FROM {ACCESS_TABLE}' )
+
+	def status( self ) -> Dict[str, Any]:
+		return {
+			'path': self.cache.responses.db_path,
+			'responses': self.cache.responses.count(),
+			'expired': self.cache.responses.count() - self.cache.responses.count( expired=False ),
+			'size': self.size,
+			'max_size': self.policy.max_size,
+		}
+
+class ActivityCache:
+	"""
+	Persistent cache for activities created from resources, backed by a SQLite database in the cache area of the context.
+	Keys are calculated by the importer and consist of path, size and modification time of a resource file and of name
+	and version of the importer, so changed files and changed importers never hit stale entries. Activities are stored
+	without their resources. Size is limited by evicting the least recently used activities.
+	"""
+
+	_instances: WeakKeyDictionary = WeakKeyDictionary()
+	_instances_lock: Lock = Lock()
+
+	def __init__( self, path: Optional[str] = None, max_size: int = DEFAULT_ACTIVITY_CACHE_SIZE ):
+		self.path = path
+		self.max_size = max_size
+		self.hits, self.misses = 0, 0
+		self._lock = Lock()
+		self._con = connect( path or ':memory:', check_same_thread=False, isolation_level=None )
+		if path:
+			self._con.execute( 'PRAGMA journal_mode=WAL' )
+		self._con.execute( f'CREATE TABLE IF NOT EXISTS {ACTIVITY_TABLE} (key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)' )
+
+	@classmethod
+	def for_context( cls, ctx: ApplicationContext ) -> Optional[ActivityCache]:
+		"""
+		Returns the activity cache of the provided context, there's one cache per cache fs. Falls back to an in-memory
+		cache if the fs does not provide system paths.
+
+		:param ctx: application context
+		:return: activity cache or None if the context has no cache area or caching of activities is disabled
+		"""
+		try:
+			cfg = { k.lower(): v for k, v in ( ctx.config.get( 'cache' ) or {} ).items() }
+		except AttributeError:
+			cfg = {}
+
+		if not cfg.get( 'activities', True ) or getattr( ctx, 'cache_fs', None ) is None:
+			return None
+
+		with cls._instances_lock:
+			if ( cache := cls._instances.get( ctx.cache_fs ) ) is None:
+				try:
+					path = ctx.cache_fs.getsyspath( ACTIVITY_CACHE_FILENAME )
+				except NoSysPath:
+					path = None
+				cache = ActivityCache( path=path, max_size=cfg.get( 'activities_max_size' ) or DEFAULT_ACTIVITY_CACHE_SIZE )
+				cls._instances[ctx.cache_fs] = cache
+			return cache
+
+	def get( self, key: str ) -> Optional[Activity]:
+		with self._lock:
+			row = self._con.execute( f'SELECT value FROM {ACTIVITY_TABLE} WHERE key = ?', ( key, ) ).fetchone()
+			if row:
+				self._con.execute( f'UPDATE {ACTIVITY_TABLE} SET accessed = ? WHERE key = ?', ( time(), key ) )
+				self.hits += 1
+			else:
+				self.misses += 1
+
+		return Activity.from_dict( loads( row[0] ) ) if row else None
+
+	def put( self, key: str, activity: Activity ) -> None:
+		value = dumps( { k: v for k, v in activity.to_dict().items() if k != 'resources' } )
+		with self._lock:
+			self._con.execute( f'INSERT OR REPLACE INTO {ACTIVITY_TABLE} (key, value, size, accessed) VALUES (?, ?, ?, ?)', ( key, value, len( value ), time() ) )
+		self.evict()
+
+	@property
+	def size( self ) -> int:
+		with self._lock:
+			return self._con.execute( f'SELECT COALESCE(SUM(size), 0) FROM {ACTIVITY_TABLE}' ).fetchone()[0]
+
+	def evict( self, max_size: Optional[int] = None ) -> List[str]:
+		"""
+		Removes the least recently used activities until the cache does not exceed the provided size.
+
+		:param max_size: maximum size in bytes, defaults to the max size of the cache
+		:return: keys of the evicted activities
+		"""
+		max_size = self.max_size if max_size is None else max_size
+		with self._lock:
+			if self._con.execute( f'SELECT COALESCE(SUM(size), 0) FROM {ACTIVITY_TABLE}' ).fetchone()[0] <= max_size:
+				return []
+
+			rows = self._con.execute( f'SELECT key, size FROM {ACTIVITY_TABLE} ORDER BY accessed' ).fetchall()
+			total, evicted = sum( size for key, size in rows ), []
+			for key, size in rows:
+				if total <= max_size:
+					break
+				evicted.append( key )
+				total -= size
+
+			log.debug( f'evicting {len( evicted )} activities from activity cache' )
+			self._con.executemany( f'DELETE FROM {ACTIVITY_TABLE} WHERE key = ?', [ ( key, ) for key in evicted ] )
+
+		return evicted
+
+	def clear( self ) -> None:
+		with self._lock:
+			self._con.execute( f'DELETE FROM {ACTIVITY_TABLE}' )
+
+	def status( self ) -> Dict[str, Any]:
+		with self._lock:
+			count = self._con.execute( f'SELECT COUNT(*) FROM {ACTIVITY_TABLE}' ).fetchone()[0]
+		return {
+			'path': self.path,
+			'activities': count,
+			'size': self.size,
+			'max_size': self.max_size,
+			'hits': self.hits,
+			'misses': self.misses,
+		}
+
+def status_cache( ctx: ApplicationContext ) -> None:
+	table = RichTable( box=box.MINIMAL, show_header=False, show_footer=False )
+	for k, v in HttpCache.for_context( ctx ).status().items():
+		table.add_row( k, pp( v ) )
+	if activity_cache := ActivityCache.for_context( ctx ):
+		for k, v in activity_cache.status().items():
+			table.add_row( f'activity cache {k}', pp( v ) )
+	ctx.console.print( table )
+
+def clear_cache( ctx: ApplicationContext ) -> None:
+	HttpCache.for_context( ctx ).clear()
+	if activity_cache := ActivityCache.for_context( ctx ):
+		activity_cache.clear()
+	log.info( f'cleared http and activity cache in {ctx.cache_fs}' )
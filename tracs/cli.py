@@ -10,12 +10,13 @@ from rule_engine import RuleSyntaxError
 from tracs.activity import Activity
 from tracs.aio import export_activities, import_activities, open_activities, reimport_activities
 from tracs.application import Application
+from tracs.cache import clear_cache, status_cache
 from tracs.config import ApplicationContext, APPNAME
 from tracs.db import maintain_db, status_db
 from tracs.edit import edit_activities, equip_activities, modify_activities, rename_activities, set_activity_type, tag_activities, unequip_activities, \
 	untag_activities
 from tracs.fsio import backup_db, restore_db
-from tracs.group import group_activities, part_activities, ungroup_activities, unpart_activities
+from tracs.group import group_activities, part_activities, SCORE_THRESHOLD, ungroup_activities, unpart_activities
 from tracs.inspct import inspect_activities, inspect_keywords, inspect_plugins, inspect_registry, inspect_resources
 from tracs.link import link_activities
 from tracs.list import list_activities, show_config, show_fields
@@ -79,6 +80,16 @@ def db( ctx: ApplicationContext, backup: bool, maintenance: str, restore: bool,
 	elif status:
 		status_db( ctx )
 
+@cli.command( help='manages the cache of http responses and parsed activities' )
+@option( '-c', '--clear', is_flag=True, required=False, help='removes all cached responses and activities' )
+@option( '-s', '--status', is_flag=True, required=False, help='prints some cache status information' )
+@pass_obj
+def cache( ctx: ApplicationContext, clear: bool, status: bool ):
+	if clear:
+		clear_cache( ctx )
+	elif status:
+		status_cache( ctx )
+
 @cli.command( help='prints the current configuration' )
 @pass_obj
 def config( ctx: ApplicationContext ):
@@ -100,6 +111,7 @@ def fields():
 @option( '-m', '--move', required=False, hidden=True, is_flag=True, help='remove resources after import (dangerous, applies for imports from takeouts only)' )
 @option( '-o', '--as-overlay', required=False, hidden=True, is_flag=False, type=int, help='import as overlay for an existing resource (experimental, local imports only)' )
 @option( '-r', '--as-resource', required=False, hidden=True, is_flag=False, help='import as resource for an existing activity (experimental, local imports only)' )
+@option( '--resume', required=False, is_flag=True, help='continues an interrupted import without downloading activities again' )
 @option( '-sd', '--skip-download', required=False, is_flag=True, help='skips download of activities' )
 @option( '-t', '--from-takeouts', required=False, is_flag=True, help='imports activities from takeouts folder (plugin needs to support this)' )
 @argument( 'sources', nargs=-1 )
@@ -114,9 +126,11 @@ def imprt( ctx,
            from_takeouts: str = None,
            classifier: str = None,
            location: str = None,
+           resume: bool = False,
            ):
 	import_activities( ctx.obj, sources=sources, fetch_all=fetch_all, skip_download=skip_download, move=move,
-	   as_overlay=as_overlay, as_resource=as_resource, from_takeouts=from_takeouts, classifier=classifier, location=location
+	   as_overlay=as_overlay, as_resource=as_resource, from_takeouts=from_takeouts, classifier=classifier, location=location,
+	   resume=resume
 	)
 
 @cli.command( help='fetches activity summaries', hidden=True )
@@ -164,10 +178,12 @@ def show( ctx: ApplicationContext, filters, raw, format_name, resource, verbose
 		show_activities( _flt( *filters ), ctx=ctx, display_raw=raw, verbose=verbose, format_name=format_name )
 
 @cli.command( help='groups activities' )
+@option( '-a', '--auto', is_flag=True, required=False, default=False, help='automatically accepts groups scoring at least the threshold' )
+@option( '-t', '--threshold', required=False, type=float, default=SCORE_THRESHOLD, help=f'score threshold for automatic grouping (0..1, default {SCORE_THRESHOLD})' )
 @argument( 'filters', nargs=-1 )
 @pass_obj
-def group( ctx: ApplicationContext, filters: List[str] ):
-	group_activities( ctx, _flt( *filters ), force=ctx.force )
+def group( ctx: ApplicationContext, filters: List[str], auto: bool = False, threshold: float = SCORE_THRESHOLD ):
+	group_activities( ctx, _flt( *filters ), force=ctx.force, auto=auto, threshold=threshold, pretend=ctx.pretend )
 
 @cli.command( help='reverts activity groupings' )
 @option( '-k', '--keep', is_flag=True, required=False, hidden=True, default=False, help='do not remove group after ungrouping' )
@@ -396,20 +396,23 @@ class ApplicationContext:
 				self.pp( description )
 		else:
 			# create progress and start as start/stop/reuse does not seem to work
-			columns = [
-				TextColumn( '[progress.description]{task.description}' ),
-				BarColumn(),
-				TaskProgressColumn(),
-				TimeElapsedColumn(),
-				TextColumn( '/' ),
-				TimeRemainingColumn(),
-				TextColumn( '[cyan]to go[/cyan]' ),
-				TextColumn( '{task.fields[msg]}' )
-			]
-			self.progress = Progress( *columns, console=self.console )
+			self.progress = self.create_progress()
 			self.progress.start()
 			self.task_id = self.progress.add_task( description=description, total=total, msg='' )
 
+	def create_progress( self ) -> Progress:
+		columns = [
+			TextColumn( '[progress.description]{task.description}' ),
+			BarColumn(),
+			TaskProgressColumn(),
+			TimeElapsedColumn(),
+			TextColumn( '/' ),
+			TimeRemainingColumn(),
+			TextColumn( '[cyan]to go[/cyan]' ),
+			TextColumn( '{task.fields[msg]}' )
+		]
+		return Progress( *columns, console=self.console )
+
 	def total( self, total=None ):
 		if self.progress is None:
 			self.start( total=total )
@@ -493,6 +496,44 @@ class ApplicationContext:
 
 # convenience helper
 
+class TaskContext:
+	"""
+	View on an application context for one of several jobs running side by side, like concurrent imports from several
+	services: progress is reported to a task of its own in a progress display which is shared by all jobs, everything
+	else is delegated to the underlying context.
+	"""
+
+	def __init__( self, ctx: ApplicationContext, progress: Optional[Progress], description: str = '' ):
+		self._ctx = ctx
+		self.progress = progress
+		self.task_id = progress.add_task( description=description, total=None, msg='' ) if progress else None
+
+	def __getattr__( self, name: str ) -> Any:
+		return getattr( self._ctx, name )
+
+	def start( self, description: str = '', total = None ):
+		if self.progress:
+			self.progress.update( task_id=self.task_id, description=description, total=total, completed=0, msg='' )
+		elif self.verbose:
+			self._ctx.start( description, total )
+
+	def total( self, total=None ):
+		if self.progress:
+			self.progress.update( task_id=self.task_id, total=total )
+
+	def advance( self, msg: str = None, advance: float = 1 ):
+		if self.progress:
+			self.progress.update( task_id=self.task_id, advance=advance, msg=msg )
+		elif self.verbose:
+			self._ctx.advance( msg, advance )
+
+	def complete( self, msg: str = None ):
+		# the shared progress is not stopped here, this is up to the owner of the display
+		if self.progress:
+			self.progress.update( task_id=self.task_id, advance=1, msg='' if msg is None else msg )
+		elif self.verbose:
+			self._ctx.complete( msg )
+
 def _subfs( parent: FS, path: str ) -> SubFS:
 	parent.makedirs( path, recreate=True )
 	return SubFS( parent_fs=parent, path=path )
@@ -4,7 +4,7 @@ from __future__ import annotations
 from itertools import chain, groupby
 from logging import getLogger
 from pathlib import Path
-from typing import cast, Dict, List, Mapping, Optional, Tuple, Union
+from typing import cast, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Union
 
 from fs.base import FS
 from fs.copy import copy_file, copy_file_if
@@ -158,6 +158,8 @@ class ActivityDb:
 	def _load_db( self ):
 		self._schema = load_schema( self.fs )
 		self._activities: Activities = load_activities( self.fs )
+		self._resource_keys: Optional[Dict[Tuple[str, int, str], Optional[str]]] = None # resource key -> content digest, built lazily by known_resources()
+		self._resource_digests: Dict[str, Tuple[str, int, str]] = {} # content digest -> resource key, built together with resource keys
 
 	def register_summary_types( self, *types: str ):
 		[ self._summary_types.add( t ) for t in types ]
@@ -236,7 +238,9 @@ class ActivityDb:
 	# insert/upsert activities
 
 	def insert( self, *activities ) -> List[int]:
-		return self._activities.add( *activities )
+		ids = self._activities.add( *activities )
+		self._index_resources( *activities )
+		return ids
 
 	def insert_activity( self, activity: Activity ) -> int:
 		return self.insert( activity )[0]
@@ -247,20 +251,51 @@ class ActivityDb:
 	def upsert_activity( self, activity: Activity ) -> int:
 		if existing := self.get_by_uid( activity.uid ):
 			Activity.group_of( activity, target=existing )
+			self._index_resources( existing )
 			return existing.id
 		else:
 			return self.insert_activity( activity )
 
+	def upsert_activities( self, activities: Iterable[Activity] ) -> List[int]:
+		"""
+		Bulk version of upsert_activity(): existing activities are looked up in a uid map which is built only once,
+		new activities are appended in one go and receive the lowest free ids.
+
+		:param activities: activities to insert/upsert
+		:return: ids of the inserted/updated activities, in the order of the provided activities
+		"""
+		activities, uid_map, new = list( activities ), self._activities.uid_map, []
+		for a in activities:
+			if existing := uid_map.get( a.uid ):
+				if existing is not a:
+					Activity.group_of( a, target=existing )
+					self._index_resources( existing )
+			elif a.uid is None:
+				raise KeyError( f'activity must have a valid UID to be added (UID = {a.uid})' )
+			else:
+				uid_map[a.uid] = a
+				new.append( a )
+
+		for a, id in zip( new, free_ids( self._activities.ids(), len( new ) ) ):
+			a.id = id
+		self._activities.add( *new, skip_checks=True )
+		self._index_resources( *new )
+
+		return [ uid_map[a.uid].id for a in activities ]
+
 	# def replace_activity( self, new: Activity, old: Activity = None, id: int = None, uid = None ) -> None:
 	# 	self._activities.replace( new, old, id, uid )
 
 	# remove items
 
 	def remove_activity( self, a: Activity ) -> None:
-		self._activities.remove( a.id )
+		self.remove_activities( [ a ] )
 
 	def remove_activities( self, activities: List[Activity], auto_commit: bool = False ) -> None:
-		[self.remove_activity( a ) for a in activities]
+		# remove in one pass, activities are matched by identity or by id
+		objects, ids = { id( a ) for a in activities }, { a.id for a in activities if a.id is not None }
+		self._activities[:] = [ a for a in self._activities if id( a ) not in objects and ( a.id is None or a.id not in ids ) ]
+		self._resource_keys, self._resource_digests = None, {}
 		self.commit( auto_commit )
 
 	# -----
@@ -306,13 +341,62 @@ class ActivityDb:
 		uid = uid if isinstance( uid, UID ) else UID.from_str( uid )
 		return any( u == uid for u in self._activities.iter_uids() )
 
+	def known_resources( self, candidates: Iterable[Resource] ) -> Set[Resource]:
+		"""
+		Returns the subset of the provided resources which are already contained in the db. Resources are identified by
+		classifier, local id and file name, the key set of all resources in the db is built once and kept up to date
+		on insert/upsert and when content of resources is written.
+
+		:param candidates: resources to check
+		:return: set of resources which are already known
+		"""
+		self._build_resource_index()
+		return { c for c in candidates if resource_key( c.uid, c.path ) in self._resource_keys }
+
+	def resource_key_for_digest( self, digest: Optional[str] ) -> Optional[Tuple[str, int, str]]:
+		"""
+		Looks up the resource having content with the provided digest.
+
+		:param digest: content digest, as calculated by content_digest()
+		:return: key of the resource with the provided digest, see resource_key(), or None if the digest is unknown
+		"""
+		self._build_resource_index()
+		# digests of replaced content remain in the index, they only count as long as the resource still has that digest
+		key = self._resource_digests.get( digest ) if digest else None
+		return key if key and self._resource_keys.get( key ) == digest else None
+
+	def update_resource_digest( self, resource: Resource ) -> None:
+		"""
+		Updates the digest of a resource contained in the db after its content has been written. This keeps the resource
+		index up to date when content is changed outside of insert/upsert. Resources which are not contained in the db
+		are ignored, they are indexed when their activity is added.
+
+		:param resource: resource having the new digest
+		"""
+		if self._resource_keys is not None and resource.digest and ( key := resource_key( resource.uid, resource.path ) ) in self._resource_keys:
+			self._resource_keys[key] = resource.digest
+			self._resource_digests[resource.digest] = key
+
+	def _build_resource_index( self ) -> None:
+		if self._resource_keys is None:
+			self._resource_keys, self._resource_digests = {}, {}
+			self._index_resources( *self._activities )
+
+	def _index_resources( self, *activities: Activity ) -> None:
+		if self._resource_keys is not None:
+			for a in activities:
+				for r in a.resources:
+					key = resource_key( r.uid or a.uid, r.path )
+					if r.digest:
+						self._resource_keys[key] = r.digest
+						self._resource_digests[r.digest] = key
+					else:
+						self._resource_keys.setdefault( key, None )
+
 	def contains_resource( self, uid: UID|str, path: Optional[str] ) -> bool:
 		# todo: we might also accept paths with directories, but then we need to iterate over resources below
-		if isinstance( uid, UID ):
-			uid = UID( uid.classifier, uid.local_id, uid.path or basename( path ) )
-		else:
-			uid = UID( uid, path=basename( path ) if path else None )
-		return any( u == uid for u in self._activities.iter_resource_uids() )
+		self._build_resource_index()
+		return resource_key( uid, path ) in self._resource_keys
 
 	# get methods
 
@@ -494,6 +578,14 @@ class ActivityDb:
 
 # ---- DB Operations ----
 
+def resource_key( uid: UID|str, path: Optional[str] ) -> Tuple[str, int, str]:
+	"""
+	Creates the key identifying a resource: a tuple of classifier, local id and file name.
+	The file name is taken from the path, if present, otherwise from the uid.
+	"""
+	uid = uid if isinstance( uid, UID ) else UID( uid )
+	return uid.classifier, uid.local_id, basename( path ) if path else uid.path
+
 def status_db( ctx: ApplicationContext ) -> None:
 	table = RichTable( box=box.MINIMAL, show_header=False, show_footer=False )
 	table.add_row( 'activities', pp( len( ctx.db.activities ) ) )
@@ -516,3 +608,14 @@ def maintain_db( ctx: ApplicationContext, maintenance: str, **kwargs ) -> None:
 		[ctx.console.print( f ) for f in migrate_db_functions( ctx )]
 	else:
 		migrate_db( ctx, maintenance, **kwargs )
+
+def free_ids( used: Iterable[int], count: int ) -> List[int]:
+	"""
+	Returns the lowest count ids (starting with 1) which are not contained in the provided ids.
+	"""
+	used, ids, candidate = set( used ), [], 1
+	while len( ids ) < count:
+		if candidate not in used:
+			ids.append( candidate )
+		candidate += 1
+	return ids
@@ -1,6 +1,7 @@
 
 from datetime import datetime, time, timedelta
 from logging import getLogger
+from math import asin, cos, radians, sin, sqrt
 from typing import List, Optional, Tuple
 
 from attrs import define, field
@@ -9,6 +10,7 @@ from rich.prompt import Confirm
 from tracs.service import Service
 from tracs.activity import Activity, ActivityPart, groups
 from tracs.config import ApplicationContext
+from tracs.intervals import IntervalIndex
 from tracs.ui import Choice, dict_table, diff_table_3
 from tracs.utils import seconds_to_time, unique_sorted as usort
 
@@ -18,12 +20,17 @@ DELTA = 180
 MAX_DELTA = timedelta( seconds=180 )
 PART_THRESHOLD = 4
 
+SCORE_THRESHOLD = 0.8 # groups scoring at least this value are accepted automatically when using --auto
+MAX_LOCATION_DISTANCE = 500 # distance in meters between start/end points at which similarity drops to 0
+EARTH_RADIUS = 6371000
+
 @define
 class ActivityGroup:
 
 	members: List[Activity] = field( factory=list )
 	target: Activity = field( default=None )
 	time: datetime = field( default=None )
+	score: float = field( default=0.0 )
 
 	@property
 	def head( self ) -> Activity:
@@ -34,39 +41,92 @@ class ActivityGroup:
 		return self.members[1:]
 
 
-def group_activities( ctx: ApplicationContext, activities: List[Activity], force: bool = False ) -> None:
-	groups = group_activities2( activities )
+def group_activities( ctx: ApplicationContext, activities: List[Activity], force: bool = False, auto: bool = False, threshold: float = SCORE_THRESHOLD, pretend: bool = False ) -> List[ActivityGroup]:
+	"""
+	Finds group candidates among the provided activities and groups the accepted ones. Candidates are accepted when
+	forced, when auto is set and the score reaches the threshold or when confirmed by the user.
+	All accepted groups are applied at once, followed by a single commit.
+
+	:return: accepted groups
+	"""
+	candidates = find_group_candidates( activities )
+	log.info( f'found {len( candidates )} group candidates among {len( activities )} activities' )
+
+	accepted = []
+	for c in candidates:
+		if force or ( auto and c.score >= threshold ) or confirm_grouping( ctx, c ):
+			accepted.append( c )
 
+	if not pretend:
+		apply_groups( ctx, accepted )
+
+	return accepted
+
+def apply_groups( ctx: ApplicationContext, groups: List[ActivityGroup] ) -> None:
 	for g in groups:
-		added, removed = [], []
-		if force or confirm_grouping( ctx, g ):
-			added.append( g.target )
-			removed.extend( g.members )
+		g.target = g.target or Activity.group_of( *g.members )
 
-		ctx.db.insert_activities( added )
-		ctx.db.remove_activities( removed )
-		ctx.db.commit()
+	# members are removed first: a target might share its uid with an existing group which is one of the members
+	ctx.db.remove_activities( [ m for g in groups for m in g.members ] )
+	ctx.db.upsert_activities( [ g.target for g in groups ] )
+	ctx.db.commit()
+	log.info( f'created {len( groups )} activity groups' )
 
-def group_activities2( activities: List[Activity] ) -> List[ActivityGroup]:
-	last_activity, next_activity, current_group = None, None, None
-	groups: List[ActivityGroup] = []
-	for a in sorted( activities, key=lambda act: act.starttime.timestamp() ):
-		last_activity, next_activity = next_activity, a
-		if last_activity is None:
-			current_group = ActivityGroup( members=[a], time=a.starttime )
-			continue
-
-		delta = next_activity.starttime - last_activity.starttime
-		if delta < MAX_DELTA:
-			current_group.members.append( a )
-		else:
-			groups.append( current_group )
-			current_group = ActivityGroup( members=[a], time=a.starttime )
-
-	# append the last group
-	if current_group:
-		groups.append( current_group )
+def find_group_candidates( activities: List[Activity], gap: timedelta = timedelta( 0 ) ) -> List[ActivityGroup]:
+	"""
+	Finds group candidates in one pass: activities are clustered by time via an interval index, each cluster is
+	then scored by the similarity of its members. Candidates are ranked by score, best candidates first.
+
+	:param activities: activities to examine
+	:param gap: gap tolerance used for clustering
+	:return: candidates, sorted by score
+	"""
+	candidates = group_activities2( activities, gap )
+	for c in candidates:
+		c.score = min( similarity( a, b ) for i, a in enumerate( c.members ) for b in c.members[i + 1:] )
+	return sorted( candidates, key=lambda c: c.score, reverse=True )
+
+def similarity( a: Activity, b: Activity ) -> float:
+	"""
+	Calculates the similarity of two activities, ranging from 0 (different) to 1 (identical). The score is the mean
+	of the time overlap and, if available for both activities, the similarity of distance, duration and start/end
+	coordinates.
+	"""
+	scores = [ _time_overlap( a, b ) ]
+	if a.distance and b.distance:
+		scores.append( _ratio( a.distance, b.distance ) )
+	if a.duration and b.duration:
+		scores.append( _ratio( a.duration.total_seconds(), b.duration.total_seconds() ) )
+	for suffix in [ 'start', 'end' ]:
+		coords = [ getattr( x, f'location_{c}_{suffix}' ) for x in [ a, b ] for c in [ 'latitude', 'longitude' ] ]
+		if all( c is not None for c in coords ):
+			scores.append( max( 0.0, 1.0 - _haversine( *coords ) / MAX_LOCATION_DISTANCE ) )
+	return sum( scores ) / len( scores )
+
+def _time_overlap( a: Activity, b: Activity ) -> float:
+	a_end, b_end = a.endtime or a.starttime + MAX_DELTA, b.endtime or b.starttime + MAX_DELTA
+	overlap = ( min( a_end, b_end ) - max( a.starttime, b.starttime ) ).total_seconds()
+	union = ( max( a_end, b_end ) - min( a.starttime, b.starttime ) ).total_seconds()
+	return max( 0.0, overlap / union ) if union > 0 else 1.0
+
+def _ratio( x: float, y: float ) -> float:
+	return min( x, y ) / max( x, y ) if max( x, y ) > 0 else 1.0
+
+def _haversine( lat1: float, lon1: float, lat2: float, lon2: float ) -> float:
+	phi1, phi2 = radians( lat1 ), radians( lat2 )
+	h = sin( ( phi2 - phi1 ) / 2 ) ** 2 + cos( phi1 ) * cos( phi2 ) * sin( radians( lon2 - lon1 ) / 2 ) ** 2
+	return 2 * EARTH_RADIUS * asin( sqrt( h ) )
+
+def group_activities2( activities: List[Activity], gap: timedelta = timedelta( 0 ) ) -> List[ActivityGroup]:
+	"""
+	Finds groups of overlapping activities. Activities without an end time are assumed to last MAX_DELTA.
 
+	:param activities: activities to group
+	:param gap: gap tolerance, allows to group activities which are nearly adjacent
+	:return: groups consisting of more than one activity
+	"""
+	index = IntervalIndex( activities, key=lambda a: ( a.starttime, a.endtime or a.starttime + MAX_DELTA ) )
+	groups = [ ActivityGroup( members=cluster, time=cluster[0].starttime ) for cluster in index.clusters( gap ) ]
 	return [g for g in groups if len( g.members ) > 1 ]
 
 def confirm_grouping( ctx: ApplicationContext, group: ActivityGroup, force: bool = False ) -> bool:
@@ -78,7 +138,7 @@ def confirm_grouping( ctx: ApplicationContext, group: ActivityGroup, force: bool
 
 	ctx.console.print( diff_table_3( result = group.target.to_dict(), sources = sources ) )
 
-	answer = Confirm.ask( f'Continue grouping?' )
+	answer = Confirm.ask( f'Continue grouping (score {group.score:.2f})?' )
 	names = sorted( list( set( [member.name for member in group.members] ) ) )
 	if answer and len( names ) > 1:
 		group.target.name = Choice.ask(
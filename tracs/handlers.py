@@ -1,11 +1,14 @@
 
 from __future__ import annotations
 
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from functools import partial
 from logging import getLogger
 from pathlib import Path
-from typing import Any, Callable, Optional, Type, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Type, Union
 
 from fs.base import FS
+from fs.errors import FSError
 from fs.path import basename
 from requests import Response, Session
 
@@ -20,46 +23,83 @@ class ResourceHandler:
 	resource_type: Optional[str] = None
 	TYPE: Optional[str] = resource_type
 	ACTIVITY_CLS: Optional[Type] = None
+	VERSION: int = 1 # increase when activities created by a handler change, this invalidates cached activities
 
 	def __init__( self, resource_type: Optional[str] = None, activity_cls: Optional[Type] = None ) -> None:
 		self._type: Optional[str] = resource_type
 		self._activity_cls: Optional[Type] = activity_cls
 		self._factory: Callable = self.transform_data
 
-		# todo: are these fields really needed? probably not ...
-		self.resource: Optional[Resource] = None
-		self.content: Optional[Union[bytes,str]] = None
-		self.raw: Any = None
-		self.data: Any = None
-
 	def load( self, path: Optional[Path|str] = None, url: Optional[str] = None, content: Optional[bytes] = None, fs: Optional[FS] = None, **kwargs ) -> Optional[Resource]:
-		# load from either from path, url or provided content
-		if content:
-			self.content = self.load_from_content( content, **kwargs )
-
-		elif path:
-			if fs:
-				self.content = self.load_from_fs( fs, path, **kwargs )
-			else:
-				self.content = self.load_from_path( path, **kwargs )
+		"""
+		Loads a resource from either a path (optionally in the provided fs), a url or from the provided content.
+		Intermediate results are not stored in the handler, so a handler can be used by several threads at the same time.
 
-		elif url:
-			self.content = self.load_from_url( url, **kwargs )
+		:return: resource having content, raw and data populated
+		"""
+		# load from either from path, url or provided content
+		content = self.load_content( path=path, url=url, content=content, fs=fs, **kwargs )
 
 		# try to transform content into structured data (i.e. from bytes to a dict)
 		# by default this does nothing and has to be implemented in subclasses
-		self.raw = self.load_raw( self.content, **kwargs )
+		raw = self.load_raw( content, **kwargs )
 
 		# postprocess data
 		# if resource.raw is dict-like  structure and there's a factory function,
 		# the factory will be used to transfrom the data from raw and populate the data field
 		# if not, the data field will be set to raw
-		self.data = self.load_data( self.raw, **kwargs )
+		data = self.load_data( raw, **kwargs )
 
 		# return the result
-		return self.load_resource( path, url, **kwargs )
+		return self.load_resource( path, url, content=content, raw=raw, data=data, **kwargs )
+
+	def load_content( self, path: Optional[Path|str] = None, url: Optional[str] = None, content: Optional[bytes] = None, fs: Optional[FS] = None, **kwargs ) -> Optional[bytes]:
+		"""
+		Loads the content of a resource from either a path (optionally in the provided fs), a url or from the provided
+		content, without transforming it into raw or data.
+
+		:return: content of the resource
+		"""
+		if content:
+			return self.load_from_content( content, **kwargs )
+		elif path:
+			return self.load_from_fs( fs, path, **kwargs ) if fs else self.load_from_path( path, **kwargs )
+		elif url:
+			return self.load_from_url( url, **kwargs )
+		return content
+
+	def load_many( self, paths: Iterable[Path|str], fs: Optional[FS] = None, executor: Optional[Executor] = None, **kwargs ) -> List[Optional[Resource]]:
+		"""
+		Loads resources from several paths, optionally fanning out to a thread or process pool. When a process pool is
+		provided, files are read on the calling thread and parsed in the pool by a new instance of this handler's class.
+		Resources which cannot be loaded are logged and returned as None.
+
+		:param paths: paths to load from
+		:param fs: file system containing the paths, paths are treated as OS paths if fs is None
+		:param executor: executor to run loads on, loading is done sequentially if None
+		:return: list of loaded resources, in the order of the provided paths
+		"""
+		paths = list( paths )
+		if executor is None:
+			return [ _load( self, p, fs, kwargs ) for p in paths ]
+		elif isinstance( executor, ProcessPoolExecutor ):
+			contents = [ _read( self, p, fs ) for p in paths ]
+			futures = [ executor.submit( load_content, type( self ), c, p, **kwargs ) if c else None for p, c in zip( paths, contents ) ]
+			return [ _result( f, p ) for f, p in zip( futures, paths ) ]
+		else:
+			return list( executor.map( partial( _load, self, fs=fs, kwargs=kwargs ), paths ) )
 
 	def load_as_activity( self, path: Optional[Union[Path, str]] = None, url: Optional[str] = None, fs: Optional[FS] = None, **kwargs ) -> Optional[Activity]:
+		# activities loaded from a path are looked up in the activity cache first, if one is provided
+		if ( cache := kwargs.pop( 'cache', None ) ) is not None and path and ( key := self.cache_key( path, fs ) ):
+			if activity := cache.get( key ):
+				activity.resources.append( self.load_resource( path, url, **kwargs ) )
+				return activity
+
+			if activity := self.load_as_activity( path=path, url=url, fs=fs, **kwargs ):
+				cache.put( key, activity )
+			return activity
+
 		if resource := kwargs.get( 'resource' ):
 			# lazy (re-)loading of an existing resource
 			if resource.content and resource.raw is None and resource.data is None:
@@ -78,6 +118,27 @@ class ResourceHandler:
 	def as_activity( self, resource: Resource ) -> Optional[Activity]:
 		return self._factory.load( resource.raw, self.activity_cls ) if self.activity_cls else None
 
+	def cache_key( self, path: Union[Path, str], fs: Optional[FS] = None ) -> Optional[str]:
+		"""
+		Calculates the key of the activity created from the provided path, consisting of path, size and modification
+		time of the file and of name and version of this handler.
+
+		:param path: path of the resource
+		:param fs: file system containing the path, path is treated as OS path if fs is None
+		:return: cache key or None if the file does not exist
+		"""
+		try:
+			if fs:
+				info = fs.getinfo( str( path ), namespaces=[ 'details' ] )
+				size, mtime = info.size, info.raw.get( 'details', {} ).get( 'modified' )
+			else:
+				stat = Path( path ).stat()
+				size, mtime = stat.st_size, stat.st_mtime_ns
+		except (OSError, FSError):
+			return None
+
+		return f'{path}|{size}|{mtime}|{self.__class__.__module__}.{self.__class__.__qualname__}|{self.__class__.VERSION}'
+
 	# load methods
 
 	# noinspection PyMethodMayBeStatic
@@ -120,14 +181,15 @@ class ResourceHandler:
 		Loads data from a url.
 
 		:param url: URL to load data from
-		:param kwargs: session, headers, allow_redirects, stream
+		:param kwargs: session, headers, allow_redirects, stream, expire_after and refresh (the latter two for cached sessions only)
 		:return: bytes read from the provided URL
 		"""
 		session: Session = kwargs.get( 'session' )
 		headers = kwargs.get( 'headers' )
 		allow_redirects: bool = kwargs.get( 'allow_redirects', True )
 		stream: bool = kwargs.get( 'stream', True )
-		response: Response = session.get( url, headers=headers, allow_redirects=allow_redirects, stream=stream )
+		cache_kwargs = { k: kwargs.get( k ) for k in [ 'expire_after', 'refresh' ] if k in kwargs }
+		response: Response = session.get( url, headers=headers, allow_redirects=allow_redirects, stream=stream, **cache_kwargs )
 		return response.content
 
 	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
@@ -163,7 +225,7 @@ class ResourceHandler:
 	def transform_data( self, raw: Any, **kwargs ):
 		return raw
 
-	def load_resource( self, path: Optional[Path|str] = None, url: Optional[str] = None, **kwargs ) -> Resource:
+	def load_resource( self, path: Optional[Path|str] = None, url: Optional[str] = None, content: Optional[Union[bytes,str]] = None, raw: Any = None, data: Any = None, **kwargs ) -> Resource:
 		if isinstance( path, Path ):
 			path, source = path.name, path.as_uri()
 		elif isinstance( path, str ):
@@ -172,11 +234,11 @@ class ResourceHandler:
 			path, source = None, None
 
 		if resource := kwargs.get( 'resource' ):
-			resource.content = self.content
-			resource.raw = self.raw
-			resource.data = self.data
+			resource.content = content
+			resource.raw = raw
+			resource.data = data
 		else:
-			resource = Resource( type=self.__class__.TYPE, path=path, source=source, content=self.content, raw=self.raw, data=self.data )
+			resource = Resource( type=self.__class__.TYPE, path=path, source=source, content=content, raw=raw, data=data )
 
 		return resource
 
@@ -250,3 +312,32 @@ class ResourceHandler:
 			self.save_to_url( content, url, **kwargs )
 
 		return self.save_to_resource( content=content, raw=raw, data=data, **kwargs )
+
+# helpers for loading several resources
+
+def load_content( handler_cls: Type[ResourceHandler], content: bytes, path: Optional[Path|str] = None, **kwargs ) -> Optional[Resource]:
+	"""
+	Loads a resource from content with a new handler instance, this is the entry point for loading in another process.
+	"""
+	return handler_cls().load( path=path, content=content, **kwargs )
+
+def _load( handler: ResourceHandler, path: Path|str, fs: Optional[FS], kwargs: Dict[str, Any] ) -> Optional[Resource]:
+	try:
+		return handler.load( path=path, fs=fs, **kwargs )
+	except Exception:
+		log.error( f'unable to load resource from {path}', exc_info=True )
+		return None
+
+def _read( handler: ResourceHandler, path: Path|str, fs: Optional[FS] ) -> Optional[bytes]:
+	try:
+		return handler.load_from_fs( fs, path ) if fs else handler.load_from_path( path )
+	except Exception:
+		log.error( f'unable to read resource from {path}', exc_info=True )
+		return None
+
+def _result( future: Optional[Future], path: Path|str ) -> Optional[Resource]:
+	try:
+		return future.result() if future else None
+	except Exception:
+		log.error( f'unable to load resource from {path}', exc_info=True )
+		return None
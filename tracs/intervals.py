@@ -0,0 +1,74 @@
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from typing import Callable, Generic, Iterable, List, Optional, Tuple, TypeVar
+
+from attrs import define, field
+
+log = getLogger( __name__ )
+
+T = TypeVar( 'T' )
+
+@define
+class Interval( Generic[T] ):
+
+	start: datetime = field( default=None )
+	end: datetime = field( default=None )
+	item: T = field( default=None )
+
+	@property
+	def duration( self ) -> timedelta:
+		return self.end - self.start
+
+class IntervalIndex( Generic[T] ):
+	"""
+	Index over items having a start and an end time. Intervals are kept sorted by start time, this allows to find
+	clusters of overlapping (or nearly adjacent) intervals in a single sweep. Items without an end are treated
+	as points in time.
+	"""
+
+	def __init__( self, items: Iterable[T] = (), key: Callable[[T], Tuple[datetime, Optional[datetime]]] = None ):
+		self.key = key or ( lambda i: ( i.starttime, i.endtime ) )
+		self.intervals: List[Interval[T]] = []
+		self._sorted = True
+		self.add( *items )
+
+	def __len__( self ) -> int:
+		return len( self.intervals )
+
+	def add( self, *items: T ) -> None:
+		for i in items:
+			start, end = self.key( i )
+			if start is None:
+				log.debug( f'ignoring item {i} without start time' )
+				continue
+			self.intervals.append( Interval( start=start, end=end if end is not None and end > start else start, item=i ) )
+			self._sorted = False
+
+	def sorted( self ) -> List[Interval[T]]:
+		if not self._sorted:
+			self.intervals.sort( key=lambda i: ( i.start, i.end ) )
+			self._sorted = True
+		return self.intervals
+
+	def clusters( self, gap: timedelta = timedelta( 0 ) ) -> List[List[T]]:
+		"""
+		Returns clusters of intervals: an interval belongs to a cluster if it does not start later than the end of the
+		cluster plus the provided gap tolerance. With a tolerance of 0 overlapping and touching intervals are clustered,
+		a positive tolerance also clusters nearly adjacent intervals. Clusters and their items are sorted by start time.
+
+		:param gap: gap tolerance
+		:return: list of clusters
+		"""
+		clusters, cluster_end = [], None
+		for interval in self.sorted():
+			if cluster_end is not None and interval.start <= cluster_end + gap:
+				clusters[-1].append( interval.item )
+				cluster_end = max( cluster_end, interval.end )
+			else:
+				clusters.append( [ interval.item ] )
+				cluster_end = interval.end
+
+		return clusters
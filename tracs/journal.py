@@ -0,0 +1,99 @@
+
+from __future__ import annotations
+
+from datetime import datetime
+from logging import getLogger
+from threading import Lock
+from typing import Any, Dict, List, Optional, Tuple
+
+from dateutil.tz import UTC
+from fs.base import FS
+from orjson import dumps, loads, OPT_APPEND_NEWLINE
+
+from tracs.resources import Resource
+
+log = getLogger( __name__ )
+
+JOURNAL_DIRNAME = 'imports'
+
+EVENT_START = 'start'
+EVENT_FETCHED = 'fetched'
+EVENT_DOWNLOADED = 'downloaded'
+EVENT_UPSERTED = 'upserted'
+EVENT_COMMITTED = 'committed'
+
+class ImportJournal:
+	"""
+	Checkpoint journal of an import, one per service, kept as JSON lines in the var area. It records fetched summaries,
+	which summaries have been downloaded (including the persisted resources) and which ones have been added to the db.
+	The journal is removed after an import has completed, an existing journal therefore denotes an interrupted import.
+	"""
+
+	def __init__( self, fs: FS, name: str ):
+		self.fs = fs
+		self.name = name
+		self.path = f'/{JOURNAL_DIRNAME}/{name}.jsonl'
+		self._lock = Lock()
+
+	def exists( self ) -> bool:
+		return self.fs.exists( self.path )
+
+	def start( self, summaries: List[Resource] ) -> None:
+		self.fs.makedirs( JOURNAL_DIRNAME, recreate=True )
+		self.fs.writebytes( self.path, b'' )
+		self._write( EVENT_START, time=datetime.now( UTC ).isoformat() )
+		for s in summaries:
+			self._write( EVENT_FETCHED, summary=s.to_dict() )
+
+	def downloaded( self, summary: Resource, resources: List[Resource] ) -> None:
+		self._write( EVENT_DOWNLOADED, summary=summary.to_dict(), resources=[ r.to_dict() for r in resources ] )
+
+	def upserted( self, summary: Resource ) -> None:
+		self._write( EVENT_UPSERTED, summary=summary.to_dict() )
+
+	def committed( self ) -> None:
+		self._write( EVENT_COMMITTED, time=datetime.now( UTC ).isoformat() )
+
+	def complete( self ) -> None:
+		with self._lock:
+			if self.fs.exists( self.path ):
+				self.fs.remove( self.path )
+
+	def load( self ) -> Tuple[List[Resource], Dict[Tuple[str, str], List[Resource]]]:
+		"""
+		Reads the journal and returns the list of fetched summaries together with the resources of all summaries which
+		have been downloaded completely, keyed by uid and path of the summary. Summaries which have been upserted and
+		committed to the db are left out, these don't need to be imported again.
+
+		:return: tuple of summaries and downloaded resources
+		"""
+		summaries, downloaded, upserted, committed = [], {}, [], set()
+		for line in self.fs.readbytes( self.path ).splitlines():
+			try:
+				entry: Dict[str, Any] = loads( line )
+			except ValueError:
+				log.warning( f'skipping damaged entry in import journal {self.path}' ) # might happen when the last write was interrupted
+				continue
+
+			if entry.get( 'event' ) == EVENT_FETCHED:
+				summaries.append( Resource.from_dict( entry['summary'] ) )
+			elif entry.get( 'event' ) == EVENT_DOWNLOADED:
+				downloaded[_key( entry['summary'] )] = [ Resource.from_dict( r ) for r in entry['resources'] ]
+			elif entry.get( 'event' ) == EVENT_UPSERTED:
+				upserted.append( _key( entry['summary'] ) )
+			elif entry.get( 'event' ) == EVENT_COMMITTED:
+				committed.update( upserted )
+				upserted = []
+
+		summaries = [ s for s in summaries if _key( s.to_dict() ) not in committed ]
+		return summaries, { k: v for k, v in downloaded.items() if k not in committed }
+
+	def downloaded_resources( self, downloaded: Dict[Tuple[str, str], List[Resource]], summary: Resource ) -> Optional[List[Resource]]:
+		return downloaded.get( _key( summary.to_dict() ) )
+
+	def _write( self, event: str, **kwargs ) -> None:
+		with self._lock:
+			self.fs.appendbytes( self.path, dumps( { 'event': event, **kwargs }, option=OPT_APPEND_NEWLINE ) )
+
+def _key( summary: Dict[str, Any] ) -> Tuple[str, str]:
+	return summary.get( 'uid' ), summary.get( 'path' )
@@ -0,0 +1,194 @@
+
+from __future__ import annotations
+
+from concurrent.futures import Future
+from logging import getLogger
+from queue import Queue
+from threading import current_thread, Lock, Thread
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from attrs import define, field
+
+log = getLogger( __name__ )
+
+DEFAULT_QUEUE_SIZE = 16
+
+_DONE = object() # sentinel, signals that no more items will follow
+_DROPPED = object() # marker for items which have been dropped by a stage
+_WAKEUP = object() # wakes up a coordinator when one of the futures it is waiting for is done
+
+@define
+class StageMetrics:
+
+	name: str = field( default=None )
+	processed: int = field( default=0 )
+	dropped: int = field( default=0 )
+	errors: int = field( default=0 )
+	busy: float = field( default=0.0 ) # seconds spent in the stage function, summed up over all workers
+	queue_depth: int = field( default=0 ) # current number of items waiting in front of the stage
+	max_queue_depth: int = field( default=0 )
+
+	@property
+	def throughput( self ) -> float:
+		"""
+		Number of items processed per second of busy time.
+		"""
+		return self.processed / self.busy if self.busy > 0 else 0.0
+
+	def __str__( self ) -> str:
+		return f'{self.name}: {self.processed} items ({self.dropped} dropped, {self.errors} errors), ' \
+		       f'{self.throughput:.1f} items/s, queue depth {self.queue_depth}/{self.max_queue_depth} (current/max)'
+
+@define
+class Stage:
+	"""
+	A single step of a pipeline. The stage function is called for each item and returns the item for the next stage,
+	returning None drops the item. Stages run on threads: a stage which needs to do heavy computation can delegate
+	work to a process pool from within its function.
+	"""
+
+	name: str = field( default=None )
+	fn: Callable[[Any], Any] = field( default=None )
+	workers: int = field( default=1 )
+
+class Pipeline:
+	"""
+	Runs items through a sequence of stages which are connected by bounded queues. The sink is called on the calling
+	thread, in the order in which items have been provided, regardless of the number of workers per stage.
+	"""
+
+	def __init__( self, *stages: Stage, queue_size: int = DEFAULT_QUEUE_SIZE ):
+		self.stages: List[Stage] = list( stages )
+		self.queue_size = max( queue_size, 1 )
+		self.metrics: Dict[str, StageMetrics] = { s.name: StageMetrics( name=s.name ) for s in self.stages }
+		self.metrics['sink'] = StageMetrics( name='sink' )
+		self._lock = Lock()
+
+	def run( self, items: Iterable[Any], sink: Callable[[Any], None] ) -> Dict[str, StageMetrics]:
+		queues = [ Queue( maxsize=self.queue_size ) for _ in range( len( self.stages ) + 1 ) ]
+		names = [ *[s.name for s in self.stages], 'sink' ]
+		threads = [ Thread( target=self._feed, args=( items, queues[0], names[0] ), daemon=True ) ]
+
+		for index, stage in enumerate( self.stages ):
+			remaining = [ max( stage.workers, 1 ) ]
+			for _ in range( max( stage.workers, 1 ) ):
+				args = ( stage, queues[index], queues[index + 1], names[index + 1], remaining )
+				threads.append( Thread( target=self._work, args=args, name=f'pipeline-{stage.name}', daemon=True ) )
+
+		[ t.start() for t in threads ]
+
+		# reorder results, so the sink sees items in the order in which they have been fed
+		pending, next_seq, metrics = {}, 0, self.metrics['sink']
+		while ( entry := queues[-1].get() ) is not _DONE:
+			self._update_depth( metrics, queues[-1], False )
+			pending[entry[0]] = entry[1]
+			while next_seq in pending:
+				if ( item := pending.pop( next_seq ) ) is not _DROPPED:
+					self._call( metrics, sink, item, next_seq, count_drops=False )
+				next_seq += 1
+
+		[ t.join() for t in threads ]
+		return self.metrics
+
+	@property
+	def errors( self ) -> int:
+		"""
+		Number of items which failed in any stage (including the sink), failed items are dropped.
+		"""
+		return sum( m.errors for m in self.metrics.values() )
+
+	def _feed( self, items: Iterable[Any], queue: Queue, name: str ) -> None:
+		try:
+			for seq, item in enumerate( items ):
+				self._put( queue, ( seq, item ), name )
+		except Exception:
+			log.error( 'error feeding items into pipeline', exc_info=True )
+		finally:
+			queue.put( _DONE )
+
+	def _work( self, stage: Stage, inbox: Queue, outbox: Queue, next_name: str, remaining: List[int] ) -> None:
+		metrics = self.metrics[stage.name]
+		while ( entry := inbox.get() ) is not _DONE:
+			self._update_depth( metrics, inbox, False )
+			seq, item = entry
+			if item is not _DROPPED:
+				item = self._call( metrics, stage.fn, item, seq )
+			self._put( outbox, ( seq, _DROPPED if item is None else item ), next_name )
+
+		# let sibling workers see the end of the input, the last worker signals the next stage
+		with self._lock:
+			remaining[0] -= 1
+			last = remaining[0] == 0
+		outbox.put( _DONE ) if last else inbox.put( _DONE )
+
+	def _call( self, metrics: StageMetrics, fn: Callable, item: Any, seq: int, count_drops: bool = True ) -> Any:
+		start = perf_counter()
+		try:
+			result = fn( item )
+		except Exception:
+			log.error( f'error processing item #{seq} in pipeline stage {metrics.name}', exc_info=True )
+			result, errors = None, 1
+		else:
+			errors = 0
+
+		with self._lock:
+			metrics.busy += perf_counter() - start
+			metrics.processed += 1
+			metrics.errors += errors
+			metrics.dropped += 1 if result is None and count_drops else 0
+		return result
+
+	def _put( self, queue: Queue, entry: Any, name: str ) -> None:
+		queue.put( entry )
+		self._update_depth( self.metrics[name], queue, True )
+
+	def _update_depth( self, metrics: StageMetrics, queue: Queue, track_max: bool ) -> None:
+		with self._lock:
+			metrics.queue_depth = queue.qsize()
+			if track_max:
+				metrics.max_queue_depth = max( metrics.max_queue_depth, metrics.queue_depth )
+
+class Coordinator:
+	"""
+	Serializes calls on a single thread: calls submitted from other threads are queued and carried out one after the
+	other by the thread which has created the coordinator, as soon as it runs the coordinator loop. The submitting
+	thread waits for the result. Calls from the coordinator thread itself or after the loop has finished are carried
+	out right away. This allows several concurrent imports to mutate the db without locking it.
+	"""
+
+	def __init__( self ):
+		self._queue: Queue = Queue()
+		self._owner: Optional[Thread] = current_thread()
+
+	def submit( self, fn: Callable, *args, **kwargs ) -> Any:
+		if self._owner is None or self._owner is current_thread():
+			return fn( *args, **kwargs )
+
+		future = Future()
+		self._queue.put( ( future, fn, args, kwargs ) )
+		return future.result()
+
+	def run( self, futures: Iterable[Future] ) -> None:
+		"""
+		Runs the coordinator loop until all provided futures are done.
+
+		:param futures: futures of the jobs submitting calls to this coordinator
+		"""
+		futures = list( futures )
+		for f in futures:
+			f.add_done_callback( lambda _: self._queue.put( _WAKEUP ) )
+
+		try:
+			while not all( f.done() for f in futures ):
+				if ( entry := self._queue.get() ) is not _WAKEUP:
+					self._call( *entry )
+		finally:
+			self._owner = None
+
+	# noinspection PyMethodMayBeStatic
+	def _call( self, future: Future, fn: Callable, args: tuple, kwargs: dict ) -> None:
+		try:
+			future.set_result( fn( *args, **kwargs ) )
+		except Exception as e:
+			future.set_exception( e )
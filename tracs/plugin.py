@@ -25,6 +25,8 @@ class Plugin:
 				self._cfg = DynaBox()
 
 			try:
+				if self._ctx.state.plugins.get( self.name ) is None: # empty state areas are None, attach a new box to make state writable
+					self._ctx.state.plugins[self.name] = DynaBox()
 				self._state: DynaBox = self._ctx.state.plugins[self.name]
 			except AttributeError:
 				self._state = DynaBox()
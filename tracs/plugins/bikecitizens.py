@@ -8,16 +8,17 @@ from attrs import define, field
 from bs4 import BeautifulSoup
 from dateutil.parser import parse
 from dateutil.tz import tzlocal
-from requests import options, Session
+from requests import options
 from rich.prompt import Prompt
 
 from tracs.activity import Activity
 from tracs.activity_types import ActivityTypes
+from tracs.cache import HttpCache
 from tracs.config import ApplicationContext, APPNAME
 from tracs.pluginmgr import importer, resourcetype, service, setup
 from tracs.plugins.json import DataclassFactoryHandler, JSONHandler
 from tracs.resources import Resource
-from tracs.service import Service
+from tracs.service import DOWNLOAD_CHUNK_SIZE, Service
 from .gpx import GPX_TYPE
 
 log = getLogger( __name__ )
@@ -187,7 +188,7 @@ class Bikecitizens( Service ):
 			return self.logged_in
 
 		if not self._session:
-			self._session = Session()
+			self._session = HttpCache.for_context( self.ctx, self.name )
 
 		# session restore does not yet work
 		#		if self.name in self._state:
@@ -258,7 +259,7 @@ class Bikecitizens( Service ):
 		try:
 			url = self.tracks_url( range_from=kwargs.get( 'range_from' ) , range_to=kwargs.get( 'range_to' ) )
 			response = options( url=url, headers=HEADERS_OPTIONS )
-			json_list = self.json_handler.load( url=url, headers={ **HEADERS_OPTIONS, **{ 'X-API-Key': self._api_key } }, session=self._session )
+			json_list = self.json_handler.load( url=url, headers={ **HEADERS_OPTIONS, **{ 'X-API-Key': self._api_key } }, session=self._session, expire_after=self._session.policy.expire_after(), refresh=force )
 
 			resources = [
 				self.importer.save_to_resource(
@@ -296,24 +297,27 @@ class Bikecitizens( Service ):
 			)
 		]
 
+		known = self._db.known_resources( resources ) if not force else set()
 		for r in resources:
-			if r not in self._db.resources or force:
+			if r not in known:
 				try:
-					self.download_resource( r )
+					self.download_resource( r, pretend=pretend )
 				except RuntimeError:
 					log.error( f'error fetching resource from {r.source}', exc_info=True )
 			else:
 				log.info( f'skipping download from {r.source}, resource already exists' )
 
-		return [ r for r in resources if r.content ]
+		return [ r for r in resources if r.content or r.digest ]
 
 	def download_resource( self, resource: Resource, **kwargs ) -> Tuple[Any, int]:
 		log.debug( f'downloading resource from {resource.source}' )
 		# noinspection PyUnusedLocal
 		response = options( resource.source, headers=HEADERS_OPTIONS )
-		response = self._session.get( resource.source, headers={ **HEADERS_OPTIONS, **{ 'X-API-Key': self._api_key } } )
-		resource.content, resource.text, resource.status = response.content, response.text, response.status_code
-		return response.content, response.status_code
+		response = self._session.get( resource.source, headers={ **HEADERS_OPTIONS, **{ 'X-API-Key': self._api_key } }, stream=True, expire_after=self._session.policy.expire_after( download=True ) )
+		resource.status = response.status_code
+		if response.status_code == 200:
+			self.stream_resource( resource, response.iter_content( chunk_size=DOWNLOAD_CHUNK_SIZE ), pretend=kwargs.get( 'pretend', False ) )
+		return resource.content, response.status_code
 
 	def url_for_id( self, local_id: Union[int, str] ) -> Optional[str]:
 		return f'https://api.bikecitizens.net/api/v1/tracks/{local_id}'
@@ -1,6 +1,5 @@
-
-from csv import field_size_limit, reader as csv_reader
-from typing import Any, Union
+from csv import Error as CSVError, reader as csv_reader
+from typing import Any, Iterator, List, Tuple, Union
 
 from tracs.handlers import ResourceHandler
 from tracs.pluginmgr import importer, resourcetype
@@ -21,12 +20,18 @@ class CSVHandler( ResourceHandler ):
 
 	TYPE: str = CSV_TYPE
 
-	def __init__( self, *args, **kwargs ) -> None:
+	def __init__( self, *args, field_size_limit: int = DEFAULT_FIELD_SIZE_LIMIT, **kwargs ) -> None:
 		super().__init__( *args, **kwargs )
-		self._field_size_limit = kwargs.get( 'field_size_limit', DEFAULT_FIELD_SIZE_LIMIT ) # keep this later use
+		self._field_size_limit = field_size_limit
 
 	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
-		return [ r for r in csv_reader( self.as_str( content ).splitlines() ) ]
+		return list( self.rows( content ) )
+
+	def rows( self, content: Union[bytes,str] ) -> Iterator[List[str]]:
+		"""
+		Lazily yields the rows of the provided content, honouring the field size limit of this handler.
+		"""
+		return read_csv( content, field_size_limit=self._field_size_limit )
 
 	@property
 	def field_size_limit( self ) -> int:
@@ -35,4 +40,87 @@ class CSVHandler( ResourceHandler ):
 	@field_size_limit.setter
 	def field_size_limit( self, limit: int ) -> None:
 		self._field_size_limit = limit
-		field_size_limit( self._field_size_limit )
+
+def read_csv( content: Union[bytes,str], field_size_limit: int = DEFAULT_FIELD_SIZE_LIMIT, delimiter: str = ',', encoding: str = 'UTF-8' ) -> Iterator[List[str]]:
+	"""
+	Incremental CSV reader working on the provided content: csv.reader() is run over a lazy line iterator, so rows are
+	decoded and split one by one when they are requested. Unlike with csv.reader(), the field size limit is passed per
+	call instead of being a process-wide setting: records rejected by csv.reader(), i.e. because of fields beyond the
+	process-wide limit, are read by a fallback and checked against the provided limit.
+
+	:param content: CSV content as bytes or str
+	:param field_size_limit: maximum size of a single field
+	:param delimiter: field delimiter
+	:param encoding: encoding used to decode content
+	:return: iterator over rows, each row being a list of fields
+	:raise: csv.Error, if a field exceeds the field size limit
+	"""
+	text = content.decode( encoding ) if isinstance( content, (bytes, bytearray, memoryview) ) else content
+	lines = _Lines( text )
+	records, start = csv_reader( lines, delimiter=delimiter ), 0
+
+	while True:
+		try:
+			row = next( records )
+		except StopIteration:
+			return
+		except CSVError:
+			row, lines.position = _read_record( text, start, delimiter )
+			records = csv_reader( lines, delimiter=delimiter )
+
+		# no field can be larger than its record, so fields only need to be checked for long records
+		if lines.position - start > field_size_limit and any( len( f ) > field_size_limit for f in row ):
+			raise CSVError( f'field larger than field limit ({field_size_limit})' )
+
+		start = lines.position
+		yield row
+
+class _Lines:
+	"""
+	Iterator over the lines of a text, including line endings, keeping track of the position after the last line.
+	"""
+
+	def __init__( self, text: str ):
+		self.text = text
+		self.position = 0
+
+	def __iter__( self ) -> Iterator[str]:
+		return self
+
+	def __next__( self ) -> str:
+		if self.position >= len( self.text ):
+			raise StopIteration
+
+		end = self.text.find( '\n', self.position )
+		end = len( self.text ) if end == -1 else end + 1
+		line, self.position = self.text[self.position:end], end
+		return line
+
+def _read_record( text: str, start: int, delimiter: str ) -> Tuple[List[str], int]:
+	"""
+	Reads the record starting at the provided position like csv.reader() does, but without limiting the size of fields.
+	A quote only opens a quoted field when it is the first character of a field, any other quote is taken literally.
+
+	:return: fields of the record and the position right after its end
+	"""
+	fields, index, length = [], start, len( text )
+	while True:
+		field = ''
+		if text.startswith( '"', index ):
+			# quoted field: read up to the closing quote, doubled quotes are escaped quotes
+			parts, index = [], index + 1
+			while ( quote := text.find( '"', index ) ) != -1 and text.startswith( '"', quote + 1 ):
+				parts.append( text[index:quote + 1] )
+				index = quote + 2
+			quote = length if quote == -1 else quote # like csv.reader(), an unterminated field ends with the data
+			parts.append( text[index:quote] )
+			field, index = ''.join( parts ), quote + 1
+
+		# unquoted field or remainder after a closing quote, which is appended like with csv.reader()
+		end = min( e if ( e := text.find( c, index ) ) != -1 else length for c in [ delimiter, '\n', '\r' ] )
+		fields.append( field + text[index:end] )
+
+		if end < length and text[end] == delimiter:
+			index = end + 1
+		else:
+			return fields, end + 2 if text.startswith( '\r\n', end ) else end + 1
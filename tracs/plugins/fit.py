@@ -1,23 +1,428 @@
-
+from array import array
+from datetime import datetime, timedelta
 from logging import getLogger
-from typing import Any
+from math import isnan, nan
+from struct import calcsize, error as StructError, Struct, unpack_from
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from attrs import define, field
+from dateutil.tz import tzlocal, UTC
 
 from tracs.activity import Activity
+from tracs.activity_types import ActivityTypes
+from tracs.errors import ResourceImportException
 from tracs.handlers import ResourceHandler
 from tracs.pluginmgr import importer, resourcetype
+from tracs.resources import Resource, ResourceType
 
 log = getLogger( __name__ )
 
 FIT_TYPE = 'application/fit'
 
-@resourcetype( type=FIT_TYPE )
-class FITActivity( Activity ):
+FIT_EPOCH = 631065600 # 1989-12-31T00:00:00Z, FIT timestamps are seconds since this date
+SEMICIRCLES = 2 ** 31 / 180 # semicircles per degree
+
+# global message numbers
+MESG_FILE_ID = 0
+MESG_SESSION = 18
+MESG_LAP = 19
+MESG_RECORD = 20
+MESG_FIELD_DESCRIPTION = 206
+
+FIELD_TIMESTAMP = 253
+
+# base types: struct format character, size and invalid value
+BASE_TYPES: Dict[int, Tuple[str, int, Any]] = {
+	0x00: ( 'B', 1, 0xFF ), # enum
+	0x01: ( 'b', 1, 0x7F ), # sint8
+	0x02: ( 'B', 1, 0xFF ), # uint8
+	0x83: ( 'h', 2, 0x7FFF ), # sint16
+	0x84: ( 'H', 2, 0xFFFF ), # uint16
+	0x85: ( 'i', 4, 0x7FFFFFFF ), # sint32
+	0x86: ( 'I', 4, 0xFFFFFFFF ), # uint32
+	0x07: ( 's', 1, None ), # string
+	0x88: ( 'f', 4, None ), # float32, invalid is NaN
+	0x89: ( 'd', 8, None ), # float64, invalid is NaN
+	0x0A: ( 'B', 1, 0x00 ), # uint8z
+	0x8B: ( 'H', 2, 0x0000 ), # uint16z
+	0x8C: ( 'I', 4, 0x00000000 ), # uint32z
+	0x0D: ( 's', 1, None ), # byte
+	0x8E: ( 'q', 8, 0x7FFFFFFFFFFFFFFF ), # sint64
+	0x8F: ( 'Q', 8, 0xFFFFFFFFFFFFFFFF ), # uint64
+	0x90: ( 'Q', 8, 0x0000000000000000 ), # uint64z
+}
+
+# profile of the messages which are decoded: field number -> name, scale, offset
+
+RECORD_FIELDS: Dict[int, Tuple[str, float, float]] = {
+	0: ( 'lat', SEMICIRCLES, 0 ),
+	1: ( 'lon', SEMICIRCLES, 0 ),
+	2: ( 'alt', 5, 500 ),
+	3: ( 'hr', 1, 0 ),
+	4: ( 'cadence', 1, 0 ),
+	5: ( 'distance', 100, 0 ),
+	6: ( 'speed', 1000, 0 ),
+	7: ( 'power', 1, 0 ),
+	73: ( 'speed', 1000, 0 ), # enhanced_speed
+	78: ( 'alt', 5, 500 ), # enhanced_altitude
+}
+
+SESSION_FIELDS: Dict[int, Tuple[str, float, float]] = {
+	253: ( 'timestamp', 1, 0 ),
+	2: ( 'start_time', 1, 0 ),
+	3: ( 'start_position_lat', SEMICIRCLES, 0 ),
+	4: ( 'start_position_long', SEMICIRCLES, 0 ),
+	5: ( 'sport', 1, 0 ),
+	6: ( 'sub_sport', 1, 0 ),
+	7: ( 'total_elapsed_time', 1000, 0 ),
+	8: ( 'total_timer_time', 1000, 0 ),
+	9: ( 'total_distance', 100, 0 ),
+	11: ( 'total_calories', 1, 0 ),
+	14: ( 'avg_speed', 1000, 0 ),
+	15: ( 'max_speed', 1000, 0 ),
+	16: ( 'avg_heart_rate', 1, 0 ),
+	17: ( 'max_heart_rate', 1, 0 ),
+	22: ( 'total_ascent', 1, 0 ),
+	23: ( 'total_descent', 1, 0 ),
+	64: ( 'min_heart_rate', 1, 0 ),
+	124: ( 'avg_speed', 1000, 0 ), # enhanced_avg_speed
+	125: ( 'max_speed', 1000, 0 ), # enhanced_max_speed
+}
+
+LAP_FIELDS: Dict[int, Tuple[str, float, float]] = {
+	253: ( 'timestamp', 1, 0 ),
+	2: ( 'start_time', 1, 0 ),
+	3: ( 'start_position_lat', SEMICIRCLES, 0 ),
+	4: ( 'start_position_long', SEMICIRCLES, 0 ),
+	5: ( 'end_position_lat', SEMICIRCLES, 0 ),
+	6: ( 'end_position_long', SEMICIRCLES, 0 ),
+	7: ( 'total_elapsed_time', 1000, 0 ),
+	8: ( 'total_timer_time', 1000, 0 ),
+	9: ( 'total_distance', 100, 0 ),
+	11: ( 'total_calories', 1, 0 ),
+	13: ( 'avg_speed', 1000, 0 ),
+	14: ( 'max_speed', 1000, 0 ),
+	15: ( 'avg_heart_rate', 1, 0 ),
+	16: ( 'max_heart_rate', 1, 0 ),
+	21: ( 'total_ascent', 1, 0 ),
+	22: ( 'total_descent', 1, 0 ),
+	25: ( 'sport', 1, 0 ),
+}
+
+FILE_ID_FIELDS: Dict[int, Tuple[str, float, float]] = {
+	0: ( 'type', 1, 0 ),
+	1: ( 'manufacturer', 1, 0 ),
+	2: ( 'product', 1, 0 ),
+	3: ( 'serial_number', 1, 0 ),
+	4: ( 'time_created', 1, 0 ),
+}
+
+FIELD_DESCRIPTION_FIELDS: Dict[int, Tuple[str, float, float]] = {
+	0: ( 'developer_data_index', 1, 0 ),
+	1: ( 'field_definition_number', 1, 0 ),
+	2: ( 'fit_base_type_id', 1, 0 ),
+	3: ( 'field_name', 1, 0 ),
+	6: ( 'scale', 1, 0 ),
+	7: ( 'offset', 1, 0 ),
+	8: ( 'units', 1, 0 ),
+}
+
+MESSAGE_FIELDS = {
+	MESG_FILE_ID: FILE_ID_FIELDS,
+	MESG_SESSION: SESSION_FIELDS,
+	MESG_LAP: LAP_FIELDS,
+	MESG_FIELD_DESCRIPTION: FIELD_DESCRIPTION_FIELDS,
+}
+
+TIME_FIELDS = [ 'timestamp', 'start_time', 'time_created' ]
+
+RECORD_COLUMNS = [ 'time', 'lat', 'lon', 'alt', 'hr', 'cadence', 'distance', 'speed', 'power' ]
+
+SPORTS: Dict[int, ActivityTypes] = {
+	1: ActivityTypes.run,
+	2: ActivityTypes.bike,
+	4: ActivityTypes.gym,
+	5: ActivityTypes.swim,
+	10: ActivityTypes.gym,
+	11: ActivityTypes.walk,
+	12: ActivityTypes.xcski,
+	13: ActivityTypes.ski,
+	14: ActivityTypes.snowboard,
+	15: ActivityTypes.row,
+	17: ActivityTypes.hiking,
+	19: ActivityTypes.paddle,
+	37: ActivityTypes.paddle_standup,
+	43: ActivityTypes.surf_wind,
+}
+
+# sub sports refining the sport of a session, keyed by sport and sub sport
+SUB_SPORTS: Dict[Tuple[int, int], ActivityTypes] = {
+	( 10, 43 ): ActivityTypes.yoga, # training/yoga
+}
+
+@resourcetype
+def fit_resource_type() -> ResourceType:
+	return ResourceType( type=FIT_TYPE, recording=True )
+
+@define
+class FITData:
+	"""
+	Decoded FIT file: record messages are stored column-wise as arrays of doubles (times are seconds since epoch, missing
+	values are NaN), developer fields of records are stored as additional columns by field name. File id, session and
+	lap messages are kept as dicts, having times converted to datetimes and values scaled to their units.
+	"""
+
+	time: array = field( factory=lambda: array( 'd' ) )
+	lat: array = field( factory=lambda: array( 'd' ) )
+	lon: array = field( factory=lambda: array( 'd' ) )
+	alt: array = field( factory=lambda: array( 'd' ) )
+	hr: array = field( factory=lambda: array( 'd' ) )
+	cadence: array = field( factory=lambda: array( 'd' ) )
+	distance: array = field( factory=lambda: array( 'd' ) )
+	speed: array = field( factory=lambda: array( 'd' ) )
+	power: array = field( factory=lambda: array( 'd' ) )
+	developer: Dict[str, array] = field( factory=dict )
+
+	file_id: Dict[str, Any] = field( factory=dict )
+	sessions: List[Dict[str, Any]] = field( factory=list )
+	laps: List[Dict[str, Any]] = field( factory=list )
+
+	def __len__( self ) -> int:
+		return len( self.time )
+
+	def first( self, column: str ) -> Optional[float]:
+		return next( ( v for v in getattr( self, column ) if not isnan( v ) ), None )
+
+	def last( self, column: str ) -> Optional[float]:
+		return next( ( v for v in reversed( getattr( self, column ) ) if not isnan( v ) ), None )
+
+@define
+class Definition:
+	"""
+	Definition message, contains a precompiled unpacker for the data messages of a local message type.
+	"""
+
+	mesg_num: int = field( default=None )
+	unpacker: Struct = field( default=None )
+	fields: List[Tuple[int, int, Any]] = field( factory=list ) # field number, index in unpacked values, invalid value
+	developer_fields: List[Tuple[Dict[str, Any], int]] = field( factory=list ) # field description, index in unpacked values
+	timestamp: Optional[int] = field( default=None ) # index of the timestamp field
+	record_plan: List[Tuple[Any, int, Any, float, float]] = field( factory=list ) # column append, index, invalid, scale, offset
+	record_missing: List[Any] = field( factory=list ) # appends of columns not contained in this definition
+
+def decode_fit( content: Union[bytes, bytearray, memoryview] ) -> FITData:
+	"""
+	Decodes a FIT file. Data messages are read straight from a memoryview with the unpacker of their definition message.
+	Compressed timestamp headers, developer fields and chained files are supported, CRCs are not verified.
+
+	:param content: FIT file content
+	:return: decoded data
+	:raise: ValueError, if content is not a valid FIT file
+	"""
+	view, data = memoryview( content ), FITData()
+	columns = { c: getattr( data, c ) for c in RECORD_COLUMNS }
+	descriptions: Dict[Tuple[int, int], Dict[str, Any]] = {}
+	definitions: Dict[int, Definition] = {}
+	timestamp, offset = 0, 0 # last timestamp, in FIT seconds
+
+	while offset < len( view ):
+		if len( view ) - offset < 12 or bytes( view[offset + 8:offset + 12] ) != b'.FIT':
+			if offset == 0:
+				raise ValueError( 'not a FIT file, header is missing' )
+			log.debug( f'ignoring {len( view ) - offset} trailing bytes after FIT data' )
+			break
+
+		header_size, data_size = view[offset], unpack_from( '<I', view, offset + 4 )[0]
+		offset, end = offset + header_size, offset + header_size + data_size
+		if end > len( view ):
+			raise ValueError( 'FIT file is truncated' )
 
-	def __raw_init__( self, raw: Any ) -> None:
-		pass
+		try:
+			while offset < end:
+				header = view[offset]
+				offset += 1
+
+				if header & 0x80: # compressed timestamp header
+					local, time_offset = ( header >> 5 ) & 0x03, header & 0x1F
+					timestamp = ( timestamp & ~0x1F ) + time_offset + ( 0x20 if time_offset < ( timestamp & 0x1F ) else 0 )
+					compressed = True
+				elif header & 0x40: # definition message
+					definitions[header & 0x0F], offset = _definition( view, offset, bool( header & 0x20 ), descriptions, columns, data )
+					continue
+				else:
+					local, compressed = header & 0x0F, False
+
+				if ( definition := definitions.get( local ) ) is None:
+					raise ValueError( f'data message for undefined local message type {local}' )
+
+				values = definition.unpacker.unpack_from( view, offset )
+				offset += definition.unpacker.size
+
+				if not compressed and definition.timestamp is not None and values[definition.timestamp] != 0xFFFFFFFF:
+					timestamp = values[definition.timestamp]
+
+				if definition.mesg_num == MESG_RECORD:
+					data.time.append( timestamp + FIT_EPOCH if ( compressed or definition.timestamp is not None ) else nan )
+					for append, index, invalid, scale, value_offset in definition.record_plan:
+						v = values[index]
+						append( nan if v == invalid or v != v else v / scale - value_offset )
+					for append in definition.record_missing:
+						append( nan )
+					for description, index in definition.developer_fields:
+						_append_developer( data, description, values[index], len( data.time ) - 1 )
+
+				elif fields := MESSAGE_FIELDS.get( definition.mesg_num ):
+					message = _message( definition, values, fields )
+					if definition.mesg_num == MESG_SESSION:
+						data.sessions.append( message )
+					elif definition.mesg_num == MESG_LAP:
+						data.laps.append( message )
+					elif definition.mesg_num == MESG_FILE_ID:
+						data.file_id = message
+					elif definition.mesg_num == MESG_FIELD_DESCRIPTION:
+						descriptions[( message.get( 'developer_data_index' ), message.get( 'field_definition_number' ) )] = message
+
+		except StructError as error:
+			raise ValueError( 'FIT file is truncated' ) from error
+
+		offset = end + 2 # skip file crc
+
+	# developer columns have the same length as all other columns
+	for column in data.developer.values():
+		column.extend( [nan] * ( len( data.time ) - len( column ) ) )
+
+	return data
 
 @importer( type=FIT_TYPE )
 class FITImporter( ResourceHandler ):
 
 	TYPE: str = FIT_TYPE
-	ACTIVITY_CLS = FITActivity
+
+	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
+		return decode_fit( content )
+
+	def as_activity( self, resource: Resource ) -> Optional[Activity]:
+		fit: FITData = resource.raw if isinstance( resource.raw, FITData ) else decode_fit( resource.content )
+		sessions = fit.sessions or fit.laps # laps serve as fallback for files without sessions
+
+		if not ( starttime := _first( sessions, 'start_time' ) or _datetime( fit.first( 'time' ) ) ):
+			raise ResourceImportException( 'FIT file does not contain any timed records or sessions', None )
+
+		elapsed = _sum( sessions, 'total_elapsed_time' )
+		endtime = max( [ t for t in [ _datetime( fit.last( 'time' ) ), starttime + timedelta( seconds=elapsed ) if elapsed else None ] if t ], default=starttime )
+		sport = next( ( s for s in sessions if s.get( 'sport' ) is not None ), {} )
+
+		activity = Activity(
+			type=SUB_SPORTS.get( ( sport.get( 'sport' ), sport.get( 'sub_sport' ) ) ) or SPORTS.get( sport.get( 'sport' ) ),
+			starttime=starttime,
+			endtime=endtime,
+			starttime_local=starttime.astimezone( tzlocal() ),
+			endtime_local=endtime.astimezone( tzlocal() ),
+			duration=timedelta( seconds=round( elapsed ) ) if elapsed else endtime - starttime,
+			duration_moving=timedelta( seconds=round( timer ) ) if ( timer := _sum( sessions, 'total_timer_time' ) ) else None,
+			distance=round( d, 1 ) if ( d := _sum( sessions, 'total_distance' ) or fit.last( 'distance' ) ) else None,
+			ascent=_sum( sessions, 'total_ascent' ),
+			descent=_sum( sessions, 'total_descent' ),
+			calories=_sum( sessions, 'total_calories' ),
+			heartrate=_first( sessions, 'avg_heart_rate' ),
+			heartrate_max=_max( sessions, 'max_heart_rate' ),
+			heartrate_min=_first( sessions, 'min_heart_rate' ),
+			speed=_first( sessions, 'avg_speed' ),
+			speed_max=_max( sessions, 'max_speed' ),
+			elevation_max=max( altitudes ) if ( altitudes := [ a for a in fit.alt if not isnan( a ) ] ) else None,
+			elevation_min=min( altitudes ) if altitudes else None,
+			location_latitude_start=fit.first( 'lat' ) or _first( sessions, 'start_position_lat' ),
+			location_longitude_start=fit.first( 'lon' ) or _first( sessions, 'start_position_long' ),
+			location_latitude_end=fit.last( 'lat' ),
+			location_longitude_end=fit.last( 'lon' ),
+			uid=f'fit:{starttime.astimezone( UTC ).strftime( "%y%m%d%H%M%S" )}',
+		)
+
+		return activity
+
+# helpers
+
+def _definition( view: memoryview, offset: int, developer: bool, descriptions: Dict, columns: Dict[str, array], data: FITData ) -> Tuple[Definition, int]:
+	architecture = view[offset + 1]
+	endian = '>' if architecture == 1 else '<'
+	mesg_num, field_count = unpack_from( f'{endian}HB', view, offset + 2 )
+	offset += 5
+
+	definition, formats, index = Definition( mesg_num=mesg_num ), [], 0
+	for field_num, size, base_type in [ tuple( view[o:o + 3] ) for o in range( offset, offset + field_count * 3, 3 ) ]:
+		code, type_size, invalid = BASE_TYPES.get( base_type, ( 's', 1, None ) )
+		if code == 's' or size % type_size != 0:
+			formats.append( f'{size}s' )
+			definition.fields.append( ( field_num, index, None ) )
+			index += 1
+		else:
+			formats.append( f'{size // type_size}{code}' )
+			definition.fields.append( ( field_num, index, invalid ) )
+			index += size // type_size
+	offset += field_count * 3
+
+	if developer:
+		developer_count = view[offset]
+		offset += 1
+		for field_num, size, developer_index in [ tuple( view[o:o + 3] ) for o in range( offset, offset + developer_count * 3, 3 ) ]:
+			description = descriptions.get( ( developer_index, field_num ) )
+			code, type_size, invalid = BASE_TYPES.get( description.get( 'fit_base_type_id' ), ( 's', 1, None ) ) if description else ( 's', 1, None )
+			if description and code != 's' and size == type_size:
+				formats.append( code )
+				definition.developer_fields.append( ( { **description, 'invalid': invalid }, index ) )
+			else:
+				formats.append( f'{size}s' )
+			index += 1
+		offset += developer_count * 3
+
+	definition.unpacker = Struct( endian + ''.join( formats ) )
+	definition.timestamp = next( ( i for n, i, _ in definition.fields if n == FIELD_TIMESTAMP ), None )
+
+	if mesg_num == MESG_RECORD:
+		contained = set()
+		for field_num, field_index, invalid in definition.fields:
+			if ( profile := RECORD_FIELDS.get( field_num ) ) and invalid is not None:
+				name, scale, value_offset = profile
+				if name in contained: # enhanced fields replace their standard counterparts
+					definition.record_plan = [ p for p in definition.record_plan if p[0] != columns[name].append ]
+				definition.record_plan.append( ( columns[name].append, field_index, invalid, scale, value_offset ) )
+				contained.add( name )
+		definition.record_missing = [ columns[c].append for c in RECORD_COLUMNS[1:] if c not in contained ]
+
+	return definition, offset
+
+def _message( definition: Definition, values: Tuple, fields: Dict[int, Tuple[str, float, float]] ) -> Dict[str, Any]:
+	message = {}
+	for field_num, index, invalid in definition.fields:
+		if profile := fields.get( field_num ):
+			name, scale, value_offset = profile
+			v = values[index]
+			if isinstance( v, bytes ):
+				message[name] = v.split( b'\x00', 1 )[0].decode( 'UTF-8', errors='replace' ) or None
+			elif v != invalid and v == v:
+				if name in TIME_FIELDS:
+					message[name] = datetime.fromtimestamp( v + FIT_EPOCH, UTC )
+				else:
+					message[name] = v / scale - value_offset if scale != 1 or value_offset != 0 else v
+	return message
+
+def _append_developer( data: FITData, description: Dict[str, Any], value: Any, index: int ) -> None:
+	name = description.get( 'field_name' ) or f'developer_{description.get( "developer_data_index" )}_{description.get( "field_definition_number" )}'
+	column = data.developer.setdefault( name, array( 'd' ) )
+	column.extend( [nan] * ( index - len( column ) ) )
+	if value == description.get( 'invalid' ) or value != value:
+		column.append( nan )
+	else:
+		column.append( value / ( description.get( 'scale' ) or 1 ) - ( description.get( 'offset' ) or 0 ) )
+
+def _datetime( timestamp: Optional[float] ) -> Optional[datetime]:
+	return datetime.fromtimestamp( timestamp, UTC ) if timestamp is not None else None
+
+def _sum( messages: List[Dict[str, Any]], name: str ) -> Optional[float]:
+	return sum( values ) if ( values := [ m.get( name ) for m in messages if m.get( name ) is not None ] ) else None
+
+def _first( messages: List[Dict[str, Any]], name: str ) -> Optional[Any]:
+	return next( ( m.get( name ) for m in messages if m.get( name ) is not None ), None )
+
+def _max( messages: List[Dict[str, Any]], name: str ) -> Optional[Any]:
+	return max( values ) if ( values := [ m.get( name ) for m in messages if m.get( name ) is not None ] ) else None
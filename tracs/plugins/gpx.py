@@ -1,10 +1,18 @@
-from datetime import timedelta
+from array import array
+from datetime import datetime, timedelta
+from io import BytesIO
 from logging import getLogger
-from typing import Any, Optional, Union
+from math import asin, cos, isnan, nan, pi, radians, sin, sqrt
+from pathlib import Path
+from typing import Any, List, Optional, Tuple, Union
 
+from attrs import define, field
 from dateutil.tz import tzlocal, UTC
+from fs.base import FS
 from gpxpy import parse as parse_gpx
 from gpxpy.gpx import GPX
+from gpxpy.gpxfield import parse_time
+from lxml.etree import iterparse
 
 from tracs.activity import Activity
 from tracs.errors import ResourceImportException
@@ -16,10 +24,128 @@ log = getLogger( __name__ )
 
 GPX_TYPE = 'application/gpx+xml'
 
+EARTH_RADIUS = 6378.137 * 1000 # same values as in gpxpy, so distances are identical
+ONE_DEGREE = ( 2 * pi * EARTH_RADIUS ) / 360
+
 @resourcetype
 def gpx_resource_type() -> ResourceType:
 	return ResourceType( type=GPX_TYPE, recording=True )
 
+@define
+class GPXTracks:
+	"""
+	Track points of all tracks of a GPX document, stored column-wise as arrays of doubles. Times are seconds since epoch,
+	missing values are NaN. Segments contains the index of the first point of each track segment. Bounds, duration and
+	length are calculated in the same way as gpxpy does, but without creating an object per point.
+	"""
+
+	name: Optional[str] = field( default=None )
+	time: array = field( factory=lambda: array( 'd' ) )
+	lat: array = field( factory=lambda: array( 'd' ) )
+	lon: array = field( factory=lambda: array( 'd' ) )
+	ele: array = field( factory=lambda: array( 'd' ) )
+	hr: array = field( factory=lambda: array( 'd' ) )
+	cad: array = field( factory=lambda: array( 'd' ) )
+	segments: List[int] = field( factory=list )
+
+	def __len__( self ) -> int:
+		return len( self.time )
+
+	def segment_ranges( self ) -> List[Tuple[int, int]]:
+		return [ ( start, end ) for start, end in zip( self.segments, [ *self.segments[1:], len( self ) ] ) ]
+
+	def time_bounds( self ) -> Tuple[Optional[datetime], Optional[datetime]]:
+		times = [ t for t in self.time if not isnan( t ) ]
+		return ( _datetime( times[0] ), _datetime( times[-1] ) ) if times else ( None, None )
+
+	def duration( self ) -> Optional[float]:
+		"""
+		Sum of the durations of all segments, None if a segment lacks time data (as in GPX.get_duration()).
+		"""
+		duration = 0.0
+		for start, end in self.segment_ranges():
+			if end - start < 2:
+				continue
+			first = self.time[start] if not isnan( self.time[start] ) else self.time[start + 1]
+			last = self.time[end - 1] if not isnan( self.time[end - 1] ) else self.time[end - 2]
+			if isnan( first ) or isnan( last ) or last < first:
+				return None
+			duration += last - first
+		return duration
+
+	def length_2d( self ) -> float:
+		"""
+		Sum of the 2D lengths of all segments (as in GPX.length_2d()).
+		"""
+		length, lat, lon = 0.0, self.lat, self.lon
+		for start, end in self.segment_ranges():
+			for i in range( start + 1, end ):
+				length += _distance_2d( lat[i], lon[i], lat[i - 1], lon[i - 1] )
+		return length
+
+	@classmethod
+	def from_gpx( cls, gpx: GPX ) -> 'GPXTracks':
+		tracks = GPXTracks( name=gpx.name )
+		for segment in [ s for t in gpx.tracks for s in t.segments ]:
+			tracks.segments.append( len( tracks ) )
+			for p in segment.points:
+				tracks.time.append( p.time.timestamp() if p.time else nan )
+				tracks.lat.append( p.latitude )
+				tracks.lon.append( p.longitude )
+				tracks.ele.append( nan if p.elevation is None else p.elevation )
+				tracks.hr.append( nan )
+				tracks.cad.append( nan )
+		return tracks
+
+def read_gpx( content: Union[bytes, str] ) -> GPXTracks:
+	"""
+	Reads the track points of a GPX document into columns, using an incremental parser which discards each point after
+	it has been read. Heart rate and cadence are taken from Garmin track point extensions.
+
+	:param content: GPX document
+	:return: track points
+	"""
+	tracks = GPXTracks()
+	source = BytesIO( content.encode( 'UTF-8' ) if isinstance( content, str ) else content )
+	for event, element in iterparse( source, events=( 'start', 'end' ), tag=( '{*}trkseg', '{*}trkpt', '{*}name' ), remove_blank_text=True ):
+		tag = element.tag.rpartition( '}' )[2]
+		if event == 'start':
+			if tag == 'trkseg':
+				tracks.segments.append( len( tracks ) )
+			continue
+
+		if tag == 'trkpt':
+			time, ele, hr, cad = nan, nan, nan, nan
+			for child in element.iter():
+				child_tag = child.tag.rpartition( '}' )[2] if isinstance( child.tag, str ) else None
+				if child_tag == 'time':
+					time = _timestamp( child.text )
+				elif child_tag == 'ele':
+					ele = _float( child.text )
+				elif child_tag == 'hr':
+					hr = _float( child.text )
+				elif child_tag == 'cad':
+					cad = _float( child.text )
+
+			tracks.time.append( time )
+			tracks.lat.append( float( element.get( 'lat' ) ) )
+			tracks.lon.append( float( element.get( 'lon' ) ) )
+			tracks.ele.append( ele )
+			tracks.hr.append( hr )
+			tracks.cad.append( cad )
+
+			# drop points which have been read already
+			element.clear()
+			while element.getprevious() is not None:
+				del element.getparent()[0]
+
+		elif tag == 'name' and ( parent := element.getparent() ) is not None:
+			# document name is located in metadata (GPX 1.1) or in the root element (GPX 1.0)
+			if parent.tag.rpartition( '}' )[2] == 'metadata' or parent.getparent() is None:
+				tracks.name = element.text
+
+	return tracks
+
 @importer( type=GPX_TYPE )
 class GPXImporter( ResourceHandler ):
 
@@ -29,33 +155,83 @@ class GPXImporter( ResourceHandler ):
 	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
 		return parse_gpx( content )
 
+	def load_as_activity( self, path: Optional[Union[Path, str]] = None, url: Optional[str] = None, fs: Optional[FS] = None, **kwargs ) -> Optional[Activity]:
+		# activities are created from the content directly, the GPX object tree is only built when raw is requested
+		if not ( resource := kwargs.get( 'resource' ) ) and kwargs.get( 'cache' ) is None and ( path or url ):
+			content = self.load_content( path=path, url=url, fs=fs, **kwargs )
+			resource = self.load_resource( path, url, content=content, **kwargs )
+
+		if resource and resource.content and resource.raw is None:
+			activity = self.as_activity( resource )
+			activity.resources.append( resource )
+			return activity
+
+		return super().load_as_activity( path=path, url=url, fs=fs, **kwargs )
+
 	def as_activity( self, resource: Resource ) -> Optional[Activity]:
-		gpx: GPX = resource.raw
-		gpx_activity = Activity( name = gpx.name )
-		bounds = gpx.get_time_bounds()
+		tracks = read_gpx( resource.content ) if resource.content else GPXTracks.from_gpx( resource.raw )
+		gpx_activity = Activity( name = tracks.name )
+		start_time, end_time = tracks.time_bounds()
 
-		if not ( bounds.start_time and bounds.end_time ):
+		if not ( start_time and end_time ):
 			raise ResourceImportException( 'GPX file is empty', None )
-		elif bounds.start_time == bounds.end_time:
+		elif start_time == end_time:
 			raise ResourceImportException( 'GPX start and end times may not be identical', None )
 		else:
-			gpx_activity.starttime= bounds.start_time.astimezone( UTC )
-			gpx_activity.endtime= bounds.end_time.astimezone( UTC )
-			gpx_activity.starttime_local= bounds.start_time.astimezone( tzlocal() )
-			gpx_activity.endtime_local= bounds.end_time.astimezone( tzlocal() )
+			gpx_activity.starttime= start_time
+			gpx_activity.endtime= end_time
+			gpx_activity.starttime_local= start_time.astimezone( tzlocal() )
+			gpx_activity.endtime_local= end_time.astimezone( tzlocal() )
 
-			if (d := gpx.get_duration() ) > 0.0:
+			if ( d := tracks.duration() ) and d > 0.0:
 				gpx_activity.duration = timedelta( seconds=round( d ) )
 			else:
 				gpx_activity.duration = None
 
-		gpx_activity.distance = round( gpx.length_2d(), 1 )
+		gpx_activity.distance = round( tracks.length_2d(), 1 )
 
-		if pd := gpx.get_points_data():
-			gpx_activity.location_latitude_start=pd[0].point.latitude
-			gpx_activity.location_longitude_start=pd[0].point.longitude
-			gpx_activity.location_latitude_end=pd[-1].point.latitude
-			gpx_activity.location_longitude_end=pd[-1].point.longitude
-		gpx_activity.uid = f'gpx:{bounds.start_time.astimezone( UTC ).strftime( "%y%m%d%H%M%S" )}'
+		if len( tracks ) > 0:
+			gpx_activity.location_latitude_start=tracks.lat[0]
+			gpx_activity.location_longitude_start=tracks.lon[0]
+			gpx_activity.location_latitude_end=tracks.lat[-1]
+			gpx_activity.location_longitude_end=tracks.lon[-1]
+		gpx_activity.uid = f'gpx:{start_time.strftime( "%y%m%d%H%M%S" )}'
 
 		return gpx_activity
+
+# helpers
+
+def _datetime( timestamp: float ) -> datetime:
+	return datetime.fromtimestamp( timestamp, UTC )
+
+def _timestamp( text: Optional[str] ) -> float:
+	if not text:
+		return nan
+	try:
+		# fromisoformat() accepts a trailing Z only from Python 3.11 on
+		text = text.strip()
+		return datetime.fromisoformat( f'{text[:-1]}+00:00' if text.endswith( 'Z' ) else text ).timestamp()
+	except ValueError:
+		try:
+			return parse_time( text.strip() ).timestamp()
+		except Exception:
+			log.debug( f'unable to parse GPX time {text}' )
+			return nan
+
+def _float( text: Optional[str] ) -> float:
+	try:
+		return float( text ) if text else nan
+	except ValueError:
+		return nan
+
+def _distance_2d( lat1: float, lon1: float, lat2: float, lon2: float ) -> float:
+	"""
+	Same as gpxpy.geo.distance(): haversine for distant points, a flat approximation otherwise.
+	"""
+	if abs( lat1 - lat2 ) > .2 or abs( lon1 - lon2 ) > .2:
+		d_lon, lat1_rad, lat2_rad = radians( lon1 - lon2 ), radians( lat1 ), radians( lat2 )
+		a = sin( ( lat1_rad - lat2_rad ) / 2 ) ** 2 + sin( d_lon / 2 ) ** 2 * cos( lat1_rad ) * cos( lat2_rad )
+		return EARTH_RADIUS * 2 * asin( sqrt( a ) )
+
+	x, y = lat1 - lat2, ( lon1 - lon2 ) * cos( radians( lat1 ) )
+	return sqrt( x * x + y * y ) * ONE_DEGREE
@@ -1,5 +1,9 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
 from io import UnsupportedOperation
 from logging import getLogger
+from multiprocessing import get_context
+from os.path import splitext
 from pathlib import Path
 from shutil import copy2 as copy, move
 from typing import Any, List, Optional, Tuple, Union
@@ -7,7 +11,7 @@ from urllib.parse import urlparse
 from urllib.request import url2pathname
 
 from fs.base import FS
-from fs.copy import copy_file
+from fs.copy import copy_modified_time
 from fs.errors import ResourceNotFound
 from fs.osfs import OSFS
 from fs.path import dirname
@@ -16,11 +20,11 @@ from fs.zipfs import ReadZipFS
 
 from tracs.activity import Activities, Activity
 from tracs.config import ApplicationContext
-from tracs.errors import ResourceImportException
 from tracs.pluginmgr import service
-from tracs.plugins.gpx import GPXImporter
-from tracs.resources import Resource
-from tracs.service import path_for_date, Service
+from tracs.pipeline import DEFAULT_QUEUE_SIZE, Pipeline, Stage
+from tracs.plugins.gpx import GPX_TYPE, GPXImporter
+from tracs.resources import content_digest, Resource, Resources
+from tracs.service import parse_activity, path_for_date, Service
 from tracs.uid import UID
 from tracs.utils import abspath
 
@@ -149,32 +153,79 @@ class Local( Service ):
 
 		activities = Activities() # list of imported activities
 
-		for path, dirs, files in fs.walk.walk( '/', filter=filters, exclude_dirs=[ '__MACOSX' ] ):
-			for f in files:
-				try:
-					src_path = f'{path}/{f.name}'
-					activity = self._gpx_importer.load_as_activity( fs=fs, path=src_path )
-					activity.uid = UID( classifier, int( activity.starttime.strftime( "%y%m%d%H%M%S" ) ) )
-					dst_path = f'{classifier}/{path_for_date( activity.starttime )}/{activity.starttime.strftime( "%y%m%d%H%M%S" )}{f.suffix}'
-
-					if force or not self.db.contains_resource( activity.uid, dst_path ):
-						import_fs.makedirs( dirname( dst_path ), recreate=True )
-						copy_file( fs, src_path, import_fs, dst_path, preserve_time=True ) # todo: avoid file collisions
-						log.debug( f'copy {fs}/{src_path} to {import_fs}/{dst_path}' )
-
-						resource = activity.resources.first()
-						resource.path = dst_path
-						# source URL is better than before, but maybe not final
-						resource.source = fs.geturl( src_path, purpose='fs' ) if isinstance( fs, ReadZipFS ) else fs.geturl( src_path, purpose='download' )
-						# don't need to set the resource uid as activity uid is set
-						# resource.uid = UID( classifier, int( activity.starttime.strftime( "%y%m%d%H%M%S" ) ) )
-						resource.unload()
-						activities.append( activity )
-
-					else:
-						log.info( f'skipping import of {fs}/{src_path}, resource already exists' )
-
-				except (AttributeError, ResourceImportException):
-					log.error( f'unable to read GPX file from FS {fs}, path {path}/{f.name}' )
+		# discover files first, then read, parse and copy them in parallel, activities are collected in order of their paths
+		src_paths = sorted( f'{path}/{f.name}' for path, dirs, files in fs.walk.walk( '/', filter=filters, exclude_dirs=[ '__MACOSX' ] ) for f in files )
+		log.debug( f'discovered {len( src_paths )} files in {fs}' )
+
+		self.db.known_resources( [] ) # make sure the resource index exists before it is accessed from several threads
+		workers = kwargs.get( 'workers', 1 ) if not isinstance( fs, ReadZipFS ) else 1 # zip members are read one at a time
+		processes = kwargs.get( 'processes', 0 )
+		executor = ProcessPoolExecutor( max_workers=processes, mp_context=get_context( 'spawn' ) ) if processes > 0 else None
+
+		pipeline = Pipeline(
+			Stage( 'read', partial( self._read_file, fs=fs, force=force ), workers=workers ),
+			Stage( 'parse', partial( self._parse_file, fs=fs, executor=executor ), workers=max( processes, 1 ) ),
+			Stage( 'copy', partial( self._copy_file, fs=fs, import_fs=import_fs, classifier=classifier, force=force ), workers=workers ),
+			queue_size=kwargs.get( 'queue_size', DEFAULT_QUEUE_SIZE )
+		)
+
+		try:
+			self.metrics = pipeline.run( src_paths, activities.append )
+		finally:
+			if executor:
+				executor.shutdown()
 
 		return activities, import_fs
+
+	# stages of the unified import
+
+	def _read_file( self, src_path: str, fs: FS, force: bool ) -> Optional[Tuple[str, bytes]]:
+		content = fs.readbytes( src_path )
+
+		# identical content has been imported before: skip without parsing
+		if not force and ( key := self.db.resource_key_for_digest( content_digest( content ) ) ):
+			log.info( f'skipping import of {fs}/{src_path}, content is identical to resource {key[0]}:{key[1]}/{key[2]}' )
+			return None
+
+		return src_path, content
+
+	# noinspection PyMethodMayBeStatic
+	def _parse_file( self, item: Tuple[str, bytes], fs: FS, executor: Optional[Executor] = None ) -> Optional[Tuple[str, bytes, Activity]]:
+		src_path, content = item
+		activity = executor.submit( parse_gpx_activity, content ).result() if executor else parse_gpx_activity( content )
+		if activity is None:
+			log.error( f'unable to read GPX file from FS {fs}, path {src_path}' )
+			return None
+		return src_path, content, activity
+
+	def _copy_file( self, item: Tuple[str, bytes, Activity], fs: FS, import_fs: FS, classifier: str, force: bool ) -> Optional[Activity]:
+		src_path, content, activity = item
+		activity.uid = UID( classifier, int( activity.starttime.strftime( "%y%m%d%H%M%S" ) ) )
+		dst_path = f'{classifier}/{path_for_date( activity.starttime )}/{activity.starttime.strftime( "%y%m%d%H%M%S" )}{splitext( src_path )[1]}'
+
+		if not force and self.db.contains_resource( activity.uid, dst_path ):
+			log.info( f'skipping import of {fs}/{src_path}, resource already exists' )
+			return None
+
+		import_fs.makedirs( dirname( dst_path ), recreate=True )
+		import_fs.writebytes( dst_path, content ) # todo: avoid file collisions
+		copy_modified_time( fs, src_path, import_fs, dst_path )
+		log.debug( f'copy {fs}/{src_path} to {import_fs}/{dst_path}' )
+
+		# source URL is better than before, but maybe not final
+		source = fs.geturl( src_path, purpose='fs' ) if isinstance( fs, ReadZipFS ) else fs.geturl( src_path, purpose='download' )
+		# don't need to set the resource uid as activity uid is set
+		activity.resources = Resources( Resource( type=GPX_TYPE, path=dst_path, source=source, digest=content_digest( content ) ) )
+		return activity
+
+# helper functions
+
+def parse_gpx_activity( content: bytes ) -> Optional[Activity]:
+	"""
+	Creates an activity from GPX content, intended to be run in a separate process. Errors are not sent back
+	to the calling process, None is returned instead.
+	"""
+	try:
+		return parse_activity( GPXImporter, Resource( type=GPX_TYPE, content=content ) )
+	except Exception:
+		return None
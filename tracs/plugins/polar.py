@@ -1,11 +1,16 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time, timedelta
+from functools import partial
+from io import BytesIO
 from logging import getLogger
+from math import nan
 from pathlib import Path
 from re import compile, match
 from sys import exit as sysexit
 from time import time as current_time
-from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
-from zipfile import BadZipFile
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+from zipfile import BadZipFile, ZipFile
 
 from attrs import define, field
 from bs4 import BeautifulSoup
@@ -13,23 +18,24 @@ from click import echo
 from datetimerange import DateTimeRange
 from dateutil.parser import parse
 from dateutil.tz import tzlocal, UTC
-from fs import open_fs
-from fs.errors import CreateFailed
-from fs.zipfs import ReadZipFS
-from requests_cache import CachedSession
+from fs.base import FS
+from fs.path import basename
 from rich.prompt import Prompt
 
 from tracs.activity import Activity, ActivityPart
 from tracs.activity_types import ActivityTypes, ActivityTypes as Types
 from tracs.aio import load_resource
+from tracs.cache import HttpCache
 from tracs.config import ApplicationContext, APPNAME
+from tracs.intervals import IntervalIndex
 from tracs.pluginmgr import importer, resourcetype, service, setup
+from tracs.plugins.csv import CSVHandler
 from tracs.plugins.gpx import GPX_TYPE, GPXImporter
 from tracs.plugins.json import DataclassFactoryHandler, JSONHandler
 from tracs.plugins.tcx import TCX_TYPE
 from tracs.plugins.xml import XMLHandler
 from tracs.resources import Resource
-from tracs.service import Service
+from tracs.service import DOWNLOAD_CHUNK_SIZE, Service
 from tracs.utils import seconds_to_time
 
 log = getLogger( __name__ )
@@ -51,6 +57,17 @@ POLAR_ZIP_TCX_TYPE = 'application/vnd.polar.tcx+zip'
 
 PED_NS = 'http://www.polarpersonaltrainer.com'
 
+# sample columns of csv exports and the fields they are parsed into
+POLAR_CSV_COLUMNS = {
+	'HR (bpm)': 'hr',
+	'Speed (km/h)': 'speed',
+	'Cadence': 'cadence',
+	'Altitude (m)': 'altitude',
+	'Distances (m)': 'distance',
+	'Temperatures (C)': 'temperature',
+	'Power (W)': 'power',
+}
+
 # polar icon ids for identifying multipart activities: there does not seem to be any other way to identify those
 ICON_ID_TRIATHLON = '003304795bc33d808ee8e6ab8bf45d1f-2015-10-20_13_45_17'  # triathlon
 ICON_ID_MULTISPORT = '20951a7d8b02def8265f5231f57f4ed9-2015-10-20_13_45_40'  # multisport
@@ -123,6 +140,7 @@ class ResourcePartlist:
 	index: int = field( default=0 )
 	range: DateTimeRange = field( default=None )
 	resources: List[Resource] = field( factory=list )
+	recordings: List[Activity] = field( factory=list ) # activities parsed from resources, same order as resources
 
 	def start( self ) -> datetime:
 		return self.range.start_datetime
@@ -130,6 +148,9 @@ class ResourcePartlist:
 	def end( self ) -> datetime:
 		return self.range.end_datetime
 
+	def recording_of_type( self, type: str ) -> Optional[Activity]:
+		return next( ( a for r, a in zip( self.resources, self.recordings ) if r.type == type ), None )
+
 @resourcetype( type=POLAR_FLOW_TYPE, summary=True )
 @define
 class PolarFlowExercise:
@@ -233,14 +254,37 @@ class PolarRRRecording:
 @resourcetype( type=POLAR_CSV_TYPE )
 @define
 class PolarFlowExerciseCsv:
-
-	pass
+	"""
+	CSV export of an exercise: the summary line is kept as dict, samples are stored column-wise with missing values being
+	NaN. Time is given in seconds since the start of the exercise, all other columns keep the units of the export.
+	"""
+
+	summary: Dict[str, str] = field( factory=dict )
+	sample_rate: Optional[int] = field( default=None )
+	time: array = field( factory=lambda: array( 'd' ) )
+	hr: array = field( factory=lambda: array( 'd' ) )
+	speed: array = field( factory=lambda: array( 'd' ) )
+	cadence: array = field( factory=lambda: array( 'd' ) )
+	altitude: array = field( factory=lambda: array( 'd' ) )
+	distance: array = field( factory=lambda: array( 'd' ) )
+	temperature: array = field( factory=lambda: array( 'd' ) )
+	power: array = field( factory=lambda: array( 'd' ) )
+
+	def __len__( self ) -> int:
+		return len( self.time )
 
 @resourcetype( type=POLAR_HRV_TYPE )
 @define
 class PolarFlowExerciseHrv:
+	"""
+	RR intervals of an exercise in milliseconds, offline flags mark intervals recorded while the sensor was offline.
+	"""
 
-	pass
+	rr: array = field( factory=lambda: array( 'd' ) )
+	offline: array = field( factory=lambda: array( 'b' ) )
+
+	def __len__( self ) -> int:
+		return len( self.rr )
 
 # todo: this needs an update, but has low priority
 @resourcetype( type=POLAR_EXERCISE_DATA_TYPE )
@@ -319,6 +363,22 @@ class PolarRRRecordingImporter( DataclassFactoryHandler ):
 			starttime_local= parse( activity.datetime, ignoretz=True ).replace( tzinfo=tzlocal() ),
 		)
 
+@importer
+class PolarCsvImporter( CSVHandler ):
+
+	TYPE: str = POLAR_CSV_TYPE
+
+	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
+		return read_csv_exercise( self.rows( content ) )
+
+@importer
+class PolarHrvImporter( CSVHandler ):
+
+	TYPE: str = POLAR_HRV_TYPE
+
+	def load_raw( self, content: Union[bytes,str], **kwargs ) -> Any:
+		return read_hrv_exercise( self.rows( content ) )
+
 @importer( type=POLAR_EXERCISE_DATA_TYPE )
 class PersonalTrainerImporter( XMLHandler ):
 
@@ -430,7 +490,7 @@ class Polar( Service ):
 			return self._logged_in
 
 		if not self._session:
-			self._session = CachedSession( backend='memory' )
+			self._session = HttpCache.for_context( self.ctx, self.name )
 
 		# noinspection PyUnusedLocal
 		response = self._session.get( self.base_url )
@@ -467,8 +527,14 @@ class Polar( Service ):
 
 	def fetch( self, force: bool, pretend: bool, **kwargs ) -> List[Resource]:
 		try:
-			url = self.events_url_for( range_from=kwargs.get( 'range_from' ), range_to=kwargs.get( 'range_to' ) )
-			json_list = self.json_handler.load( url=url, headers=HEADERS_API, session=self._session, stream=False )
+			# the requested range is split into yearly windows which are fetched in parallel and merged afterwards
+			windows = _yearly_windows( kwargs.get( 'range_from' ), kwargs.get( 'range_to' ) )
+			with ThreadPoolExecutor( max_workers=max( kwargs.get( 'workers' ) or 1, 1 ) ) as executor:
+				listings = list( executor.map( partial( self.fetch_events, force=force ), windows ) )
+
+			events = {}
+			for j in [ j for listing in listings for j in listing ]:
+				events.setdefault( _local_id( j ), j ) # windows do not overlap, but better be safe than sorry
 
 			return [
 				self.importer.save_to_resource(
@@ -479,13 +545,26 @@ class Polar( Service ):
 					path=f'{_local_id( j )}.json',
 					type=POLAR_FLOW_TYPE,
 					source=self.url_for_id( _local_id( j ) ),
-				) for j in json_list.raw
+				) for j in events.values()
 			]
 
 		except RuntimeError:
 			log.error( f'error fetching activity ids' )
 			return []
 
+	def fetch_events( self, window: Tuple[Optional[datetime], Optional[datetime]], force: bool = False ) -> List[Dict]:
+		"""
+		Fetches the event listing for a single time window, this runs on a worker thread.
+
+		:param window: tuple of start and end of the window
+		:param force: ignore cached listings
+		:return: list of events
+		"""
+		url = self.events_url_for( range_from=window[0], range_to=window[1] )
+		# handlers keep loaded content as state, so each thread needs its own handler
+		listing = JSONHandler().load( url=url, headers=HEADERS_API, session=self._session, stream=False, expire_after=self._session.policy.expire_after(), refresh=force )
+		return listing.raw or []
+
 	def download( self, summary: Resource, force: bool = False, pretend: bool = False, **kwargs ) -> List[Resource]:
 		try:
 			if not summary.raw:
@@ -496,9 +575,9 @@ class Polar( Service ):
 
 		self.login()
 
-		return self.download_multipart_resources( summary ) if multipart else self.download_resources( summary )
+		return self.download_multipart_resources( summary, pretend=pretend ) if multipart else self.download_resources( summary, pretend=pretend )
 
-	def download_multipart_resources( self, summary: Resource ) -> List[Resource]:
+	def download_multipart_resources( self, summary: Resource, pretend: bool = False ) -> List[Resource]:
 		resources = [
 			Resource( uid=summary.uid, type=POLAR_ZIP_GPX_TYPE, path=f'{summary.local_id}.gpx.zip', source=f'{self.export_url}/gpx/{summary.local_id}?compress=true' ),
 			Resource( uid=summary.uid, type=POLAR_ZIP_TCX_TYPE, path=f'{summary.local_id}.tcx.zip', source=f'{self.export_url}/tcx/{summary.local_id}?compress=true' ),
@@ -506,17 +585,17 @@ class Polar( Service ):
 
 		for r in list( resources ):
 			try:
-				self.download_resource( r )
-				resources.extend( decompress_resources( r, self.gpx_importer ) )
-			except (CreateFailed, BadZipFile):
+				self.download_resource( r, pretend=pretend )
+				resources.extend( decompress_resources( r, self.dbfs ) )
+			except BadZipFile:
 				log.debug( f'error fetching resource from {r.source}', exc_info=True )
 
-			if not r.content:
+			if not r.content and not r.digest:
 				resources.remove( r )
 
 		return resources
 
-	def download_resources( self, summary: Resource ) -> List[Resource]:
+	def download_resources( self, summary: Resource, pretend: bool = False ) -> List[Resource]:
 		resources = [
 			Resource(
 				uid=summary.uid,
@@ -546,43 +625,35 @@ class Polar( Service ):
 
 		for r in list( resources ):
 			try:
-				self.download_resource( r )
+				self.download_resource( r, pretend=pretend )
 			except RuntimeError:
 				log.error( f'error fetching resource from {r.source}', exc_info=True )
 
-			if not r.content:
+			if not r.content and not r.digest:
 				resources.remove( r )
 
 		return resources
 
 	def download_resource( self, resource: Resource, **kwargs ) -> Tuple[Any, int]:
 		log.debug( f'downloading resource from {resource.source}' )
-		response = self._session.get( resource.source, headers=HEADERS_DOWNLOAD, allow_redirects=True, stream=False )
-		resource.content = response.content
+		response = self._session.get( resource.source, headers=HEADERS_DOWNLOAD, allow_redirects=True, stream=True, expire_after=self._session.policy.expire_after( download=True ) )
 		resource.status = response.status_code
-		return response.content, response.status_code
+		if response.status_code == 200:
+			self.stream_resource( resource, response.iter_content( chunk_size=DOWNLOAD_CHUNK_SIZE ), pretend=kwargs.get( 'pretend', False ) )
+		return resource.content, response.status_code
 
 	def postprocess_activities( self, activities: List[Activity], resources: List[Resource], **kwargs ) -> List[Activity]:
 		if not any( r.type in [POLAR_ZIP_GPX_TYPE, POLAR_ZIP_TCX_TYPE] for r in resources ):
 			return activities
 
-		summary = next( (r for r in resources if r.summary), None )
+		summary = next( (r for r in resources if r.type == POLAR_FLOW_TYPE), None )
 		recordings = [r for r in resources if r.type in [GPX_TYPE, TCX_TYPE]]
 		activity = activities[0] # there should be only one activity
 		partlist = self.create_partlist( activity, recordings )
 
-		# create separate activity for each part
+		# create separate activity for each part, reusing the recordings parsed during partlist creation, tcx is preferred
 		for rp in partlist:
-			# try to create activity from tcx
-			try:
-				tcx_resource = next( (tcx for tcx in rp.resources if tcx.type == TCX_TYPE), None )
-				new_activity = Service.as_activity_from( tcx_resource )
-			except AttributeError:
-				try:
-					gpx_resource = next( (gpx for gpx in rp.resources if gpx.type == GPX_TYPE), None )
-					new_activity = Service.as_activity_from( gpx_resource )
-				except AttributeError:
-					new_activity = None
+			new_activity = rp.recording_of_type( TCX_TYPE ) or rp.recording_of_type( GPX_TYPE )
 
 			if new_activity:
 				# update new activity
@@ -601,35 +672,21 @@ class Polar( Service ):
 		# self.ctx.db.upsert_activity( activity )
 		return activities
 
-	# noinspection PyMethodMayBeStatic
-	def unzip_resources( self, resources: List[Resource] ) -> List[Resource]:
-		unzipped_resources = []
-		for r in list( resources ):
-			if r.type in [POLAR_ZIP_GPX_TYPE, POLAR_ZIP_TCX_TYPE]:
-				unzipped_resources.extend( decompress_resources( r, self.gpx_importer ) )
-		return unzipped_resources
-
 	# noinspection PyMethodMayBeStatic
 	def create_partlist( self, activity: Activity, resources: List[Resource] ) -> List[ResourcePartlist]:
-		ranges: Dict[int, ResourcePartlist] = { }
-		for r in resources:
-			recording = Service.as_activity_from( r )
-			dtr = DateTimeRange( recording.starttime, recording.endtime )
-
-			found_key = None
-			for k, v in ranges.items():
-				if dtr.is_intersection( v.range ):
-					found_key = k
-					break
-
-			if found_key is None:
-				ranges[len( ranges.keys() )] = ResourcePartlist( resources=[r], range=dtr )
-			else:
-				ranges.get( found_key ).range.encompass( dtr )
-				ranges.get( found_key ).resources.append( r )
+		# each recording is parsed only once, result is kept in the partlist
+		recordings = [ ( r, Service.as_activity_from( r ) ) for r in resources ]
 
-		# sort and number parts
-		partlists = sorted( ranges.values(), key=lambda pl: pl.start() )
+		# overlapping recordings belong to the same part, parts are sorted by start time
+		partlists = []
+		for cluster in IntervalIndex( recordings, key=lambda rr: ( rr[1].starttime, rr[1].endtime ) ).clusters():
+			partlists.append( ResourcePartlist(
+				resources=[ r for r, a in cluster ],
+				recordings=[ a for r, a in cluster ],
+				range=DateTimeRange( min( a.starttime for r, a in cluster ), max( a.endtime or a.starttime for r, a in cluster ) )
+			) )
+
+		uid = activity.uids[0] # activity turns into a multipart activity once the first part has been added
 
 		for index in range( len( partlists ) ):
 			partlists[index].index = index + 1
@@ -637,7 +694,7 @@ class Polar( Service ):
 				gap = '00:00:00'
 			else:
 				gap = seconds_to_time( (partlists[index].start() - partlists[index - 1].end()).total_seconds() ).isoformat()
-			uids = [f'{activity.uids[0]}?{r.path}' for r in partlists[index].resources]
+			uids = [f'{uid}?{r.path}' for r in partlists[index].resources]
 			activity.parts.append( ActivityPart( gap=time.fromisoformat( gap ), uids=uids ) )
 
 		return partlists
@@ -653,8 +710,65 @@ def setup( ctx: ApplicationContext, config: Dict, state: Dict ) -> Tuple[Dict, D
 
 	return { 'username': user, 'password': password }, {}
 
+def read_csv_exercise( rows: Iterable[List[str]] ) -> PolarFlowExerciseCsv:
+	"""
+	Parses the rows of a CSV export: the first two rows contain the summary, followed by the header of the sample section
+	and one sample per row. Samples are parsed straight into columns, without keeping the rows.
+	"""
+	rows, exercise = iter( rows ), PolarFlowExerciseCsv()
+	exercise.summary = { h: v for h, v in zip( next( rows, [] ), next( rows, [] ) ) if h }
+
+	header = next( rows, [] )
+	time_index = header.index( 'Time' ) if 'Time' in header else None
+	rate_index = header.index( 'Sample rate' ) if 'Sample rate' in header else None
+	columns = [ ( i, getattr( exercise, POLAR_CSV_COLUMNS[h] ).append ) for i, h in enumerate( header ) if h in POLAR_CSV_COLUMNS ]
+
+	for row in rows:
+		if not row:
+			continue
+		if rate_index is not None and exercise.sample_rate is None and row[rate_index]:
+			exercise.sample_rate = int( row[rate_index] )
+		exercise.time.append( _seconds( row[time_index] ) if time_index is not None else nan )
+		for index, append in columns:
+			append( float( v ) if index < len( row ) and ( v := row[index] ) else nan )
+
+	return exercise
+
+def read_hrv_exercise( rows: Iterable[List[str]] ) -> PolarFlowExerciseHrv:
+	"""
+	Parses the rows of an RR export, the first row contains the header (duration, offline).
+	"""
+	rows, hrv = iter( rows ), PolarFlowExerciseHrv()
+	header = next( rows, [] )
+	rr_index, offline_index = header.index( 'duration' ) if 'duration' in header else 0, header.index( 'offline' ) if 'offline' in header else None
+
+	for row in rows:
+		if row and row[rr_index]:
+			hrv.rr.append( float( row[rr_index] ) )
+			hrv.offline.append( 1 if offline_index is not None and row[offline_index] == 'true' else 0 )
+
+	return hrv
+
 # --- helper
 
+def _yearly_windows( range_from: Optional[datetime], range_to: Optional[datetime] ) -> List[Tuple[Optional[datetime], Optional[datetime]]]:
+	"""
+	Splits a date range into windows not crossing the end of a year, a missing range results in a single open window.
+	"""
+	if not range_from or not range_to:
+		return [ ( range_from, range_to ) ]
+
+	windows = []
+	for year in range( range_from.year, range_to.year + 1 ):
+		start = range_from if year == range_from.year else range_from.replace( year=year, month=1, day=1, hour=0, minute=0, second=0, microsecond=0 )
+		end = range_to if year == range_to.year else start.replace( month=12, day=31, hour=0, minute=0, second=0, microsecond=0 )
+		windows.append( ( start, end ) )
+	return windows
+
+def _seconds( t: str ) -> float:
+	# t has the format HH:MM:SS
+	return int( t[:-6] ) * 3600 + int( t[-5:-3] ) * 60 + int( t[-2:] ) if t else nan
+
 def _local_id( r: Mapping ) -> int:
 	return _raw_id( r )
 
@@ -684,17 +798,26 @@ def _multipart_str( self ) -> str:
 	else:
 		return '\u2716'
 
-def decompress_resources( r: Resource, gpx_importer: GPXImporter ) -> List[Resource]:
-	mem_fs = open_fs( 'mem://' )
-	mem_fs.writebytes( f'/{r.path}', r.content )
+def decompress_resources( r: Resource, fs: Optional[FS] = None ) -> List[Resource]:
+	"""
+	Extracts the members of a zipped resource. Members are read directly from the content of the resource, without
+	staging it in a filesystem. Resources which have been streamed to the db come without content, these are read
+	from the provided filesystem. Members are not parsed here, this happens in create_partlist() using the importer
+	matching the member type.
+	"""
 	resources = []
-
-	with mem_fs.openbin( f'/{r.path}' ) as zip_file:
-		with ReadZipFS( zip_file ) as zip_fs:
-			for f in zip_fs.listdir( '/' ):
-				resource = Resource( path=f, content=zip_fs.readbytes( f'/{f}' ), status=200, uid=r.uid, source=r.path )
-				resource.type = GPX_TYPE if f.endswith( '.gpx' ) else TCX_TYPE
-				gpx_importer.load_as_activity( resource=resource )
-				resources.append( resource )
+	source = BytesIO( r.content ) if r.content else fs.openbin( r.path ) # BytesIO shares the buffer of the content, no copy is made
+	with source, ZipFile( source ) as zip_file:
+		for info in zip_file.infolist():
+			if not info.is_dir():
+				f = basename( info.filename )
+				resources.append( Resource(
+					path=f,
+					content=zip_file.read( info ),
+					status=200,
+					uid=r.uid,
+					source=r.path,
+					type=GPX_TYPE if f.endswith( '.gpx' ) else TCX_TYPE
+				) )
 
 	return resources
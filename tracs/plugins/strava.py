@@ -1,6 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from itertools import zip_longest
 from logging import getLogger
 from pathlib import Path
 from re import compile, match
@@ -11,8 +12,9 @@ from webbrowser import open as open_url
 
 from dateutil.parser import parse as dtparse
 from dateutil.tz import tzlocal, UTC
-from lxml.etree import tostring
-from requests import get as rqget
+from fs.errors import ResourceNotFound
+from fs.path import dirname
+from requests import get as rqget, RequestException
 from rich.prompt import Prompt
 from stravalib.client import Client
 from stravalib.model import Activity as StravaActivity
@@ -26,9 +28,10 @@ from tracs.plugins.image import JPEG_TYPE
 from tracs.plugins.json import JSONHandler
 from tracs.plugins.stravaconstants import BASE_URL, TYPES
 from tracs.plugins.tcx import TCX_TYPE
+from tracs.ratelimit import RateLimitedSession, RateLimiter
 from tracs.resources import Resource, ResourceType
-from tracs.service import Service
-from tracs.streams import Point, Stream
+from tracs.service import DOWNLOAD_CHUNK_SIZE, Service
+from tracs.streams import column, epoch, Stream
 
 log = getLogger( __name__ )
 
@@ -37,11 +40,14 @@ DISPLAY_NAME = 'Strava'
 
 STRAVA_TYPE = 'application/vnd.strava+json'
 
+KEY_RATE_LIMIT = 'rate_limit'
+
 OAUTH_REDIRECT_URL = 'http://localhost:40004'
 SCOPE = 'activity:read_all'
 
 FETCH_PAGE_SIZE = 30 #
 PHOTO_SIZE = 2800
+PHOTO_TIMEOUT = 60
 
 TIMEZONE_FULL_REGEX = compile( '^(\(.+\)) (.+)$' ) # not used at the moment
 TIMEZONE_REGEX = compile( '\(\w+\+\d\d:\d\d\) ' )
@@ -113,6 +119,7 @@ class Strava( Service ):
 		self._client = Client()
 		self._session = None
 		self._oauth_session = None
+		self._details: Dict[int, StravaActivity] = {}
 
 		self.importer: StravaHandler = StravaHandler()
 		self.json_handler: JSONHandler = JSONHandler()
@@ -158,7 +165,7 @@ class Strava( Service ):
 			log.error( f"application setup not complete for {SERVICE_NAME}, consider running {APPNAME} setup --strava" )
 			sysexit( -1 )
 
-		self._client = Client( access_token=self.state_value( 'access_token' ) )
+		self._client = self.create_client( self.state_value( 'access_token' ) )
 
 		if time() > self.state_value( 'expires_at' ):
 			log.debug( f"access token has expired, attempting to fetch new one" )
@@ -174,6 +181,18 @@ class Strava( Service ):
 		# todo: how to detect unsuccessful login?
 		return True
 
+	def create_client( self, access_token: Optional[str] = None ) -> Client:
+		"""
+		Creates an API client, all requests of the client are scheduled by a rate limiter. The limiter takes its budget
+		from the rate_limit configuration and keeps the remaining budget in the plugin state across runs.
+		"""
+		limiter = RateLimiter.from_config(
+			self._cfg.get( KEY_RATE_LIMIT ) or {},
+			state=self._state.get( KEY_RATE_LIMIT ),
+			on_update=lambda state: self.set_state_value( KEY_RATE_LIMIT, state ),
+		)
+		return Client( access_token=access_token, rate_limit_requests=False, requests_session=RateLimitedSession( limiter ) )
+
 	def fetch( self, force: bool, pretend: bool, **kwargs ) -> List[Resource]:
 		# self.ctx.start( f'fetching activity summaries from {self.display_name}' )
 		resources = []
@@ -185,35 +204,74 @@ class Strava( Service ):
 		if after is None or before is None:
 			after, before = datetime( first_year, 1, 1 ), datetime.utcnow() + timedelta( days = 1 )
 
-		for a in self._client.get_activities( after=after, before=before ):
-			self.ctx.advance( f'activity {a.id}' )
-
-			a = self._client.get_activity( a.id, include_all_efforts=True ) # get detailed data for activity
-
-			resources.append( self.importer.save_to_resource(
-				content=a.json( exclude_unset=True, exclude_defaults=True, exclude_none=True, sort_keys=True, indent=2 ).encode( 'UTF-8' ),
-				raw = a.dict( exclude_unset=True, exclude_defaults=True, exclude_none=True ),
-				data = a,
-				uid = f'{self.name}:{a.id}',
-				path = f'{a.id}.json',
-				type=STRAVA_TYPE,
-				source=self.url_for_id( a.id ),
-			) )
+		# retrieve details for all listed activities in parallel, map() keeps the order of the listing
+		activities = list( self._client.get_activities( after=after, before=before ) )
+		with ThreadPoolExecutor( max_workers=max( kwargs.get( 'workers' ) or 1, 1 ) ) as executor:
+			for a in executor.map( partial( self.activity_detail, force=force, pretend=pretend ), [ a.id for a in activities ] ):
+				self.ctx.advance( f'activity {a.id}' )
+				resources.append( self.importer.save_to_resource(
+					content=self.detail_content( a ),
+					raw = a.dict( exclude_unset=True, exclude_defaults=True, exclude_none=True ),
+					data = a,
+					uid = f'{self.name}:{a.id}',
+					path = f'{a.id}.json',
+					type=STRAVA_TYPE,
+					source=self.url_for_id( a.id ),
+				) )
 
 		#	self.ctx.complete( 'done' )
 
 		return resources
 
+	def activity_detail( self, activity_id: int, force: bool = False, pretend: bool = False ) -> StravaActivity:
+		"""
+		Returns the detailed data for the activity with the provided id. Details are cached: an activity is looked up in
+		memory first, then in the db (unless forced) and is requested from the Strava API only when both fail. Requested
+		details are written to the db right away, so details do not need to be requested again when an import stops
+		early because the rate limit has been exhausted.
+
+		:param activity_id: id of the activity
+		:param force: do not use the details which have been persisted in the db
+		:param pretend: do not write requested details to the db
+		:return: detailed activity
+		"""
+		if ( detail := self._details.get( activity_id ) ) is not None:
+			return detail
+
+		path = self.path_for( Resource( uid=f'{self.name}:{activity_id}', path=f'{activity_id}.json' ) )
+		try:
+			if force:
+				raise ResourceNotFound( path )
+			detail = StravaActivity.parse_raw( self.dbfs.readbytes( path ) )
+			log.debug( f'reusing persisted details for activity {activity_id}' )
+		except (ResourceNotFound, ValueError):
+			detail = self._client.get_activity( activity_id, include_all_efforts=True )
+			if not pretend:
+				self.dbfs.makedirs( dirname( path ), recreate=True )
+				self.dbfs.writebytes( path, self.detail_content( detail ) )
+
+		self._details[activity_id] = detail
+		return detail
+
+	# noinspection PyMethodMayBeStatic
+	def detail_content( self, detail: StravaActivity ) -> bytes:
+		return detail.json( exclude_unset=True, exclude_defaults=True, exclude_none=True, sort_keys=True, indent=2 ).encode( 'UTF-8' )
+
 	def download( self, summary: Resource, force: bool = False, pretend: bool = False, **kwargs ) -> List[Resource]:
 		# available streams:
 		# time, latlng, distance, altitude, velocity_smooth, heartrate, cadence, watts, temp, moving, grade_smooth
 		# gpx contains lat/lon, elevation, time + time in metadata
 		# tcx contains TotalTimeSeconds, DistanceMeters, MaximumSpeed, Calories
 		# track contains Time, LatitudeDegrees, LongitudeDegrees, AltitudeMeters, DistanceMeters, SensorState
+		# summaries adopted from an interrupted import or taken from the db come without data, use cached details then
+		if summary.data is None or summary.raw is None:
+			summary.data = self.activity_detail( summary.local_id )
+			summary.raw = summary.data.dict( exclude_unset=True, exclude_defaults=True, exclude_none=True )
+
 		streams = self._client.get_activity_streams( summary.local_id, types=[ 'time', 'latlng', 'distance', 'altitude', 'velocity_smooth', 'heartrate' ] )
 		stream = to_stream( streams, summary.data.start_date )
 
-		tcx = stream.as_tcx(
+		tcx = stream.as_tcx_str(
 			average_heart_rate_bpm = summary.raw.get( 'average_heartrate' ),
 			calories = round( summary.raw.get( 'calories' ) ),
 			distance_meters = summary.raw.get( 'distance' ),
@@ -226,28 +284,58 @@ class Strava( Service ):
 			total_time_seconds = round( summary.raw.get( 'elapsed_time' ).total_seconds() ),
 		)
 		resources = [
-			Resource( uid=summary.uid, path=f'{summary.local_id}.tcx', type=TCX_TYPE, text=tostring( tcx.as_xml(), pretty_print=True ).decode( 'UTF-8' ) )
+			Resource( uid=summary.uid, path=f'{summary.local_id}.tcx', type=TCX_TYPE, text=tcx )
 		]
 
-		if any( p.lat for p in stream.points ):
-			gpx = stream.as_gpx(
+		if stream.has_coordinates():
+			gpx = stream.as_gpx_str(
 				track_name = summary.raw.get( 'name' ),
 				# track_type = '1' # todo: don't know what GPX type means, strava uses integer numbers
 			)
 			resources.append(
-				Resource( uid=summary.uid, path=f'{summary.local_id}.gpx', type=GPX_TYPE, text=gpx.to_xml( prettyprint=True ) )
+				Resource( uid=summary.uid, path=f'{summary.local_id}.gpx', type=GPX_TYPE, text=gpx )
 			)
 
-		if summary.raw.get( 'photos' ).get( 'count' ) > 0:
-			for photo, index in zip( self._client.get_activity_photos( summary.raw.get( 'id' ), size=PHOTO_SIZE ), range( 1, 100 ) ):
-				photo_url = photo.urls.get( str( PHOTO_SIZE ) )
-				if ( response := rqget( photo_url ) ) and response.status_code == 200:
-					resources.append(
-						Resource( uid=summary.uid, path=f'{summary.local_id}.{index}.jpg', type=JPEG_TYPE, content=response.content )
-					)
+		if summary.raw.get( 'photos', {} ).get( 'count', 0 ) > 0:
+			for photo, index in zip( self._client.get_activity_photos( summary.local_id, size=PHOTO_SIZE ), range( 1, 100 ) ):
+				resource = Resource( uid=summary.uid, path=f'{summary.local_id}.{index}.jpg', type=JPEG_TYPE, source=photo.urls.get( str( PHOTO_SIZE ) ) )
+				if self.download_photo( resource, force=force, pretend=pretend ):
+					resources.append( resource )
 
 		return resources
 
+	def download_photo( self, resource: Resource, force: bool = False, pretend: bool = False ) -> bool:
+		"""
+		Streams a photo from its source url directly into the db, without keeping the whole photo in memory. The digest
+		of the resource is calculated while writing, the resource itself remains without content.
+
+		:param resource: photo resource, source has to contain the url to download from
+		:param force: overwrite an existing photo
+		:param pretend: do not download anything
+		:return: True if the photo exists in the db after the download
+		"""
+		path = self.path_for( resource )
+		if pretend:
+			log.info( f'pretending to download photo {resource.uidpath}' )
+			return False
+
+		if self.dbfs.exists( path ) and not force:
+			log.debug( f'not downloading photo {resource.uidpath}, path already exists: {path}, use --force to overwrite' )
+			resource.path = path
+			return True
+
+		try:
+			with rqget( resource.source, stream=True, timeout=PHOTO_TIMEOUT ) as response:
+				if response.status_code != 200:
+					log.error( f'unable to download photo {resource.uidpath} from {resource.source}, status = {response.status_code}' )
+					return False
+
+				return self.stream_resource( resource, response.iter_content( chunk_size=DOWNLOAD_CHUNK_SIZE ) )
+
+		except (OSError, RequestException):
+			log.error( f'error downloading photo {resource.uidpath} from {resource.source}', exc_info=True )
+			return False
+
 	@property
 	def logged_in( self ) -> bool:
 		return True if self._session and self._oauth_session else False
@@ -348,14 +436,14 @@ class EmptyStream:
 EMPTY = EmptyStream()
 
 def to_stream( streams: Dict, start_date: datetime ) -> Stream:
-	stream_iterator = zip_longest(
-		streams.get( 'time', EMPTY ).data,
-		streams.get( 'latlng', EMPTY ).data,
-		streams.get( 'distance', EMPTY ).data,
-		streams.get( 'altitude', EMPTY ).data,
-		streams.get( 'velocity_smooth', EMPTY ).data,
-		streams.get( 'heartrate', EMPTY ).data,
-		fillvalue=None
+	start, latlng = epoch( start_date ), streams.get( 'latlng', EMPTY ).data
+	return Stream(
+		time=column( start + t if t is not None else None for t in streams.get( 'time', EMPTY ).data ),
+		lat=column( ll[0] if ll else None for ll in latlng ),
+		lon=column( ll[1] if ll else None for ll in latlng ),
+		distance=column( streams.get( 'distance', EMPTY ).data ),
+		alt=column( streams.get( 'altitude', EMPTY ).data ),
+		speed=column( streams.get( 'velocity_smooth', EMPTY ).data ),
+		hr=column( streams.get( 'heartrate', EMPTY ).data ),
+		tz=start_date.tzinfo,
 	)
-	points = [ Point( distance=d, alt=a, speed=vs, hr=hr, start=start_date, seconds=t, latlng=ll ) for t, ll, d, a, vs, hr in stream_iterator ]
-	return Stream( points=points )
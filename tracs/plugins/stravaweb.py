@@ -1,28 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from logging import getLogger
+from math import ceil
 from re import compile, findall
 from sys import exit as sysexit
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from uuid import uuid4
 
 from attrs import define, field
 from bs4 import BeautifulSoup
 from dateutil.tz import tzlocal, UTC
-from requests import Session
+from more_itertools import chunked
 from requests.utils import cookiejar_from_dict, dict_from_cookiejar
 from rich.prompt import Prompt
 
 from tracs.activity import Activity
 from tracs.activity_types import ActivityTypes
+from tracs.cache import HttpCache
 from tracs.config import ApplicationContext, APPNAME
 from tracs.pluginmgr import importer, resourcetype, service, setup
-from tracs.plugins.fit import FIT_TYPE
 from tracs.plugins.gpx import GPX_TYPE
 from tracs.plugins.json import JSONHandler
 from tracs.plugins.stravaconstants import BASE_URL, TYPES
 from tracs.plugins.tcx import TCX_TYPE
 from tracs.resources import Resource
-from tracs.service import Service
+from tracs.service import DOWNLOAD_CHUNK_SIZE, Service
 from tracs.utils import to_isotime
 
 log = getLogger( __name__ )
@@ -137,7 +139,7 @@ class Strava( Service ):
 
 	def __init__( self, **kwargs ):
 		super().__init__( **{ **{'name': SERVICE_NAME, 'display_name': DISPLAY_NAME, 'base_url': BASE_URL }, **kwargs } )
-		self._session: Optional[Session] = None
+		self._session: Optional[HttpCache] = None
 		self._importer: StravaWebImporter = StravaWebImporter()
 		self._json_handler: JSONHandler = JSONHandler()
 
@@ -185,7 +187,7 @@ class Strava( Service ):
 
 		if not self._session:
 			if cookies := self.state_value( 'session' ) and False: # todo: session reuse does not yet work
-				session = Session()
+				session = HttpCache.for_context( self.ctx, self.name, ignored_params=[ 'search_session_id' ] )
 				session.cookies.update( cookiejar_from_dict( cookies ) )
 				response = session.get( self.training_url )
 				if response.status_code == 200:
@@ -196,8 +198,8 @@ class Strava( Service ):
 				self._session = self.login_session()
 
 	# might raise TypeError
-	def login_session( self ) -> Session:
-		session = Session()
+	def login_session( self ) -> HttpCache:
+		session = HttpCache.for_context( self.ctx, self.name, ignored_params=[ 'search_session_id' ] )
 		response = session.get( self.login_url )
 
 		HEADERS_API['X-CSRF-Token'] = BeautifulSoup( response.text, 'html.parser' ).find( 'meta', attrs={ 'name': 'csrf-token' } )['content']
@@ -241,18 +243,23 @@ class Strava( Service ):
 		}
 
 		try:
-			json = self._session.get( url, params=parameters, headers=HEADERS_API ).json()
-			total_pages = int( json.get( 'total' ) / FETCH_PAGE_SIZE ) + 1
-			models: List[Dict] = [m for m in json.get( 'models' )]
+			first_page = self.fetch_page( url, parameters, 1, force )
+			total_pages = max( ceil( first_page.get( 'total', 0 ) / FETCH_PAGE_SIZE ), 1 )
+			models: List[Dict] = [m for m in first_page.get( 'models' )]
 			self.ctx.total( total_pages - 1 ) # minus one so progress bar turns green ...
 
-			for page in range( 2, total_pages ):
-				self.ctx.advance( f'activities {(page - 1) * FETCH_PAGE_SIZE} to {page * FETCH_PAGE_SIZE} (batch {page})' )
-				models.extend( [m for m in self._session.get( url, params={ **parameters, 'page': str( page ) }, headers=HEADERS_API ).json().get( 'models' )] )
+			# remaining pages are fetched in parallel, in batches of one page per worker: listings are sorted by date
+			# (most recent first), so before each batch we can check whether the start of the range has been reached
+			workers = max( kwargs.get( 'workers' ) or 1, 1 )
+			with ThreadPoolExecutor( max_workers=workers ) as executor:
+				for batch in chunked( range( 2, total_pages + 1 ), workers ):
+					# can't query for the last X days, so we need to check for dates directly
+					if _reached( models, after ):
+						break
 
-				# can't query for the last X days, so we need to check for dates directly
-				if to_isotime( models[-1].get( 'start_time' ) ) < after:
-					break
+					for page, page_models in zip( batch, executor.map( lambda p: self.fetch_page( url, parameters, p, force ).get( 'models' ), batch ) ):
+						self.ctx.advance( f'activities {(page - 1) * FETCH_PAGE_SIZE} to {page * FETCH_PAGE_SIZE} (batch {page})' )
+						models.extend( page_models or [] )
 
 			return [
 				self._importer.save_to_resource(
@@ -263,7 +270,6 @@ class Strava( Service ):
 					path=f'{ m.get( "id" ) }.web.json',
 					type=STRAVA_WEB_TYPE,
 					source=self.url_for_id( m.get( "id" ) ),
-					summary=True
 				) for m in models
 			]
 
@@ -271,6 +277,10 @@ class Strava( Service ):
 			log.error( f'error fetching activity ids', exc_info=True )
 			return []
 
+	def fetch_page( self, url: str, parameters: Dict, page: int, force: bool = False ) -> Dict:
+		expire_after = self._session.policy.expire_after()
+		return self._session.get( url, params={ **parameters, 'page': str( page ) }, headers=HEADERS_API, expire_after=expire_after, refresh=force ).json()
+
 	def download( self, summary: Resource, force: bool = False, pretend: bool = False, **kwargs ) -> List[Resource]:
 		try:
 			resources = [
@@ -278,23 +288,24 @@ class Strava( Service ):
 				Resource( uid=summary.uid, source=f'{self.activities_url}/{summary.local_id}/export_original' ) # type is None as this can be tcx or fit
 			]
 
+			# type handling is more complicated here, original resources can be either tcx or fit
+			known = { r.path for r in self.ctx.db.known_resources( [
+				Resource( uid=summary.uid, path=f'{summary.local_id}.{ext}' ) for ext in [ 'gpx', 'tcx', 'fit' ]
+			] ) } if not force else set()
+
 			for r in resources:
-				# type handling is more complicated here ...
-				if not force:
-					# gpx
-					if r.type == GPX_TYPE and self.ctx.db.contains_resource( r.uid, r.path ):
-						continue
+				if r.type == GPX_TYPE and r.path in known:
+					continue
 
-					# tcx or fit
-					if r.type is None and ( self.ctx.db.contains_resource( r.uid, f'{r.local_id}.tcx' ) or self.ctx.db.contains_resource( r.uid, f'{r.local_id}.fit' ) ):
-						continue
+				if r.type is None and ( f'{r.local_id}.tcx' in known or f'{r.local_id}.fit' in known ):
+					continue
 
 				try:
-					self.download_resource( r )
+					self.download_resource( r, pretend=pretend )
 				except RuntimeError:
 					log.error( f'error fetching resource from {r.source}', exc_info=True )
 
-			return [r for r in resources if r.content]
+			return [r for r in resources if r.content or r.digest]
 
 		except RuntimeError:
 			log.error( f'error fetching resources', exc_info=True )
@@ -303,7 +314,7 @@ class Strava( Service ):
 	def download_resource( self, resource: Resource, **kwargs ) -> Tuple[Any, int]:
 		if url := resource.source:
 			log.debug( f'downloading resource from {url}' )
-			response = self._session.get( url, headers=HEADERS_LOGIN, allow_redirects=True, stream=True )
+			response = self._session.get( url, headers=HEADERS_LOGIN, allow_redirects=True, stream=True, expire_after=self._session.policy.expire_after( download=True ) )
 
 			content_type = response.headers.get( 'Content-Type' )
 			content_disposition = response.headers.get( 'content-disposition' )
@@ -314,23 +325,19 @@ class Strava( Service ):
 				resource.status = 404
 			else:
 				ext = findall( r'^.*filename=\".+\.(\w+)\".*$', content_disposition )[0]
-				resource.content = response.content
 				resource.type = self.ctx.registry.resource_type_for_suffix( ext )
 				resource.path = f'{resource.local_id}.{ext}'
 				resource.status = response.status_code
 
-			# fit is binary, there's no text version to be stored
-			if resource.type == FIT_TYPE:
-				pass
+				chunks = response.iter_content( chunk_size=DOWNLOAD_CHUNK_SIZE )
+				# fix for Strava bug where TCX documents contain whitespace before the first XML tag
+				# sample first line:
+				# '          <?xml version="1.0" encoding="UTF-8"?><TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"> ...'
+				if resource.type == TCX_TYPE:
+					chunks = _lstrip( chunks )
+				self.stream_resource( resource, chunks, pretend=kwargs.get( 'pretend', False ) )
 
-			# fix for Strava bug where TCX documents contain whitespace before the first XML tag
-			# sample first line:
-			# '          <?xml version="1.0" encoding="UTF-8"?><TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2"> ...'
-			if resource.type == TCX_TYPE:
-				while resource.content[0:1] == b' ':
-					resource.content = resource.content[1:]
-
-			return response.content, response.status_code
+			return resource.content, resource.status
 
 		else:
 			log.warning( f'unable to determine download url for resource {resource}' )
@@ -352,3 +359,23 @@ def setup( ctx: ApplicationContext, config: Dict, state: Dict ) -> Tuple[Dict, D
 	password = Prompt.ask( 'Enter your password', console=ctx.console, default=config.get( 'password' ), password=True )
 
 	return { 'username': username, 'password': password }, {}
+
+# helpers
+
+def _reached( models: List[Dict], after: Optional[datetime] ) -> bool:
+	"""
+	Checks if the last of the provided models (sorted by start time, most recent first) starts before after.
+	"""
+	return bool( after and models and ( start := to_isotime( models[-1].get( 'start_time' ) ) ) and start < after )
+
+def _lstrip( chunks: Iterable[bytes] ) -> Iterator[bytes]:
+	"""
+	Removes leading whitespace from streamed content.
+	"""
+	stripping = True
+	for chunk in chunks:
+		if stripping:
+			chunk = chunk.lstrip( b' ' )
+			stripping = not chunk
+		if chunk:
+			yield chunk
@@ -1,12 +1,18 @@
 from __future__ import annotations
 
-from datetime import datetime, timedelta
+from array import array
+from datetime import datetime, timedelta, tzinfo
+from io import BytesIO
 from logging import getLogger
+from math import isnan, nan
+from pathlib import Path
 from typing import Any, List, Optional, Union
 
 from attrs import define, field
 from dateutil.parser import parse as parse_dt
 from dateutil.tz import tzlocal
+from fs.base import FS
+from lxml.etree import iterparse
 from lxml.objectify import Element, fromstring, ObjectifiedElement, ObjectPath, SubElement
 
 from tracs.activity import Activity as TracsActivity
@@ -311,6 +317,127 @@ class TrainingCenterDatabase:
 			author=Author.from_xml( root ),
 		)
 
+# columnar representation, used for fast activity creation
+
+@define
+class LapData:
+	"""
+	Trackpoints of a single lap, stored column-wise as arrays of doubles. Times are seconds since epoch, missing values
+	are NaN. Lap summary values are None when missing.
+	"""
+
+	start_time: Optional[str] = field( default=None )
+	total_time_seconds: Optional[float] = field( default=None )
+	distance_meters: Optional[float] = field( default=None )
+	maximum_speed: Optional[float] = field( default=None )
+	calories: Optional[float] = field( default=None )
+
+	time: array = field( factory=lambda: array( 'd' ) )
+	lat: array = field( factory=lambda: array( 'd' ) )
+	lon: array = field( factory=lambda: array( 'd' ) )
+	alt: array = field( factory=lambda: array( 'd' ) )
+	distance: array = field( factory=lambda: array( 'd' ) )
+	hr: array = field( factory=lambda: array( 'd' ) )
+	cadence: array = field( factory=lambda: array( 'd' ) )
+
+	def __len__( self ) -> int:
+		return len( self.time )
+
+@define
+class TCXData:
+	"""
+	Laps of all activities of a TCX document. Times are reconstructed using tz, which is the time zone of the first
+	trackpoint, tz = None denotes naive times.
+	"""
+
+	laps: List[LapData] = field( factory=list )
+	tz: Optional[tzinfo] = field( default=None )
+
+	@property
+	def trackpoints( self ) -> int:
+		return sum( len( l ) for l in self.laps )
+
+	@property
+	def distance( self ) -> float:
+		return sum( l.distance_meters or 0.0 for l in self.laps )
+
+	@property
+	def time( self ) -> Optional[datetime]:
+		return self.datetime( self.laps[0].time[0] ) if self.laps and len( self.laps[0] ) else None
+
+	@property
+	def time_end( self ) -> Optional[datetime]:
+		return self.datetime( self.laps[-1].time[-1] ) if self.laps and len( self.laps[-1] ) else None
+
+	def datetime( self, seconds: float ) -> Optional[datetime]:
+		if isnan( seconds ):
+			return None
+		return datetime.fromtimestamp( seconds, self.tz ) if self.tz else datetime.fromtimestamp( seconds )
+
+def read_tcx( content: Union[bytes, str] ) -> TCXData:
+	"""
+	Reads the laps and trackpoints of a TCX document into columns, using an incremental parser which discards each
+	trackpoint after it has been read.
+
+	:param content: TCX document
+	:return: laps with trackpoints
+	:raise: XMLSyntaxError, if the document is not well-formed
+	"""
+	data, lap, first_time = TCXData(), None, True
+	source = BytesIO( content.encode( 'UTF-8' ) if isinstance( content, str ) else content )
+	for event, element in iterparse( source, events=( 'start', 'end' ), tag=( '{*}Lap', '{*}Trackpoint' ), remove_blank_text=True ):
+		tag = element.tag.rpartition( '}' )[2]
+		if event == 'start':
+			if tag == 'Lap':
+				lap = LapData( start_time=element.get( 'StartTime' ) )
+				data.laps.append( lap )
+			continue
+
+		if tag == 'Trackpoint' and lap is not None:
+			time, lat, lon, alt, distance, hr, cadence = nan, nan, nan, nan, nan, nan, nan
+			for child in element.iter():
+				child_tag = child.tag.rpartition( '}' )[2] if isinstance( child.tag, str ) else None
+				if child_tag == 'Time' and ( dt := _datetime( child.text ) ):
+					if first_time: # times are reconstructed with the time zone of the first trackpoint
+						data.tz, first_time = dt.tzinfo, False
+					time = dt.timestamp()
+				elif child_tag == 'LatitudeDegrees':
+					lat = _float( child.text )
+				elif child_tag == 'LongitudeDegrees':
+					lon = _float( child.text )
+				elif child_tag == 'AltitudeMeters':
+					alt = _float( child.text )
+				elif child_tag == 'DistanceMeters':
+					distance = _float( child.text )
+				elif child_tag == 'Value':
+					hr = _float( child.text )
+				elif child_tag == 'Cadence':
+					cadence = _float( child.text )
+
+			lap.time.append( time )
+			lap.lat.append( lat )
+			lap.lon.append( lon )
+			lap.alt.append( alt )
+			lap.distance.append( distance )
+			lap.hr.append( hr )
+			lap.cadence.append( cadence )
+
+		elif tag == 'Lap':
+			# summary values are direct children of a lap, trackpoints have been removed already
+			for child in element:
+				child_tag = child.tag.rpartition( '}' )[2] if isinstance( child.tag, str ) else None
+				if child_tag in [ 'TotalTimeSeconds', 'DistanceMeters', 'MaximumSpeed', 'Calories' ]:
+					setattr( lap, _LAP_FIELDS[child_tag], _float( child.text, None ) )
+
+		# drop elements which have been read already
+		element.clear()
+		while element.getprevious() is not None:
+			del element.getparent()[0]
+
+	return data
+
+_LAP_FIELDS = { 'TotalTimeSeconds': 'total_time_seconds', 'DistanceMeters': 'distance_meters', 'MaximumSpeed': 'maximum_speed', 'Calories': 'calories' }
+
 @resourcetype
 def tcx_resource_type() -> ResourceType:
 	return ResourceType( type=TCX_TYPE, recording=True )
@@ -330,11 +457,24 @@ class TCXImporter( XMLHandler ):
 	def save_data( self, data: Any, **kwargs ) -> Any:
 		return data
 
+	def load_as_activity( self, path: Optional[Union[Path, str]] = None, url: Optional[str] = None, fs: Optional[FS] = None, **kwargs ) -> Optional[TracsActivity]:
+		# activities are created from the content directly, the object tree is only built when raw/data is requested
+		if not ( resource := kwargs.get( 'resource' ) ) and kwargs.get( 'cache' ) is None and ( path or url ):
+			content = self.load_content( path=path, url=url, fs=fs, **kwargs )
+			resource = self.load_resource( path, url, content=content, **kwargs )
+
+		if resource and resource.content and resource.raw is None and resource.data is None:
+			activity = self.as_activity( resource )
+			activity.resources.append( resource )
+			return activity
+
+		return super().load_as_activity( path=path, url=url, fs=fs, **kwargs )
+
 	def as_activity( self, resource: Resource ) -> Optional[TracsActivity]:
-		tcx: TrainingCenterDatabase = resource.data
+		tcx: Union[TCXData, TrainingCenterDatabase] = read_tcx( resource.content ) if resource.content else resource.data
 		return TracsActivity(
 			distance=tcx.distance,
-			duration=tcx.duration,
+			duration=timedelta( seconds = (tcx.time_end - tcx.time).total_seconds() ),
 			starttime=tcx.time,
 			endtime=tcx.time_end,
 			starttime_local=tcx.time.astimezone( tzlocal() ),
@@ -347,6 +487,26 @@ class TCXImporter( XMLHandler ):
 def ztime( dt: datetime ) -> str:
 	return dt.strftime( '%Y-%m-%dT%H:%M:%SZ' ) if dt else None
 
+def _datetime( text: Optional[str] ) -> Optional[datetime]:
+	if not text:
+		return None
+	try:
+		# fromisoformat() accepts a trailing Z only from Python 3.11 on
+		text = text.strip()
+		return datetime.fromisoformat( f'{text[:-1]}+00:00' if text.endswith( 'Z' ) else text )
+	except ValueError:
+		try:
+			return parse_dt( text )
+		except (ValueError, OverflowError):
+			log.debug( f'unable to parse TCX time {text}' )
+			return None
+
+def _float( text: Optional[str], default: Optional[float] = nan ) -> Optional[float]:
+	try:
+		return float( text ) if text else default
+	except ValueError:
+		return default
+
 def find( element: ObjectifiedElement, sub_element: str ) -> Any:
 	try:
 		return ObjectPath( f'.{sub_element}' ).find( element ).pyval
@@ -1,14 +1,18 @@
-from datetime import datetime
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache, partial
 from logging import getLogger
+from math import isnan, nan
+from multiprocessing import get_context
 from pathlib import Path
 from re import compile as regex_compile
-from typing import Any, cast, List, Optional, Tuple, Union
+from typing import Any, cast, Dict, List, Optional, Tuple, Union
 
 from attrs import define, field
 from dateutil.parser import parse as parse_datetime
 from dateutil.tz import gettz, UTC
-from gpxpy.gpx import GPX, GPXTrack, GPXTrackPoint, GPXTrackSegment
 
 from tracs.activity import Activity
 from tracs.activity_types import ActivityTypes
@@ -16,8 +20,9 @@ from tracs.handlers import ResourceHandler
 from tracs.pluginmgr import importer, resourcetype, service
 from tracs.plugins.csv import CSVHandler
 from tracs.plugins.gpx import GPX_TYPE, GPXImporter
-from tracs.resources import Resource
+from tracs.resources import content_digest, Resource
 from tracs.service import Service
+from tracs.streams import EPOCH, format_gpx, Stream
 from tracs.utils import as_datetime
 
 log = getLogger( __name__ )
@@ -35,6 +40,8 @@ WAZE_TAKEOUT_TYPE = WAZE_ACCOUNT_ACTIVITY_TYPE # for backward compatibility
 
 DEFAULT_FIELD_SIZE_LIMIT = 131072
 
+KEY_TAKEOUTS = 'takeouts'
+
 @define
 class Point:
 
@@ -88,6 +95,11 @@ class LocationDetail:
 
 	CURLY_BRACES = regex_compile( r'\{.+?\}' )
 
+	# patterns for a single point, c1/c2 are lat/lon, except for 2023 V1 which has lon/lat
+	POINT_2020 = regex_compile( r'(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?: GMT| UTC)?\((?P<c1>-?[\d.]+); (?P<c2>-?[\d.]+)\)' )
+	POINT_2023_1 = regex_compile( r'(?P<time>)\((?P<c1>-?[\d.]+) (?P<c2>-?[\d.]+)\)' )
+	POINT_2023_2 = regex_compile( r'(?P<time>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) UTC\((?P<c1>-?[\d.]+) (?P<c2>-?[\d.]+)\)' )
+
 	# date format can be:
 	# - 2023-02-19 13:40:19 GMT
 	# - 2023-02-19 13:40:19 UTC
@@ -100,36 +112,60 @@ class LocationDetail:
 	# - 2023 V2: 2023-02-23 13:49:52 UTC(50.0 10.0)|2023-02-23 13:49:55 UTC(50.1 10.1)| ...
 	coordinates: str = field( default=None )
 
+	_columns: Optional[Tuple[array, array, array]] = field( default=None, init=False, repr=False, eq=False )
+	_utc: bool = field( default=False, init=False, repr=False, eq=False )
+
 	def __attrs_post_init__( self ):
 		self.coordinates = self.coordinates.strip()
 
-	def as_point_list( self ) -> List[Point]:
+	def columns( self ) -> Tuple[array, array, array]:
+		"""
+		Parses the coordinates in a single pass and returns three columns: time (as seconds since epoch, NaN when
+		missing), latitude and longitude. The result is cached, so repeated calls do not parse again.
+		"""
+		if self._columns is None:
+			self._columns = self._parse()
+		return self._columns
+
+	def _parse( self ) -> Tuple[array, array, array]:
+		times = array( 'd' )
 		if self.coordinates[0] == '[' and self.coordinates[-1] == ']':
-			segments = self.__class__.CURLY_BRACES.findall( self.coordinates )
-			segments = [s[6:-2] for s in segments]
-			all_points = []
-			for s in segments:
-				points = s.split( ' => ' )
-				points = [p[:-1].split( '(' ) for p in points]
-				points = [[p[0], *p[1].split( '; ' ) ] for p in points]
-				all_points.extend( [Point( time=p[0], lat=p[1], lon=p[2] ) for p in points] )
-			points = all_points
+			pattern, lat_lon = self.__class__.POINT_2020, True
+			self._utc = ' GMT(' in self.coordinates or ' UTC(' in self.coordinates
+		elif self.__class__.COORDS_1.match( self.coordinates.split( '|', 1 )[0] ):
+			pattern, lat_lon = self.__class__.POINT_2023_1, False  # format: lon lat!!
+		elif self.__class__.COORDS_2.match( self.coordinates.split( '|', 1 )[0] ):
+			pattern, lat_lon, self._utc = self.__class__.POINT_2023_2, True, True
 		else:
-			points = self.coordinates.split( '|' )
-			if points and self.__class__.COORDS_1.match( points[0] ):
-				points = [p[1:-1].split( ' ' ) for p in points]  # format: lon lat!!
-				points = [Point( lon=float( p[0] ), lat=float( p[1] ) ) for p in points]
-			elif points and self.__class__.COORDS_2.match( points[0] ):
-				points = [p[:-1].split( '(' ) for p in points ]
-				points = [[p[0], *p[1].split( ' ' ) ] for p in points] # format lat lon!!
-				points = [ Point( time=p[0], lat=p[1], lon=p[2] ) for p in points ]
-			else:
-				raise RuntimeError( f'unsupported format error, example: {points[0]}' )
+			raise RuntimeError( f'unsupported format error, example: {self.coordinates[:64]}' )
+
+		points = pattern.findall( self.coordinates )
+		times.extend( _seconds( t ) for t, _c1, _c2 in points )
+		c1, c2 = array( 'd', ( float( p[1] ) for p in points ) ), array( 'd', ( float( p[2] ) for p in points ) )
+		lats, lons = ( c1, c2 ) if lat_lon else ( c2, c1 )
 
-		return points
+		return times, lats, lons
+
+	def times( self ) -> List[Optional[datetime]]:
+		return [ self._datetime( t ) for t in self.columns()[0] ]
+
+	def _datetime( self, t: float ) -> Optional[datetime]:
+		return ( EPOCH + timedelta( seconds=t ) ).replace( tzinfo=UTC if self._utc else None ) if not isnan( t ) else None
+
+	def as_stream( self ) -> Stream:
+		times, lats, lons = self.columns()
+		return Stream( time=times, lat=lats, lon=lons, tz=UTC if self._utc else None )
+
+	def has_times( self ) -> bool:
+		times = self.columns()[0]
+		return len( times ) > 0 and not any( isnan( t ) for t in times )
+
+	def as_point_list( self ) -> List[Point]:
+		_times, lats, lons = self.columns()
+		return [ Point( time=t, lat=lat, lon=lon ) for t, lat, lon in zip( self.times(), lats, lons ) ]
 
 	def id( self ):
-		return self.as_point_list()[0].time_as_str()
+		return self._datetime( self.columns()[0][0] ).strftime( Point.str_format )
 
 	# this is just for testing
 	def validate( self ) -> bool:
@@ -290,69 +326,69 @@ class WazeAccountActivityImporter( CSVHandler ):
 
 	def load_data( self, raw: Any, **kwargs ) -> Any:
 		account_activity = AccountActivity()
-		while raw:
-			line = raw.pop( 0 )
+		rows = iter( raw )
+		for line in rows:
 			mode = WazeAccountActivityImporter.Mode.mode_by_value( line )
 
 			if mode == WazeAccountActivityImporter.Mode.DRIVE_SUMMARY:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Date', 'Destination', 'Source']:
+					if (line := next( rows, [] )) and line != ['Date', 'Destination', 'Source']:
 						account_activity.drive_summaries.append( DriveSummary( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.FAVOURITES:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Place', 'Name', 'Type']:
+					if (line := next( rows, [] )) and line != ['Place', 'Name', 'Type']:
 						account_activity.favourites.append( Favourite( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.LOCATION_DETAILS:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Date', 'Coordinates']:
+					if (line := next( rows, [] )) and line != ['Date', 'Coordinates']:
 						account_activity.location_details.append( LocationDetail( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.LOCATION_DETAILS_2:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_activity.location_details.append( LocationDetail( coordinates=line[0] ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.LOGIN_DETAILS:
 				while line:
-					if (line := raw.pop( 0 )) and line[0] != 'Login Time' and line[1] != 'Logout Time':
+					if (line := next( rows, [] )) and line[0] != 'Login Time' and line[1] != 'Logout Time':
 						account_activity.login_details.append( LoginDetail( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.USAGE_DATA_SNAPSHOT:
-				header = raw.pop( 0 )
-				data = raw.pop( 0 )
+				header = next( rows, [] )
+				data = next( rows, [] )
 				for h, d in zip( header, data ):
 					setattr( account_activity.usage_data, _snake( h ), d )
 
 			elif mode == WazeAccountActivityImporter.Mode.EDIT_HISTORY:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_activity.edit_history.append( EditHistoryEntry( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.USER_REPORTS:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_activity.user_reports.append( UserReport( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.USER_FEEDBACK:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_activity.user_feedback.append( UserFeedback( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.PHOTOS_ADDED:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Name', 'Image']:
+					if (line := next( rows, [] )) and line != ['Name', 'Image']:
 						account_activity.photos_added.append( Photo( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.SEARCH_HISTORY:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_activity.search_history.append( SearchHistoryEntry( *line ) )
 
 			elif mode == WazeAccountActivityImporter.Mode.CARPOOL_PREFERENCES:
-				header = raw.pop( 0 )
-				data = raw.pop( 0 )
+				header = next( rows, [] )
+				data = next( rows, [] )
 				for h, d in zip( header, data ):
 					setattr( account_activity.carpool_preferences, _snake( h ), d )
 
@@ -383,33 +419,33 @@ class WazeAccountInfoImporter( CSVHandler ):
 
 	def load_data( self, raw: Any, **kwargs ) -> Any:
 		account_info = AccountInfo()
-		while raw:
-			line = raw.pop( 0 )
+		rows = iter( raw )
+		for line in rows:
 			mode = WazeAccountInfoImporter.Mode.mode_by_value( line )
 
 			if mode == WazeAccountInfoImporter.Mode.GENERAL_INFO:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						setattr( account_info, _snake( line[0] ), line[1] )
 
 			elif mode == WazeAccountInfoImporter.Mode.CONNECTED_ACCOUNTS:
 				while line:
-					if line := raw.pop( 0 ):
+					if line := next( rows, [] ):
 						account_info.connected_accounts.append( line[0] )
 
 			elif mode == WazeAccountInfoImporter.Mode.USER_REPORTS:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Event Date', 'Type', 'Pos X', 'Pos Y', 'Subtype']:
+					if (line := next( rows, [] )) and line != ['Event Date', 'Type', 'Pos X', 'Pos Y', 'Subtype']:
 						account_info.user_reports.append( UserReport( *line ) )
 
 			elif mode == WazeAccountInfoImporter.Mode.USER_FEEDBACK:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Event Date','Type','Alert Type']:
+					if (line := next( rows, [] )) and line != ['Event Date','Type','Alert Type']:
 						account_info.user_feedback.append( UserFeedback( *line ) )
 
 			elif mode == WazeAccountInfoImporter.Mode.USER_COUNTERS:
 				while line:
-					if (line := raw.pop( 0 )) and line != ['Count','Name']:
+					if (line := next( rows, [] )) and line != ['Count','Name']:
 						setattr( account_info.user_counters, line[1], line[0] )
 
 		return account_info
@@ -447,6 +483,7 @@ class Waze( Service ):
 		self._gpx_importer: GPXImporter = GPXImporter()
 
 		self._takeout_importer.field_size_limit = kwargs.get( 'field_size_limit' ) or DEFAULT_FIELD_SIZE_LIMIT
+		self._fetched_takeouts: Optional[List[Dict[str, Any]]] = None # takeouts of the last fetch, recorded after the import
 
 		self._logged_in = True
 
@@ -475,6 +512,17 @@ class Waze( Service ):
 	def login( self ) -> bool:
 		return self._logged_in
 
+	@property
+	def processed_takeouts( self ) -> List[Dict[str, Any]]:
+		"""
+		Takeout files which have been processed by previous imports, each entry contains path, size, mtime and digest.
+		"""
+		return list( self._state.get( KEY_TAKEOUTS ) or [] )
+
+	@processed_takeouts.setter
+	def processed_takeouts( self, takeouts: List[Dict[str, Any]] ) -> None:
+		self.set_state_value( KEY_TAKEOUTS, takeouts )
+
 	def fetch( self, force: bool, pretend: bool, **kwargs ) -> List[Resource]:
 		if not kwargs.get( 'from_takeouts', False ):
 			return []
@@ -485,35 +533,69 @@ class Waze( Service ):
 		takeout_files = sorted( takeouts_dir.rglob( ACTIVITY_FILE ) )
 
 		self.ctx.total( len( takeout_files ) )
-		# last_fetch = self.state_value( KEY_LAST_FETCH )
-
-		summaries = []
 
+		# find new/changed takeouts: unchanged size and mtime skip reading, unchanged content skips parsing
+		processed = { t['path']: t for t in self.processed_takeouts }
+		changed, takeouts = [], []
 		for file in takeout_files:
 			self.ctx.advance( f'{file}' )
-			log.debug( f'fetching activities from Waze takeout in {file}' )
-
-			takeout_resource = self._takeout_importer.load( path=file )
-			account_activity = cast( AccountActivity, takeout_resource.data )
-			for ld in account_activity.location_details:
-				# ignore drives without timestamps, see issue #74
-				if not all( p.time for p in ld.as_point_list() ):
-					continue
-
-				summaries.append( Resource(
-					content=ld.coordinates.encode( 'UTF-8' ),
-					path=f'{ld.id()}.txt',
-					raw=ld, # this allows to skip parsing again
-					source=str( f'{self.name}/{file.relative_to( takeouts_dir )}' ),
-					type=WAZE_TYPE,
-					uid=f'{self.name}:{ld.id()}'
-				) )
+			path, stat = str( file.relative_to( takeouts_dir ) ), file.stat()
+			entry, known = { 'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns }, processed.get( path )
+
+			if not force and known and known.get( 'size' ) == entry['size'] and known.get( 'mtime' ) == entry['mtime']:
+				log.debug( f'skipping unchanged Waze takeout {file}' )
+				takeouts.append( dict( known ) )
+				continue
+
+			content = file.read_bytes()
+			entry['digest'] = content_digest( content )
+			takeouts.append( entry )
+
+			if not force and known and known.get( 'digest' ) == entry['digest']:
+				log.debug( f'skipping Waze takeout {file}, content has not changed' )
+				continue
+
+			changed.append( ( path, content ) )
+
+		# parse changed takeouts, drives are merged by id, drives from later takeouts replace earlier ones
+		drives: Dict[str, Tuple[LocationDetail, str]] = {}
+		for ( path, _content ), location_details in zip( changed, self._parse_takeouts( [ c for _p, c in changed ], kwargs.get( 'processes', 0 ) ) ):
+			if location_details is None:
+				log.error( f'unable to parse Waze takeout {takeouts_dir}/{path}' )
+				takeouts = [ t for t in takeouts if t['path'] != path ] # try again next time
+				continue
+
+			log.debug( f'fetched {len( location_details )} drives from Waze takeout {takeouts_dir}/{path}' )
+			for ld in location_details:
+				drives[ld.id()] = ( ld, path )
+
+		summaries = [ Resource(
+			content=ld.coordinates.encode( 'UTF-8' ),
+			path=f'{drive_id}.txt',
+			raw=ld, # this allows to skip parsing again
+			source=f'{self.name}/{path}',
+			type=WAZE_TYPE,
+			uid=f'{self.name}:{drive_id}'
+		) for drive_id, ( ld, path ) in sorted( drives.items() ) ]
+
+		# takeouts are recorded as processed when the import has completed, a failed import will process them again
+		self._fetched_takeouts = takeouts if not pretend else None
+
+		log.debug( f'fetched {len( summaries )} Waze activities from {len( changed )} new or changed takeouts' )
 
-		# self.ctx.complete( 'done' )
+		return summaries
 
-		log.debug( f'fetched {len( summaries )} Waze activities' )
+	def postprocess_import( self, force: bool = False, pretend: bool = False, **kwargs ) -> None:
+		if self._fetched_takeouts is not None and not pretend:
+			self.processed_takeouts = self._fetched_takeouts
+		self._fetched_takeouts = None
 
-		return summaries
+	def _parse_takeouts( self, contents: List[bytes], processes: int = 0 ) -> List[Optional[List[LocationDetail]]]:
+		parse = partial( parse_takeout, field_size_limit=self.field_size_limit )
+		if processes > 0 and len( contents ) > 1:
+			with ProcessPoolExecutor( max_workers=processes, mp_context=get_context( 'spawn' ) ) as executor:
+				return list( executor.map( parse, contents ) )
+		return [ parse( c ) for c in contents ]
 
 	def download( self, summary: Resource, force: bool = False, pretend: bool = False, **kwargs ) -> List[Resource]:
 		try:
@@ -531,14 +613,13 @@ class Waze( Service ):
 
 	def download_resource( self, resource: Resource, **kwargs ) -> Tuple[Any, int]:
 		if (summary := kwargs.get( 'summary' )) and summary.raw:
-			resource.raw, resource.content = to_gpx( cast( LocationDetail, summary.raw ).as_point_list() )
+			resource.content = to_gpx( cast( LocationDetail, summary.raw ) )
 			resource.status = 200
 		else:
 			local_path = Path( self.path_for( resource=resource ).parent, f'{resource.local_id}.txt' )
 			with open( local_path, mode='r', encoding='UTF-8' ) as p:
 				content = p.read()
-				drive = self._drive_importer.read_drive( content )
-				gpx = to_gpx( drive )
+				gpx = to_gpx( LocationDetail( coordinates=content ) )
 				return gpx, 200  # return always 200
 
 	# def postdownload( self, ctx: ApplicationContext ) -> None:
@@ -551,16 +632,32 @@ class Waze( Service ):
 
 # helper functions
 
-def to_gpx( points: List[Point] ) -> Tuple[GPX, bytes]:
-	trackpoints = [GPXTrackPoint( time=p.time, latitude=p.lat, longitude=p.lon ) for p in points]
-	segment = GPXTrackSegment( points=trackpoints )
-	track = GPXTrack()
-	track.segments.append( segment )
-	gpx = GPX()
-	gpx.tracks.append( track )
-	return gpx, bytes( gpx.to_xml(), 'UTF-8' )
+def parse_takeout( content: bytes, field_size_limit: int = DEFAULT_FIELD_SIZE_LIMIT ) -> Optional[List[LocationDetail]]:
+	"""
+	Parses the drives contained in an account activity takeout, intended to be run in a separate process. Drives without
+	timestamps are ignored (see issue #74). Coordinates are parsed here as well, so the parsed columns are sent back to
+	the calling process. Errors are not sent back, None is returned instead. Rows are read lazily, without keeping all
+	rows of the takeout in memory.
+	"""
+	try:
+		takeout_importer = WazeAccountActivityImporter( field_size_limit=field_size_limit )
+		account_activity = cast( AccountActivity, takeout_importer.load_data( takeout_importer.rows( content ) ) )
+		return [ ld for ld in account_activity.location_details if ld.has_times() ]
+	except Exception:
+		return None
+
+def to_gpx( location_detail: LocationDetail ) -> bytes:
+	return format_gpx( [ location_detail.as_stream() ], extensions=False ).encode( 'UTF-8' )
 
 # helper
 
+@lru_cache( maxsize=1024 )
+def _day_seconds( day: str ) -> float:
+	return ( datetime.fromisoformat( day ) - EPOCH ).total_seconds()
+
+def _seconds( t: str ) -> float:
+	# t is either empty or has the format YYYY-MM-DD HH:MM:SS, days are cached as drives usually span a single day
+	return _day_seconds( t[:10] ) + int( t[11:13] ) * 3600 + int( t[14:16] ) * 60 + int( t[17:19] ) if t else nan
+
 def _snake( s: str ) -> str:
 	return s.lower().replace( ' ', '_' )
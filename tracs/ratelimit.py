@@ -0,0 +1,181 @@
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from logging import getLogger
+from threading import Lock
+from time import sleep
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
+
+from attrs import define, field
+from dateutil.tz import UTC
+from requests import Response, Session
+
+log = getLogger( __name__ )
+
+PERIOD_QUARTER = 'quarter'
+PERIOD_DAY = 'day'
+
+USAGE_HEADERS = [ ( 'X-ReadRateLimit-Usage', 'X-ReadRateLimit-Limit' ), ( 'X-RateLimit-Usage', 'X-RateLimit-Limit' ) ]
+
+DEFAULT_MAX_WAIT = 900 # seconds
+
+class RateLimitExceeded( Exception ):
+
+	def __init__( self, message: str, reset: Optional[datetime] = None ):
+		super().__init__( message )
+		self.reset = reset
+
+@define
+class RateWindow:
+	"""
+	Request budget for a fixed time window: the window is a token bucket holding limit tokens, which is refilled
+	completely at the end of the window. Windows are aligned to quarters of an hour resp. to days (UTC), which is how
+	Strava counts requests.
+	"""
+
+	name: str = field( default=None )
+	limit: int = field( default=0 )
+	period: str = field( default=PERIOD_QUARTER )
+	usage: int = field( default=0 )
+	reset: Optional[datetime] = field( default=None )
+
+	def next_reset( self, now: datetime ) -> datetime:
+		if self.period == PERIOD_DAY:
+			return datetime( now.year, now.month, now.day, tzinfo=UTC ) + timedelta( days=1 )
+		else:
+			return datetime( now.year, now.month, now.day, now.hour, now.minute - now.minute % 15, tzinfo=UTC ) + timedelta( minutes=15 )
+
+	def refresh( self, now: datetime ) -> None:
+		if self.reset is None or now >= self.reset:
+			self.usage, self.reset = 0, self.next_reset( now )
+
+	def remaining( self, reserve: int = 0 ) -> int:
+		return max( self.limit - reserve - self.usage, 0 )
+
+	def to_dict( self ) -> Dict[str, Any]:
+		return { 'limit': self.limit, 'usage': self.usage, 'reset': self.reset.isoformat() if self.reset else None }
+
+	def load( self, state: Mapping[str, Any] ) -> None:
+		self.limit = state.get( 'limit' ) or self.limit
+		self.usage = state.get( 'usage' ) or 0
+		self.reset = datetime.fromisoformat( state.get( 'reset' ) ) if state.get( 'reset' ) else None
+
+class RateLimiter:
+	"""
+	Schedules requests against a set of rate windows (i.e. a 15-minute and a daily budget). Each request takes a token
+	from every window, a request waiting for an empty window is paused until the window is refilled. If that takes longer
+	than max_wait seconds the budget is considered as exhausted and RateLimitExceeded is raised instead, without issuing
+	the request. Usage and limits are synchronized with the usage reported by the server after each response.
+	"""
+
+	def __init__(
+			self,
+			*windows: RateWindow,
+			reserve: int = 0,
+			max_wait: float = DEFAULT_MAX_WAIT,
+			state: Optional[Mapping[str, Any]] = None,
+			on_update: Optional[Callable[[Dict[str, Any]], None]] = None,
+			clock: Callable[[], datetime] = None,
+			sleeper: Callable[[float], None] = None,
+	):
+		self.windows: List[RateWindow] = list( windows )
+		self.reserve = reserve
+		self.max_wait = max_wait
+		self.on_update = on_update
+		self.clock = clock or ( lambda: datetime.now( UTC ) )
+		self.sleeper = sleeper or sleep
+		self._lock = Lock()
+
+		for w in self.windows:
+			if state and state.get( w.name ):
+				w.load( state.get( w.name ) )
+
+	@classmethod
+	def from_config( cls, config: Mapping[str, Any], **kwargs ) -> RateLimiter:
+		"""
+		Creates a limiter from a plugin configuration area having the keys short (requests per 15 minutes), daily
+		(requests per day), reserve and max_wait.
+		"""
+		return RateLimiter(
+			RateWindow( name='short', limit=config.get( 'short', 100 ), period=PERIOD_QUARTER ),
+			RateWindow( name='daily', limit=config.get( 'daily', 1000 ), period=PERIOD_DAY ),
+			reserve=config.get( 'reserve', 0 ),
+			max_wait=config.get( 'max_wait', DEFAULT_MAX_WAIT ),
+			**kwargs
+		)
+
+	def state( self ) -> Dict[str, Any]:
+		return { w.name: w.to_dict() for w in self.windows }
+
+	def acquire( self ) -> None:
+		"""
+		Takes a token from all windows, waits until a token becomes available if necessary.
+		"""
+		while True:
+			with self._lock:
+				now = self.clock()
+				[ w.refresh( now ) for w in self.windows ]
+				if not ( empty := [ w for w in self.windows if w.remaining( self.reserve ) == 0 ] ):
+					for w in self.windows:
+						w.usage += 1
+					return
+
+				reset = max( w.reset for w in empty )
+				wait = ( reset - now ).total_seconds()
+
+			if wait > self.max_wait:
+				raise RateLimitExceeded( f'rate limit exhausted, budget will be refilled at {reset.isoformat()}', reset )
+
+			log.info( f'rate limit reached, pausing requests for {wait:.0f} seconds until {reset.isoformat()}' )
+			self.sleeper( wait )
+
+	def update( self, headers: Mapping[str, str], status: int = 200 ) -> None:
+		"""
+		Synchronizes usage and limits with the values reported by the server.
+
+		:param headers: response headers containing the usage and limit headers
+		:param status: response status, 429 means that the server considers the budget as exhausted
+		"""
+		rates = parse_rate_headers( headers )
+		with self._lock:
+			now = self.clock()
+			for index, w in enumerate( self.windows ):
+				w.refresh( now )
+				if rates and index < len( rates[0] ):
+					w.usage, w.limit = max( w.usage, rates[0][index] ), rates[1][index]
+			if status == 429 and not any( w.remaining() == 0 for w in self.windows ):
+				self.windows[0].usage = self.windows[0].limit # server says no, so don't try again in this window
+			if self.on_update:
+				self.on_update( self.state() )
+
+class RateLimitedSession( Session ):
+	"""
+	Session taking a token from a rate limiter before each request and feeding the limiter with the rate limit
+	headers of each response.
+	"""
+
+	def __init__( self, limiter: RateLimiter ):
+		super().__init__()
+		self.limiter = limiter
+
+	def request( self, method, url, *args, **kwargs ) -> Response:
+		self.limiter.acquire()
+		response = super().request( method, url, *args, **kwargs )
+		self.limiter.update( response.headers, response.status_code )
+		return response
+
+def parse_rate_headers( headers: Mapping[str, str] ) -> Optional[Tuple[List[int], List[int]]]:
+	"""
+	Parses usage and limits from rate limit headers, read limits are preferred as they are stricter.
+
+	:param headers: response headers
+	:return: tuple of usage and limits, one entry per window, or None if headers are missing
+	"""
+	for usage_header, limit_header in USAGE_HEADERS:
+		if ( usage := headers.get( usage_header ) ) and ( limit := headers.get( limit_header ) ):
+			try:
+				return [ int( u ) for u in usage.split( ',' ) ], [ int( l ) for l in limit.split( ',' ) ]
+			except ValueError:
+				log.debug( f'unable to parse rate limit headers {usage_header}={usage}, {limit_header}={limit}' )
+	return None
@@ -2,6 +2,7 @@ from __future__ import annotations
 
 from enum import Enum
 from functools import cached_property
+from hashlib import blake2b
 from logging import getLogger
 from re import compile, Pattern
 from typing import Any, Callable, ClassVar, Dict, List, Optional, Union
@@ -99,6 +100,8 @@ class Resource:
 	path: str = field( default=None )
 	source: str = field( default=None )
 	status: int = field( default=None )
+	digest: str = field( default=None )
+	"""Digest of the content, used to detect identical content, see content_digest()"""
 	# field type is actually UID, str is only allowed in constructor
 	uid: UID|str = field( default=None, converter=lambda u: UID.from_str( u ) if isinstance( u, str ) else u )
 
@@ -293,6 +296,26 @@ class Resources( list[Resource] ):
 	def to_dict( self ) -> List[Dict[str, Any]]:
 		return [ r.to_dict() for r in self ]
 
+# helpers
+
+def content_digest( content: Optional[bytes] ) -> Optional[str]:
+	"""
+	Calculates a digest of the provided content, this is used to detect resources having identical content.
+
+	:param content: content to calculate the digest for
+	:return: digest as hex string or None if content is missing
+	"""
+	return blake2b( content, digest_size=16 ).hexdigest() if content else None
+
+def content_hasher() -> blake2b:
+	"""
+	Returns a hash object for calculating a content digest incrementally, the resulting hex digest is identical to the
+	digest calculated by content_digest().
+
+	:return: hash object
+	"""
+	return blake2b( digest_size=16 )
+
 # configure converters
 
 Resource.converter.register_unstructure_hook( UID, lambda uid: uid.to_str() )
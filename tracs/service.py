@@ -2,13 +2,18 @@
 from __future__ import annotations
 
 from abc import abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from inspect import getmembers
 from logging import getLogger
+from multiprocessing import get_context
 from pathlib import Path
-from typing import Any, cast, List, Optional, Tuple, Union
+from time import monotonic
+from typing import Any, cast, Dict, Iterable, List, Optional, Tuple, Type, Union
 
 from arrow import utcnow
+from attrs import define, field
 from dateutil.tz import UTC
 from fs.base import FS
 from fs.copy import copy_file
@@ -18,14 +23,82 @@ from fs.osfs import OSFS
 from fs.path import basename, combine, dirname, isabs, join, parts, split
 
 from tracs.activity import Activity
-from tracs.config import current_ctx, DB_DIRNAME
-from tracs.db import ActivityDb
+from tracs.cache import ActivityCache
+from tracs.config import ApplicationContext, current_ctx, DB_DIRNAME, KEY_LAST_FETCH
+from tracs.db import ActivityDb, resource_key
+from tracs.handlers import ResourceHandler
+from tracs.journal import ImportJournal
+from tracs.pipeline import Coordinator, DEFAULT_QUEUE_SIZE, Pipeline, Stage, StageMetrics
 from tracs.plugin import Plugin
-from tracs.resources import Resource, Resources
+from tracs.ratelimit import RateLimitExceeded
+from tracs.resources import content_digest, content_hasher, Resource, Resources
 from tracs.uid import UID
 
 log = getLogger( __name__ )
 
+DOWNLOAD_CHUNK_SIZE = 65536
+PARTIAL_SUFFIX = '.part'
+
+# ---- state of a running import ----
+
+@define
+class ImportBatch:
+	"""
+	Collects new/updated activities during an import and applies them to the db via one bulk upsert followed by a
+	single commit. The batch is flushed after size activities or when interval seconds have passed since the last
+	flush, whatever comes first. A size of 0 and an interval of 0 disable intermediate flushes. When a coordinator is
+	provided, flushes are carried out by the coordinator thread.
+	"""
+
+	db: ActivityDb = field( default=None )
+	coordinator: Optional[Coordinator] = field( default=None )
+	size: int = field( default=100 )
+	interval: float = field( default=0 )
+	save: bool = field( default=True ) # save db to disk on flush, so an interrupted import does not lose everything
+	pending: List[Activity] = field( factory=list )
+	flushes: int = field( default=0 )
+	last_flush: float = field( factory=monotonic )
+
+	def add( self, *activities: Activity ) -> bool:
+		"""
+		Adds activities to the batch and flushes the batch when it is due.
+
+		:return: True if the batch has been flushed
+		"""
+		self.pending.extend( activities )
+		if ( self.size > 0 and len( self.pending ) >= self.size ) or ( self.interval > 0 and monotonic() - self.last_flush >= self.interval ):
+			self.flush()
+			return True
+		return False
+
+	def flush( self ) -> None:
+		pending, self.pending = self.pending, []
+		if self.coordinator:
+			self.coordinator.submit( self._write, pending )
+		else:
+			self._write( pending )
+		self.flushes += 1
+		self.last_flush = monotonic()
+
+	def _write( self, activities: List[Activity] ) -> None:
+		if activities:
+			self.db.upsert_activities( activities )
+		self.db.commit()
+		if self.save:
+			self.db.save()
+
+@define
+class ImportRun:
+
+	journal: Optional[ImportJournal] = field( default=None )
+	batch: Optional[ImportBatch] = field( default=None )
+	downloaded: Dict[Tuple[str, str], List[Resource]] = field( factory=dict ) # resources downloaded by an interrupted import
+	watermark: Optional[datetime] = field( default=None )
+	exhausted: Optional[RateLimitExceeded] = field( default=None ) # set when the rate limit of the service has been exhausted
+
+	def downloaded_resources( self, summary: Resource ) -> Optional[List[Resource]]:
+		return self.journal.downloaded_resources( self.downloaded, summary ) if self.journal and self.downloaded else None
+
 # ---- base class for a service ----
 
 class Service( Plugin ):
@@ -40,6 +113,7 @@ class Service( Plugin ):
 		self._rootfs = OSFS( '/' )
 		self._base_url = kwargs.get( 'base_url' )
 		self._logged_in: bool = False
+		self.metrics: Dict[str, StageMetrics] = {} # metrics of the last import
 
 		# set service properties from kwargs, if a setter exists # todo: is this really needed?
 		for p in getmembers( self.__class__, lambda p: type( p ) is property and p.fset is not None ):
@@ -70,6 +144,22 @@ class Service( Plugin ):
 	def _db( self ) -> ActivityDb:
 		return self.db
 
+	@property
+	def last_fetch( self ) -> Optional[datetime]:
+		"""
+		High-water mark of the last successful import: the latest start time of all activities seen so far.
+		"""
+		try:
+			last_fetch = datetime.fromisoformat( self._state.get( KEY_LAST_FETCH ) )
+			return last_fetch if last_fetch.tzinfo else last_fetch.replace( tzinfo=UTC )
+		except (AttributeError, TypeError, ValueError):
+			return None
+
+	@last_fetch.setter
+	def last_fetch( self, last_fetch: Union[datetime, str] ) -> None:
+		last_fetch = last_fetch.astimezone( UTC ).isoformat() if isinstance( last_fetch, datetime ) else last_fetch
+		self.set_state_value( KEY_LAST_FETCH, last_fetch )
+
 	# fs properties (read-only)
 
 	@property
@@ -135,10 +225,17 @@ class Service( Plugin ):
 	def as_activity( resource: Resource, **kwargs ) -> Activity:
 		"""
 		Loads a resource and transforms it into an activity by using the importer indicated by the resource type.
+		Activities of unchanged resources are taken from the activity cache, without loading the resource.
 		"""
-		Service.load_resources( None, resource )
-		importer = kwargs.get( 'ctx', current_ctx() ).registry.importer_for( resource.type )
-		activity = importer.load_as_activity( resource=resource )
+		ctx = kwargs.get( 'ctx', current_ctx() )
+		importer = ctx.registry.importer_for( resource.type )
+		cache, key = Service._activity_cache( resource, importer, ctx )
+		if not ( activity := cache.get( key ) if key else None ):
+			# only the content is loaded, the importer decides whether raw and data are needed to create the activity
+			resource.content, resource.raw, resource.data = importer.load_content( path=resource.path, fs=ctx.db_fs ), None, None
+			activity = importer.load_as_activity( resource=resource )
+			if key and activity:
+				cache.put( key, activity )
 		activity.metadata.created = utcnow().datetime
 		activity.resources = Resources( resource )
 		return activity
@@ -146,10 +243,46 @@ class Service( Plugin ):
 	@staticmethod
 	def as_activity_from( resource: Resource, **kwargs ) -> Optional[Activity]:
 		"""
-		Loads a resource to an activity in a 'lazy' manner, reusing the existing content of the resource.
+		Loads a resource to an activity in a 'lazy' manner, reusing the existing content of the resource. Activities of
+		unchanged resources, which have not been loaded yet, are taken from the activity cache.
 		"""
 		registry = kwargs.get( 'registry', current_ctx().registry )
-		return registry.importer_for( resource.type ).load_as_activity( resource=resource, **kwargs )
+
+		if kwargs.get( 'cache', True ) and resource.content is None and resource.raw is None and resource.path is not None:
+			cache, key = Service._activity_cache( resource, registry.importer_for( resource.type ), kwargs.get( 'ctx', current_ctx() ) )
+			if key and ( activity := cache.get( key ) ):
+				activity.resources.append( resource )
+				return activity
+			elif key:
+				if activity := Service.as_activity_from( resource, **{ **kwargs, 'cache': False } ):
+					cache.put( key, activity )
+				return activity
+
+		# resources streamed to the db come without content: read content from disk and drop it again after parsing
+		if lazy := resource.content is None and resource.raw is None and resource.path is not None:
+			try:
+				resource.content = kwargs.get( 'ctx', current_ctx() ).db_fs.readbytes( Service.path_for_resource( resource, absolute=False, as_path=False ) )
+			except (ResourceNotFound, TypeError):
+				log.error( f'unable to load content of resource {resource.uidpath} from db' )
+
+		try:
+			return registry.importer_for( resource.type ).load_as_activity( resource=resource, **{ k: v for k, v in kwargs.items() if k != 'cache' } )
+		finally:
+			if lazy:
+				resource.content = None
+
+	@staticmethod
+	def _activity_cache( resource: Resource, importer: Optional[ResourceHandler], ctx: ApplicationContext ) -> Tuple[Optional[ActivityCache], Optional[str]]:
+		"""
+		Returns the activity cache of the context together with the key for the provided resource, key is None if the
+		resource cannot be cached.
+		"""
+		if importer is None or resource.path is None or ( cache := ActivityCache.for_context( ctx ) ) is None:
+			return None, None
+		try:
+			return cache, importer.cache_key( Service.path_for_resource( resource, absolute=False, as_path=False ), ctx.db_fs )
+		except (AttributeError, TypeError):
+			return None, None
 
 	@staticmethod
 	def load_resources( activity: Optional[Activity] = None, *resources: Resource, **kwargs ):
@@ -288,6 +421,50 @@ class Service( Plugin ):
 		"""
 		pass
 
+	def stream_resource( self, resource: Resource, chunks: Iterable[bytes], pretend: bool = False ) -> bool:
+		"""
+		Writes downloaded content chunk by chunk to the db, without holding the content in memory. Chunks are written to
+		a temporary file first, which replaces the target file only when the download is complete. Digest and size are
+		calculated on the fly, the resource is updated with path and digest and remains without content.
+		When pretending, content is kept in memory instead.
+
+		:param resource: resource to write
+		:param chunks: content to write, i.e. a response's iter_content()
+		:param pretend: pretend flag, do not write anything
+		:return: True if content has been written, False if there was no content
+		"""
+		if pretend:
+			resource.content = b''.join( chunks )
+			return len( resource.content ) > 0
+
+		path = self.path_for( resource )
+		partial_path, hasher, size = f'{path}{PARTIAL_SUFFIX}', content_hasher(), 0
+
+		try:
+			self.dbfs.makedirs( dirname( path ), recreate=True )
+			with self.dbfs.openbin( partial_path, 'w' ) as f:
+				for chunk in chunks:
+					f.write( chunk )
+					hasher.update( chunk )
+					size += len( chunk )
+
+			if size == 0:
+				log.debug( f'not persisting resource {resource.uidpath} as content missing (0 bytes)' )
+				self.dbfs.remove( partial_path )
+				return False
+
+			self.dbfs.move( partial_path, path, overwrite=True )
+
+		except Exception:
+			if self.dbfs.exists( partial_path ):
+				self.dbfs.remove( partial_path )
+			raise
+
+		resource.path, resource.digest, resource.content = path, hasher.hexdigest(), None
+		self._db.update_resource_digest( resource )
+		log.debug( f'streamed {size} bytes of resource {resource.uidpath} to {path}' )
+		return True
+
 	def persist_resources( self, resources: List[Resource], force: bool, pretend: bool, **kwargs ) -> None:
 		[ self.persist_resource( r, force, pretend, **kwargs ) for r in resources ]
 
@@ -306,14 +483,25 @@ class Service( Plugin ):
 			log.debug( f'not persisting resource {resource.uidpath}, path already exists: {path}, use --force to overwrite' )
 			return
 
+		if not resource.content and resource.digest and self.dbfs.exists( path ):
+			log.debug( f'not persisting resource {resource.uidpath}, content has been streamed to {path} already' )
+			return
+
 		if not resource.content or not len( resource.content ) > 0:
 			log.debug( f'not persisting resource {resource.uidpath} as content missing (0 bytes)' )
 			return
 
+		# skip writing when the db knows that the file contains exactly the same bytes
+		resource.digest = content_digest( resource.content )
+		if self.dbfs.exists( path ) and self._db.resource_key_for_digest( resource.digest ) == resource_key( resource.uid, path ):
+			log.debug( f'not persisting resource {resource.uidpath}, content is identical to existing file {path}' )
+			return
+
 		try:
 			self.dbfs.makedirs( dirname( path ), recreate=True )
 			self.dbfs.writebytes( path, resource.content )
 			resource.path = path # adjust resource
+			self._db.update_resource_digest( resource )
 		except TypeError:
 			log.error( f'error writing resource data for resource {resource.uidpath}', exc_info=True )
 
@@ -344,6 +532,13 @@ class Service( Plugin ):
 	def create_activities( self, summary: Resource, resources: List[Resource], **kwargs ) -> List[Activity]:
 		return [ self.activity_from( summary, resources, **kwargs ) ]
 
+	def postprocess_import( self, force: bool = False, pretend: bool = False, **kwargs ) -> None:
+		"""
+		Called after an import has completed without errors, subclasses may persist state here which must not be
+		recorded before all activities have been added to the db. By default, nothing is done.
+		"""
+		pass
+
 	# noinspection PyMethodMayBeStatic
 	def postprocess_activities( self, activities: List[Activity], resources: List[Resource], **kwargs ) -> List[Activity]:
 		"""
@@ -355,8 +550,29 @@ class Service( Plugin ):
 		"""
 		return activities
 
-	def persist_activities( self, activities: List[Activity], force: bool, pretend: bool, **kwargs ) -> None:
-		[ self._db.upsert_activity( a ) for a in activities ]
+	def persist_activities( self, activities: List[Activity], force: bool, pretend: bool, **kwargs ) -> bool:
+		"""
+		Adds activities to the db. When a batch is provided via kwargs, activities are collected and applied in bulk
+		when the batch is due. Otherwise activities are upserted right away, by the coordinator thread if a coordinator
+		is provided.
+
+		:return: True if the activities have been written to the db (or the batch has been flushed)
+		"""
+		if batch := kwargs.get( 'batch' ):
+			return batch.add( *activities )
+		if coordinator := kwargs.get( 'coordinator' ):
+			coordinator.submit( self._db.upsert_activities, activities )
+		else:
+			self._db.upsert_activities( activities )
+		return True
+
+	def create_batch( self, **kwargs ) -> ImportBatch:
+		return ImportBatch(
+			db=self._db,
+			coordinator=kwargs.get( 'coordinator' ),
+			size=kwargs.get( 'commit_every', 100 ),
+			interval=kwargs.get( 'commit_interval', 0 )
+		)
 
 	def import_activities( self, force: bool = False, pretend: bool = False, **kwargs ):
 		if 'unified_import' in dir( self ):
@@ -366,15 +582,19 @@ class Service( Plugin ):
 		fetch_all = kwargs.get( 'fetch_all', False )
 		first_year = kwargs.get( 'first_year', 2000 )
 		days_range = kwargs.get( 'days_range', 90 )
+		overlap = kwargs.get( 'overlap', 3 )
 
 		if fetch_all:
 			range_from = datetime( first_year, 1, 1, tzinfo=UTC )
+		elif last_fetch := self.last_fetch:
+			range_from = last_fetch - timedelta( days=overlap )
 		else:
 			range_from = datetime.utcnow().astimezone( UTC ) - timedelta( days = days_range )
 		range_to = datetime.utcnow().astimezone( UTC ) + timedelta( days=1 )
 
 		skip_fetch = kwargs.get( 'skip_fetch', False )
-		skip_download = kwargs.get( 'skip_download', False )
+		journal = ImportJournal( self.ctx.var_fs, self.name ) if not pretend and self.ctx.var_fs else None
+		run = ImportRun( journal=journal, batch=self.create_batch( **kwargs ), watermark=self.last_fetch )
 
 		if not self.login():
 			return
@@ -382,55 +602,178 @@ class Service( Plugin ):
 		# start fetch task
 		self.ctx.start( f'fetching activity data from {self.display_name}, ()' )
 
-		# fetch summaries
-		summaries = self.fetch_summary_resources( skip_fetch, force, pretend, **{ 'range_from': range_from, 'range_to': range_to, **kwargs } )
-		summaries = self.postprocess_summaries( summaries, **kwargs )  # post process summaries
+		if resumed := bool( kwargs.get( 'resume' ) and journal and journal.exists() ):
+			# continue an interrupted import: summaries are taken from the journal instead of being fetched again
+			summaries, run.downloaded = journal.load()
+			summaries = self.adopt_resources( summaries )
+			log.info( f'resuming import from {self.display_name}, journal contains {len( summaries )} summaries' )
+
+		else:
+			if kwargs.get( 'resume' ):
+				log.info( f'no interrupted import found for {self.display_name}, starting a new import' )
+
+			# fetch summaries
+			try:
+				summaries = self.fetch_summary_resources( skip_fetch, force, pretend, **{ 'range_from': range_from, 'range_to': range_to, **kwargs } )
+			except RateLimitExceeded as rle:
+				log.error( f'unable to fetch activities from {self.display_name}: {rle}' )
+				self.ctx.complete( 'done' )
+				return
+
+			summaries = self.postprocess_summaries( summaries, **kwargs )  # post process summaries
 
 		log.debug( f'fetched {len( summaries)} from service {self.display_name}' )
 
 		# filter out summaries that are already known
 		if not force:
-			summaries = [s for s in summaries if not self.ctx.db.contains_resource( s.uid, s.path )]
+			known = self.ctx.db.known_resources( summaries )
+			summaries = [s for s in summaries if s not in known]
 			# this should also work
 			# summaries = [s for s in summaries if not self.ctx.db.contains_activity( s.uid )]
 
+		# record summaries in the journal, summaries are persisted right away, so a resumed import can reload them
+		if journal and not resumed:
+			self.persist_resources( summaries, force=force, pretend=pretend, **kwargs )
+			journal.start( summaries )
+
 		log.debug( f'downloading activity data for {len( summaries)}' )
 
 		# mark task as done
 		self.ctx.complete( 'done' )
 
-		# download resources
+		# download resources, persist them and create activities in a pipeline: downloading, writing and parsing
+		# run on threads, connected by bounded queues, db operations are carried out on the current thread only (or by
+		# the coordinator, when several services are imported at the same time)
 
 		self.ctx.start( f'downloading activity data from {self.display_name}', len( summaries ) )
 
-		while summaries and ( summary := summaries.pop() ):
-			# download resources for summary
-			self.ctx.advance( f'{summary.uid}' )
-
-			downloaded_resources = self.download( summary=summary, force=force, pretend=pretend, **kwargs ) if not skip_download else []
-			downloaded_resources = self.postprocess_downloaded( downloaded_resources, **kwargs )  # post process
-			resources = [summary, *downloaded_resources]
+		processes = kwargs.get( 'processes', 0 )
+		executor = ProcessPoolExecutor( max_workers=processes, mp_context=get_context( 'spawn' ) ) if processes > 0 else None
 
-			# persist all resources
-			self.persist_resources( resources, force=force, pretend=pretend, **kwargs )
+		pipeline = Pipeline(
+			Stage( 'download', partial( self._download_stage, run=run, force=force, pretend=pretend, **kwargs ), workers=kwargs.get( 'workers', 1 ) ),
+			Stage( 'persist', partial( self._persist_stage, run=run, force=force, pretend=pretend, **kwargs ) ),
+			Stage( 'parse', partial( self._parse_stage, executor=executor, **kwargs ), workers=processes if executor else 1 ),
+			queue_size=kwargs.get( 'queue_size', DEFAULT_QUEUE_SIZE )
+		)
 
-			# create activity/activities from downloaded resources
-			activities = self.create_activities( summary=summary, resources=resources, **kwargs )
-			activities = self.postprocess_activities( activities, resources, **kwargs )
+		try:
+			self.metrics = pipeline.run( reversed( summaries ), partial( self._upsert_stage, run=run, force=force, pretend=pretend, **kwargs ) )
+		finally:
+			if executor:
+				executor.shutdown()
 
-			# persist activities
-			self.persist_activities( activities, force=force, pretend=pretend, **kwargs )
+		[ log.debug( f'import from {self.display_name}, {m}' ) for m in self.metrics.values() ]
 
 		# mark download task as done
-		self._db.commit()
+		run.batch.flush()
 		self.ctx.complete( 'done' )
 
+		# keep the journal when the rate limit has been hit, a later import can be resumed from there
+		if run.exhausted:
+			log.warning( f'import from {self.display_name} stopped early: {run.exhausted}, use --resume to continue' )
+			return
+
+		# same when items have failed: they would not be fetched again once the watermark has passed them
+		if pipeline.errors:
+			log.warning( f'import from {self.display_name} finished with {pipeline.errors} errors, use --resume to retry failed activities' )
+			return
+
+		if journal:
+			journal.complete()
+
+		# move watermark forward after a successful import
+		if run.watermark and not pretend and not skip_fetch:
+			self.last_fetch = run.watermark
+
+		self.postprocess_import( force=force, pretend=pretend, **kwargs )
+
+	def adopt_resources( self, resources: List[Resource] ) -> List[Resource]:
+		"""
+		Loads the content of resources which have already been persisted, i.e. by an interrupted import.
+
+		:param resources: resources to adopt
+		:return: resources having their content loaded from the db
+		"""
+		for r in resources:
+			try:
+				r.content = self.dbfs.readbytes( self.path_for( r ) )
+			except (ResourceNotFound, TypeError):
+				log.debug( f'unable to adopt resource {r.uidpath}, file does not exist' )
+		return resources
+
+	# import pipeline stages
+
+	def _download_stage( self, summary: Resource, run: ImportRun, force: bool, pretend: bool, **kwargs ) -> Tuple[Resource, List[Resource]]:
+		self.ctx.advance( f'{summary.uid}' )
+
+		# reuse resources of an interrupted import, if they have been persisted completely
+		if ( downloaded := run.downloaded_resources( summary ) ) is not None and all( r.content for r in self.adopt_resources( downloaded ) ):
+			log.debug( f'adopted {len( downloaded )} resources for {summary.uid} from an interrupted import' )
+			return summary, [summary, *downloaded]
+
+		# skip remaining downloads once the rate limit is exhausted, instead of failing one by one
+		if run.exhausted:
+			return None
+
+		try:
+			downloaded_resources = self.download( summary=summary, force=force, pretend=pretend, **kwargs ) if not kwargs.get( 'skip_download' ) else []
+		except RateLimitExceeded as rle:
+			run.exhausted = rle
+			return None
+
+		downloaded_resources = self.postprocess_downloaded( downloaded_resources, **kwargs )  # post process
+		return summary, [summary, *downloaded_resources]
+
+	def _persist_stage( self, item: Tuple[Resource, List[Resource]], run: ImportRun, force: bool, pretend: bool, **kwargs ) -> Tuple[Resource, List[Resource]]:
+		self.persist_resources( item[1], force=force, pretend=pretend, **kwargs )
+		if run.journal:
+			run.journal.downloaded( item[0], item[1][1:] )
+
+		# downloaded content is on disk now, don't keep it in memory: parsers read it from the db when they need it
+		if not pretend:
+			for r in item[1][1:]:
+				if r.digest and r.raw is None:
+					r.content, r.text = None, None
+
+		return item
+
+	def _parse_stage( self, item: Tuple[Resource, List[Resource]], executor: Optional[Executor] = None, **kwargs ) -> Tuple[List[Activity], List[Resource]]:
+		summary, resources = item
+
+		# summaries with unparsed content are parsed in a separate process, as long as activity creation is not customized
+		if executor and summary.content and summary.raw is None and type( self ).create_activities is Service.create_activities:
+			handler = self.ctx.registry.importer_for( summary.type )
+			resource = Resource( uid=str( summary.uid ), path=summary.path, type=summary.type, content=summary.content )
+			activity = executor.submit( parse_activity, type( handler ), resource ).result()
+			activity.resources = Resources( *resources )
+			activity.metadata.created = datetime.now( UTC )
+			activities = [ activity ]
+		else:
+			activities = self.create_activities( summary=summary, resources=resources, **kwargs )
+
+		return self.postprocess_activities( activities, resources, **kwargs ), resources
+
+	def _upsert_stage( self, item: Tuple[List[Activity], List[Resource]], run: ImportRun, force: bool, pretend: bool, **kwargs ) -> None:
+		activities, resources = item
+		flushed = self.persist_activities( activities, force=force, pretend=pretend, **{ **kwargs, 'batch': run.batch } )
+
+		# remember the latest start time seen so far
+		for starttime in [ a.starttime if a.starttime.tzinfo else a.starttime.replace( tzinfo=UTC ) for a in activities if a.starttime ]:
+			run.watermark = starttime if not run.watermark or starttime > run.watermark else run.watermark
+
+		if run.journal:
+			run.journal.upserted( resources[0] )
+			if flushed:
+				run.journal.committed()
+
 	def _import_activities( self, force: bool = False, **kwargs ):
 		# call to import of service
 		# assumption: new/updated activities with new/updated resources are returned + fs which is used to resolve paths in resources
 		activities, import_fs = self.unified_import( force=force, **kwargs )
 
-		# process activities
+		# process activities, db is updated in batches
+		batch = self.create_batch( **kwargs )
 		for a in activities:
 			# move imported resources
 			for r in a.resources:
@@ -449,15 +792,21 @@ class Service( Plugin ):
 					log.info( f'skipping import of resource {r}, file already exists, use option -f/--force to force overwrite' )
 
 			# insert / upsert newly created activities
-			if self.ctx.db.contains_activity( a.uid ):
-				self.ctx.db.upsert_activity( a )
-			else:
-				self.ctx.db.insert( a )
+			self.persist_activities( [ a ], force=force, pretend=kwargs.get( 'pretend', False ), batch=batch )
 
-			self.ctx.db.commit()
+		batch.flush()
 
 # helper functions
 
+def parse_activity( handler_cls: Type[ResourceHandler], resource: Resource ) -> Optional[Activity]:
+	"""
+	Parses the content of a resource and creates an activity from it. This is intended to be run in a separate process,
+	only the activity without any resources is sent back.
+	"""
+	activity = handler_cls().load_as_activity( resource=resource )
+	activity.resources = Resources()
+	return activity
+
 def path_for_id( local_id: Union[int, str], base_path: Optional[Path] = None, resource_path: Optional[Path] = None ) -> Path:
 	local_id_rjust = str( local_id ).rjust( 3, '0' )
 	path = Path( f'{local_id_rjust[0]}/{local_id_rjust[1]}/{local_id_rjust[2]}/{local_id}' )
@@ -10,6 +10,7 @@ from rich.table import Table
 
 from tracs.activity import Activity
 from tracs.activity_types import ActivityTypes
+from tracs.cache import ActivityCache
 from tracs.config import ApplicationContext, console
 from tracs.registry import Registry
 from tracs.resources import Resource
@@ -32,7 +33,7 @@ def show_resources( activities: List[Activity], ctx: ApplicationContext, display
 
 			table.add_row( '[bright_blue]native fields[/bright_blue]', '' )
 			try:
-				act = Registry.importer_for( r.type ).load_as_activity( path=Service.path_for_resource( r ) )
+				act = Registry.importer_for( r.type ).load_as_activity( path=Service.path_for_resource( r ), cache=ActivityCache.for_context( ctx ) )
 				for nf in fields( act ):
 					table.add_row( nf.name, pp( getattr( act, nf.name ), max_depth=1, no_wrap=True ) )
 			except AttributeError:
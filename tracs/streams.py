@@ -1,11 +1,13 @@
+from array import array
 from csv import writer as csv_writer
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, tzinfo
 from io import StringIO
-from typing import List, Tuple
-from typing import Optional
+from math import isnan, nan
+from typing import Any, Iterable, List, Optional, Tuple
+from xml.sax.saxutils import escape
 
 from attrs import define, field
-from geojson import dump as dump_geojson
+from dateutil.tz import UTC
 from geojson import Feature
 from geojson import FeatureCollection
 from geojson import LineString
@@ -20,6 +22,27 @@ from tracs.plugins.tcx import Activity, Lap, Trackpoint as TCXTrackPoint, Traini
 from tracs.plugins.tcx import Lap as TCXLap
 from tracs.resources import Resource
 
+EPOCH = datetime( 1970, 1, 1 )
+
+COLUMNS = [ 'time', 'lat', 'lon', 'alt', 'distance', 'speed', 'hr' ]
+
+GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1" ' \
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+             'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" ' \
+             'version="1.1" creator="gpx.py -- https://github.com/tkrajina/gpxpy">'
+
+STRAVA_GPX_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1" ' \
+                    'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1" ' \
+                    'xmlns:gpxx="http://www.garmin.com/xmlschemas/GpxExtensions/v3" ' \
+                    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" ' \
+                    'xsi:schemaLocation="http://www.topografix.com/GPX/1/1  http://www.topografix.com/GPX/1/1/gpx.xsd  ' \
+                    'http://www.garmin.com/xmlschemas/GpxExtensions/v3 http://www.garmin.com/xmlschemas/GpxExtensionsv3.xsd ' \
+                    'http://www.garmin.com/xmlschemas/TrackPointExtension/v1 http://www.garmin.com/xmlschemas/TrackPointExtensionv1.xsd" ' \
+                    'version="1.1" creator="StravaGPX">'
+
+TCX_HEADER = '<TrainingCenterDatabase xmlns:py="http://codespeak.net/lxml/objectify/pytype" ' \
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema" py:pytype="TREE">'
+
 # todo: no need to reinvent the wheel: chosse another point class here
 @define
 class Point:
@@ -42,19 +65,72 @@ class Point:
 		if self.latlng:
 			self.lat, self.lon = self.latlng
 
+def column( values: Iterable[Optional[float]] = () ) -> array:
+	"""
+	Creates a stream column from the provided values, missing values are stored as NaN.
+	"""
+	return array( 'd', ( nan if v is None else v for v in values ) )
+
 @define
 class Stream:
-	points: List[Point] = field( factory=list )
+	"""
+	Stream of samples, stored column-wise as arrays of doubles (struct of arrays). Missing values are NaN, times are
+	seconds since epoch. Times are reconstructed using tz, tz = None denotes naive times.
+	"""
+
+	time: array = field( factory=column )
+	lat: array = field( factory=column )
+	lon: array = field( factory=column )
+	alt: array = field( factory=column )
+	distance: array = field( factory=column )
+	speed: array = field( factory=column )
+	hr: array = field( factory=column )
+	tz: Optional[tzinfo] = field( default=UTC )
+
+	_points: List[Point] = field( factory=list, kw_only=True, alias='points', repr=False )
 	gpx: GPX = field( default=None, kw_only=True )
 
 	def __attrs_post_init__( self ):
 		if self.gpx:
 			gpx_points = [p for t in self.gpx.tracks for s in t.segments for p in s.points]
-			self.points = [Point( p.time, p.latitude, p.longitude, p.speed ) for p in gpx_points]
+			self._points = [Point( p.time, p.latitude, p.longitude, p.speed ) for p in gpx_points]
+
+		if self._points:
+			self.tz = next( ( p.time.tzinfo for p in self._points if p.time ), self.tz )
+			self.time = column( epoch( p.time ) if p.time else None for p in self._points )
+			for name in COLUMNS[1:]:
+				setattr( self, name, column( getattr( p, name ) for p in self._points ) )
+			self._points = []
+
+		# all columns have the same length
+		for name in COLUMNS:
+			if ( missing := self.length - len( getattr( self, name ) ) ) > 0:
+				getattr( self, name ).extend( [nan] * missing )
 
 	@property
 	def length( self ) -> int:
-		return len( self.points )
+		return max( len( getattr( self, name ) ) for name in COLUMNS )
+
+	@property
+	def points( self ) -> List[Point]:
+		return [
+			Point( self.datetime( t ), value( lat ), value( lon ), value( speed ), value( alt ), value( distance ), integral( hr ) )
+			for t, lat, lon, speed, alt, distance, hr in zip( *self.columns( 'time', 'lat', 'lon', 'speed', 'alt', 'distance', 'hr' ) )
+		]
+
+	def columns( self, *names: str ) -> List[array]:
+		return [ getattr( self, name ) for name in names or COLUMNS ]
+
+	def datetime( self, seconds: float ) -> Optional[datetime]:
+		if isnan( seconds ):
+			return None
+		return datetime.fromtimestamp( seconds, self.tz ) if self.tz else EPOCH + timedelta( seconds=seconds )
+
+	def datetimes( self ) -> List[Optional[datetime]]:
+		return [ self.datetime( t ) for t in self.time ]
+
+	def has_coordinates( self ) -> bool:
+		return any( not isnan( lat ) and lat != 0 for lat in self.lat )
 
 	def as_csv_list( self ) -> List[List[str]]:
 		return [[str( p.lon ), str( p.lat )] for p in self.points]
@@ -98,6 +174,20 @@ class Stream:
 		gpx.tracks[0].type = kwargs.get( 'track_type' )
 		return gpx
 
+	def as_gpx_str( self, prettyprint: bool = True, **kwargs ) -> str:
+		"""
+		Fast path of as_gpx().to_xml( prettyprint ): the document is written directly from the columns.
+		"""
+		start = next( ( t for t in self.time if not isnan( t ) ), nan )
+		return format_gpx(
+			[ self ],
+			header=STRAVA_GPX_HEADER,
+			time=self.datetime( start ),
+			track_name=kwargs.get( 'track_name' ),
+			track_type=kwargs.get( 'track_type' ),
+			prettyprint=prettyprint
+		)
+
 	def as_tcx_lap( self, **kwargs ) -> TCXLap:
 		return TCXLap(
 			average_heart_rate_bpm=kwargs.get( 'average_heart_rate_bpm' ),
@@ -120,6 +210,44 @@ class Stream:
 			)]
 		)
 
+	def as_tcx_str( self, **kwargs ) -> str:
+		"""
+		Fast path of tostring( as_tcx().as_xml(), pretty_print=True ): the document is written directly from the columns.
+		"""
+		lines = [ TCX_HEADER, '  <Activities>', '    <Activity>' ]
+		_tcx_value( lines, 6, 'Id', kwargs.get( 'id' ) )
+		lines.append( f'      <Lap StartTime="{_ztime( kwargs.get( "start_date" ) )}">' )
+		_tcx_value( lines, 8, 'TotalTimeSeconds', kwargs.get( 'total_time_seconds' ) )
+		_tcx_value( lines, 8, 'DistanceMeters', kwargs.get( 'distance_meters' ) )
+		_tcx_value( lines, 8, 'MaximumSpeed', kwargs.get( 'maximum_speed' ) )
+		_tcx_value( lines, 8, 'Calories', kwargs.get( 'calories' ) )
+		_tcx_nested_value( lines, 8, 'AverageHeartRateBpm', kwargs.get( 'average_heart_rate_bpm' ) )
+		_tcx_nested_value( lines, 8, 'MaximumHeartRateBpm', kwargs.get( 'maximum_heart_rate_bpm' ) )
+		_tcx_value( lines, 8, 'Intensity', kwargs.get( 'intensity' ) )
+		_tcx_value( lines, 8, 'TriggerMethod', kwargs.get( 'trigger_method' ) )
+
+		if self.length == 0:
+			lines.append( '        <Track/>' )
+		else:
+			lines.append( '        <Track>' )
+			for t, lat, lon, alt, distance, hr in zip( *self.columns( 'time', 'lat', 'lon', 'alt', 'distance', 'hr' ) ):
+				lines.append( '          <Trackpoint>' )
+				if not isnan( t ):
+					lines.append( f'            <Time>{self.datetime( t ).isoformat( timespec="seconds" )[:19]}Z</Time>' )
+				if not isnan( lat ) and not isnan( lon ):
+					lines.append( '            <Position>' )
+					_tcx_number( lines, '              ', 'LatitudeDegrees', lat )
+					_tcx_number( lines, '              ', 'LongitudeDegrees', lon )
+					lines.append( '            </Position>' )
+				_tcx_number( lines, '            ', 'AltitudeMeters', alt )
+				_tcx_number( lines, '            ', 'DistanceMeters', distance )
+				_tcx_nested_value( lines, 12, 'HeartRateBpm', integral( hr ) )
+				lines.append( '          </Trackpoint>' )
+			lines.append( '        </Track>' )
+
+		lines.extend( [ '      </Lap>', '    </Activity>', '  </Activities>', '</TrainingCenterDatabase>', '' ] )
+		return '\n'.join( lines )
+
 def as_streams( resources: List[Resource] ) -> List[Stream]:
 	return [Stream( gpx=r.raw ) for r in resources]
 
@@ -140,12 +268,116 @@ def as_feature_collection( streams: List[Stream] ) -> FeatureCollection:
 
 def as_str( resources: List[Resource], fmt: str ) -> Optional[str]:
 	if fmt == 'csv':
-		return as_csv( as_streams( resources ) )
+		return format_csv( as_streams( resources ) )
 	elif fmt == 'gpx':
-		return as_gpx( as_streams( resources ) ).to_xml( prettyprint=False )
+		return format_gpx( as_streams( resources ), prettyprint=False )
 	elif fmt == 'geojson':
-		io = StringIO()
-		dump_geojson( as_feature_collection( as_streams( resources ) ), io )
-		return io.getvalue()
+		return format_geojson( as_streams( resources ) )
 	else:
 		return None
+
+# direct writers, output is identical to the output created via gpxpy, geojson, lxml and csv
+
+def format_csv( streams: List[Stream] ) -> str:
+	lines = [ 'longitude;latitude' ]
+	for s in streams:
+		lines.extend( f'{_str( lon )};{_str( lat )}' for lat, lon in zip( s.lat, s.lon ) )
+	return '\n'.join( lines ) + '\n'
+
+def format_geojson( streams: List[Stream] ) -> str:
+	features = []
+	for s in streams:
+		coordinates = ', '.join( f'[{round( lon, 6 )!r}, {round( lat, 6 )!r}]' for lat, lon in zip( s.lat, s.lon ) )
+		features.append( f'{{"type": "Feature", "id": "id_1", "geometry": {{"type": "LineString", "coordinates": [{coordinates}]}}, "properties": {{}}}}' )
+	return f'{{"type": "FeatureCollection", "features": [{", ".join( features )}]}}'
+
+def format_gpx(
+		streams: List[Stream],
+		header: str = GPX_HEADER,
+		time: Optional[datetime] = None,
+		track_name: Optional[str] = None,
+		track_type: Optional[str] = None,
+		extensions: bool = True,
+		prettyprint: bool = True
+) -> str:
+	"""
+	Writes a GPX document containing one track per stream. Heart rates are written as TrackPointExtension, unless
+	extensions is False.
+	"""
+	i = ( lambda level: '  ' * level ) if prettyprint else ( lambda level: '' )
+	lines = [ header ]
+
+	if time:
+		lines.extend( [ f'{i( 1 )}<metadata>', f'{i( 2 )}<time>{_isotime( time )}</time>', f'{i( 1 )}</metadata>' ] )
+
+	for s in streams:
+		lines.append( f'{i( 1 )}<trk>' )
+		if track_name is not None:
+			lines.append( f'{i( 2 )}<name>{escape( str( track_name ) )}</name>' )
+		if track_type is not None:
+			lines.append( f'{i( 2 )}<type>{escape( str( track_type ) )}</type>' )
+		lines.append( f'{i( 2 )}<trkseg>' )
+
+		for t, lat, lon, alt, hr in zip( *s.columns( 'time', 'lat', 'lon', 'alt', 'hr' ) ):
+			lines.append( f'{i( 3 )}<trkpt lat="{_gpx_number( lat )}" lon="{_gpx_number( lon )}">' )
+			if not isnan( alt ):
+				lines.append( f'{i( 4 )}<ele>{_gpx_number( alt )}</ele>' )
+			if not isnan( t ):
+				lines.append( f'{i( 4 )}<time>{_isotime( s.datetime( t ) )}</time>' )
+			if extensions:
+				lines.extend( [
+					f'{i( 4 )}<extensions>',
+					f'{i( 5 )}<gpxtpx:TrackPointExtension>',
+					f'{i( 6 )}<gpxtpx:hr>{integral( hr )}</gpxtpx:hr>',
+					f'{i( 5 )}</gpxtpx:TrackPointExtension>',
+					f'{i( 4 )}</extensions>',
+				] )
+			lines.append( f'{i( 3 )}</trkpt>' )
+
+		lines.extend( [ f'{i( 2 )}</trkseg>', f'{i( 1 )}</trk>' ] )
+
+	lines.append( '</gpx>' )
+	return '\n'.join( lines )
+
+# helpers
+
+def epoch( dt: datetime ) -> float:
+	return dt.timestamp() if dt.tzinfo else ( dt - EPOCH ).total_seconds()
+
+def value( v: float ) -> Optional[float]:
+	return None if isnan( v ) else v
+
+def integral( v: float ) -> Optional[int|float]:
+	return None if isnan( v ) else int( v ) if v.is_integer() else v
+
+def _str( v: float ) -> str:
+	return 'None' if isnan( v ) else repr( v )
+
+def _gpx_number( v: float ) -> str:
+	# same as gpxpy: missing coordinates are written as 0, scientific notation is not allowed
+	if isnan( v ):
+		return '0'
+	s = repr( v )
+	return s if 'e' not in s else format( v, '.10f' ).rstrip( '0' ).rstrip( '.' )
+
+def _isotime( dt: datetime ) -> str:
+	return dt.isoformat().replace( '+00:00', 'Z' )
+
+def _ztime( dt: Optional[datetime] ) -> Optional[str]:
+	return dt.strftime( '%Y-%m-%dT%H:%M:%SZ' ) if dt else None
+
+def _tcx_value( lines: List[str], indent: int, name: str, v: Any ) -> None:
+	# same as tcx.sub(): None and 0 are omitted
+	if v is not None and v != 0 and v != 0.0:
+		lines.append( f'{" " * indent}<{name}>{escape( str( v ) )}</{name}>' )
+
+def _tcx_number( lines: List[str], indent: str, name: str, v: float ) -> None:
+	if v != 0 and not isnan( v ):
+		lines.append( f'{indent}<{name}>{v!r}</{name}>' )
+
+def _tcx_nested_value( lines: List[str], indent: int, name: str, v: Any ) -> None:
+	# same as tcx.sub2(): the outer element is always present
+	if v is not None and v != 0 and v != 0.0:
+		lines.extend( [ f'{" " * indent}<{name}>', f'{" " * ( indent + 2 )}<Value>{escape( str( v ) )}</Value>', f'{" " * indent}</{name}>' ] )
+	else:
+		lines.append( f'{" " * indent}<{name}/>' )
@@ -148,16 +148,13 @@ def resource_files( activities: List[Activity], correct: bool ) -> ReportData:
 	return rd
 
 def tcx_files( activities: List[Activity], correct: bool ) -> ReportData:
-	from tcxreader.tcxreader import TCXReader
-	from tcxreader.tcx_exercise import TCXExercise
-	from xml.etree.ElementTree import ParseError
+	from lxml.etree import XMLSyntaxError
+	from tracs.plugins.tcx import read_tcx
 
 	rd = ReportData( name='TCX Files' )
 	all_resources = ReportData.ctx.db.find_all_resources_for( activities )
 	ReportData.ctx.start( 'Checking TCX files for parse errors ...', total=len( all_resources ) )
 
-	reader = TCXReader()
-
 	for r in all_resources:
 		ReportData.ctx.advance( msg=str( r.path ) )
 
@@ -166,9 +163,9 @@ def tcx_files( activities: List[Activity], correct: bool ) -> ReportData:
 
 		if (path := Service.path_for_resource( r )).exists():
 			try:
-				exercise: TCXExercise = reader.read( str( path ) )
-				rd.info( f'TCX parsing ok ({len( exercise.trackpoints )})', path=path )
-			except (ParseError, ValueError) as error:
+				tcx = read_tcx( path.read_bytes() )
+				rd.info( f'TCX parsing ok ({tcx.trackpoints})', path=path )
+			except (XMLSyntaxError, ValueError) as error:
 				rd.error( f'TCX parse error', path=path )
 
 	ReportData.ctx.complete()